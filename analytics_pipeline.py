@@ -0,0 +1,337 @@
+"""
+analytics_pipeline.py
+---------------------
+Local, incremental replacement for the EMR notebook export
+(M2-bigdata/Note converted from Jupyter...). Reads bus_arrivals straight from
+the bus database and writes the datasets behind /charts:
+
+    avg_by_hour.csv          weekday, hour -> avg_eta, eta_variability
+    avg_by_service_hour.csv  service, weekday, hour -> avg_eta, eta_variability
+    median_by_service.csv    service -> median_eta, avg_eta, eta_variability, drift_volatility
+    drift_by_service.csv     service -> avg_eta_drift, drift_variability, avg_volatility
+    top10_worst.csv          the 10 services with the highest avg_eta_drift
+
+Drift follows notebook step 3: per (stop, service), ordered by time,
+eta_change = eta - previous eta and volatility = |eta_change|. Weekday uses
+Spark's dayofweek numbering (1 = Sunday ... 7 = Saturday).
+
+Every aggregate is kept as a mergeable partial (count / sum / sum of squares,
+plus an ETA histogram per service for the median) in a JSON state file,
+together with a per-partition id watermark and the last ETA per
+(stop, service). A run only reads rows above the watermark, in chunks, and
+merges them in. Partitions are SQLite day files locally and the day
+partitions of bus_arrivals on PostgreSQL. With pyarrow installed every
+dataset is also written as Parquet, which /charts prefers.
+
+Usage:
+    python analytics_pipeline.py [--rebuild] [--chunk-size 50000] [--state PATH] [--out DIR]
+"""
+
+import argparse
+import csv
+import json
+import math
+import os
+import sqlite3
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+from columnar import PARQUET_AVAILABLE, parquet_path, write_frame
+from database import (IS_PRODUCTION, get_bus_db_connection, sqlite_arrival_days, arrival_day_path,
+                      _pg_arrival_partitions)
+
+try:
+    import fcntl
+except ImportError:  # Windows: runs are not serialised
+    fcntl = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = os.getenv("ANALYTICS_STATE_FILE", os.path.join(BASE_DIR, "database/analytics_state.json"))
+DATASET_DIR = os.path.join(BASE_DIR, "static/datasets")
+CHUNK_SIZE = 50000
+STATE_VERSION = 1
+
+
+def _key(*parts):
+    return "|".join(str(p) for p in parts)
+
+
+def _spark_weekday(day):
+    return day.isoweekday() % 7 + 1
+
+
+def _add(stats, value):
+    """Fold one value into a [count, sum, sum of squares] triple."""
+    stats[0] += 1
+    stats[1] += value
+    stats[2] += value * value
+
+
+def _merge_stats(into, other):
+    for i in range(3):
+        into[i] += other[i]
+
+
+def _mean_std(stats):
+    """Mean and sample standard deviation (None below two samples, like Spark's stddev)."""
+    count, total, total_sq = stats
+    mean = total / count
+    if count < 2:
+        return mean, None
+    return mean, math.sqrt(max(total_sq - total * total / count, 0.0) / (count - 1))
+
+
+class PartialAggregates:
+    """Mergeable partial aggregates for the notebook's datasets."""
+
+    def __init__(self):
+        self.by_hour = {}          # weekday|hour -> [n, sum, sumsq]
+        self.by_service_hour = {}  # service|weekday|hour -> [n, sum, sumsq]
+        self.eta = {}              # service -> [n, sum, sumsq]
+        self.drift = {}            # service -> [n, sum, sumsq] of eta_change
+        self.volatility = {}       # service -> [n, sum of |eta_change|, unused]
+        self.histogram = {}        # service -> {eta in tenths of a minute: count}
+
+    def add(self, service, weekday, hour, eta, change):
+        _add(self.by_hour.setdefault(_key(weekday, hour), [0, 0.0, 0.0]), eta)
+        _add(self.by_service_hour.setdefault(_key(service, weekday, hour), [0, 0.0, 0.0]), eta)
+        _add(self.eta.setdefault(service, [0, 0.0, 0.0]), eta)
+        bins = self.histogram.setdefault(service, {})
+        tenths = str(round(eta * 10))
+        bins[tenths] = bins.get(tenths, 0) + 1
+        if change is not None:
+            _add(self.drift.setdefault(service, [0, 0.0, 0.0]), change)
+            _add(self.volatility.setdefault(service, [0, 0.0, 0.0]), abs(change))
+
+    def merge(self, other):
+        for name in ("by_hour", "by_service_hour", "eta", "drift", "volatility"):
+            mine = getattr(self, name)
+            for key, stats in getattr(other, name).items():
+                if key in mine:
+                    _merge_stats(mine[key], stats)
+                else:
+                    mine[key] = list(stats)
+        for service, bins in other.histogram.items():
+            mine = self.histogram.setdefault(service, {})
+            for tenths, count in bins.items():
+                mine[tenths] = mine.get(tenths, 0) + count
+
+    def to_state(self):
+        return {name: getattr(self, name) for name in
+                ("by_hour", "by_service_hour", "eta", "drift", "volatility", "histogram")}
+
+    @classmethod
+    def from_state(cls, state):
+        partial = cls()
+        for name, value in (state or {}).items():
+            setattr(partial, name, value)
+        return partial
+
+    def median(self, service):
+        """Smallest ETA with at least half the samples at or below it (percentile_approx 0.5)."""
+        bins = sorted((int(t), c) for t, c in self.histogram[service].items())
+        half, seen = sum(c for _, c in bins) * 0.5, 0
+        for tenths, count in bins:
+            seen += count
+            if seen >= half:
+                return tenths / 10
+
+    def datasets(self):
+        """filename -> (header, rows), ordered like the notebook's exports."""
+        by_hour = []
+        for key in sorted(self.by_hour, key=lambda k: tuple(map(int, k.split("|")))):
+            by_hour.append([*map(int, key.split("|")), *_mean_std(self.by_hour[key])])
+
+        by_service_hour = []
+        for key in sorted(self.by_service_hour, key=lambda k: (k.split("|")[0], *map(int, k.split("|")[1:]))):
+            service, weekday, hour = key.split("|")
+            by_service_hour.append([service, int(weekday), int(hour), *_mean_std(self.by_service_hour[key])])
+
+        median = []
+        for service, stats in self.eta.items():
+            volatility = self.volatility.get(service)
+            median.append([service, self.median(service), *_mean_std(stats),
+                           volatility[1] / volatility[0] if volatility else None])
+        median.sort(key=lambda row: row[1], reverse=True)
+
+        drift = []
+        for service, stats in self.drift.items():
+            volatility = self.volatility[service]
+            drift.append([service, *_mean_std(stats), volatility[1] / volatility[0]])
+        drift.sort(key=lambda row: row[1], reverse=True)
+
+        hour_header = ["weekday", "hour", "avg_eta", "eta_variability"]
+        drift_header = ["service", "avg_eta_drift", "drift_variability", "avg_volatility"]
+        return {
+            "avg_by_hour.csv": (hour_header, by_hour),
+            "avg_by_service_hour.csv": (["service"] + hour_header, by_service_hour),
+            "median_by_service.csv": (["service", "median_eta", "avg_eta", "eta_variability", "drift_volatility"],
+                                      median),
+            "drift_by_service.csv": (drift_header, drift),
+            "top10_worst.csv": (drift_header, drift[:10]),
+        }
+
+
+# ---- Reading bus_arrivals ----
+def arrival_units(today=None):
+    """(unit, closed) for every arrivals partition, oldest first.
+
+    A unit is closed once its day is over (plus a day of slack), so no new
+    rows can land in it after it has been read.
+    """
+    today = today or date.today()
+    if IS_PRODUCTION:
+        conn = get_bus_db_connection(role="primary")
+        cursor = conn.cursor()
+        partitions = sorted(_pg_arrival_partitions(cursor), key=lambda p: p[2] or datetime.max)
+        cursor.close()
+        conn.close()
+        return [(name, upper is not None and upper.date() < today) for name, _, upper in partitions]
+    return [(f"{day:%Y%m%d}", day < today - timedelta(days=1)) for day in sqlite_arrival_days()]
+
+
+def read_unit(unit, after_id, chunk_size):
+    """Yield chunks of (id, stop_code, service, eta_min, timestamp) above after_id, in id order."""
+    sql = ("SELECT id, stop_code, service, eta_min, timestamp FROM {table} "
+           "WHERE id > {param} AND eta_min IS NOT NULL ORDER BY id")
+    if IS_PRODUCTION:
+        conn = get_bus_db_connection()
+        # Server-side cursor: the partition is streamed, not loaded into memory
+        cursor = conn.cursor(name=f"analytics_{unit}")
+        cursor.itersize = chunk_size
+        cursor.execute(sql.format(table=unit, param="%s"), (after_id,))
+    else:
+        conn = sqlite3.connect(arrival_day_path(datetime.strptime(unit, "%Y%m%d")))
+        cursor = conn.cursor()
+        cursor.execute(sql.format(table="bus_arrivals", param="?"), (after_id,))
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [tuple(row.values()) if isinstance(row, dict) else tuple(row) for row in rows]
+    finally:
+        cursor.close()
+        conn.rollback()
+        conn.close()
+
+
+def aggregate_chunk(rows, last_eta):
+    """Partial aggregates of one chunk; last_eta carries the lag across chunks and runs."""
+    partial = PartialAggregates()
+    weekdays = {}
+    for _, stop, service, eta, ts in rows:
+        if stop is None or service is None:
+            continue
+        ts = str(ts)
+        day = ts[:10]
+        if day not in weekdays:
+            weekdays[day] = _spark_weekday(date.fromisoformat(day))
+        key = _key(stop, service)
+        previous = last_eta.get(key)
+        partial.add(service, weekdays[day], int(ts[11:13]), eta,
+                    eta - previous if previous is not None else None)
+        last_eta[key] = eta
+    return partial
+
+
+# ---- State and outputs ----
+def empty_state():
+    return {"version": STATE_VERSION, "units": {}, "last_eta": {}, "watermark": None, "aggregates": {}}
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return empty_state()
+    with open(path) as f:
+        state = json.load(f)
+    if state.get("version") != STATE_VERSION:
+        print(f"⚠️ {path} has an old format, rebuilding from scratch")
+        return empty_state()
+    return state
+
+
+def _atomic_write(path, write):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", newline="") as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def save_state(path, state):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _atomic_write(path, lambda f: json.dump(state, f, separators=(",", ":")))
+
+
+def write_datasets(partial, out_dir):
+    """Write the CSVs, plus Parquet copies when pyarrow is installed.
+
+    Each file is replaced atomically so /charts never reads half of one.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for filename, (header, rows) in partial.datasets().items():
+        def write(f, header=header, rows=rows):
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(["" if v is None else v for v in row] for row in rows)
+        path = os.path.join(out_dir, filename)
+        _atomic_write(path, write)
+        if PARQUET_AVAILABLE:
+            write_frame(pd.DataFrame(rows, columns=header), parquet_path(path))
+
+
+def run_pipeline(state_path=STATE_FILE, out_dir=DATASET_DIR, chunk_size=CHUNK_SIZE, rebuild=False):
+    """Merge arrivals newer than the watermark into the stored aggregates and rewrite the datasets.
+
+    Returns the number of rows read.
+    """
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with open(f"{state_path}.lock", "w") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        state = empty_state() if rebuild else load_state(state_path)
+        aggregates = PartialAggregates.from_state(state["aggregates"])
+        units = arrival_units()
+        # Forget watermarks of partitions that retention has dropped
+        state["units"] = {unit: state["units"][unit] for unit, _ in units if unit in state["units"]}
+
+        total = 0
+        for unit, closed in units:
+            progress = state["units"].setdefault(unit, {"last_id": 0, "closed": False})
+            if progress["closed"]:
+                continue
+            count = 0
+            for rows in read_unit(unit, progress["last_id"], chunk_size):
+                aggregates.merge(aggregate_chunk(rows, state["last_eta"]))
+                progress["last_id"] = rows[-1][0]
+                state["watermark"] = max(state["watermark"] or "", str(rows[-1][4])[:19])
+                count += len(rows)
+            progress["closed"] = closed
+            state["aggregates"] = aggregates.to_state()
+            save_state(state_path, state)
+            if count:
+                print(f"📊 {unit}: merged {count} arrivals")
+            total += count
+
+        if aggregates.eta:
+            write_datasets(aggregates, out_dir)
+            print(f"✅ Analytics datasets updated ({total} new arrivals, watermark {state['watermark']})")
+        else:
+            # Keep the existing exports rather than replacing them with empty files
+            print("⚠️ No bus arrivals aggregated yet, datasets left unchanged")
+        return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rebuild", action="store_true", help="ignore the stored state and re-read every partition")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--state", default=STATE_FILE)
+    parser.add_argument("--out", default=DATASET_DIR)
+    args = parser.parse_args()
+    run_pipeline(args.state, args.out, args.chunk_size, args.rebuild)
+
+
+if __name__ == "__main__":
+    main()
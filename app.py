@@ -1,15 +1,29 @@
-import os, sqlite3, requests, threading, time, re
+import os, requests, threading, time, re, json, hashlib
+from collections import Counter
+from functools import lru_cache
 from datetime import datetime
 from flask import Flask, jsonify, render_template, request, redirect, url_for, session, current_app
 from dotenv import load_dotenv
 import pandas as pd
-import folium
-from sqlalchemy import create_engine, Table, Column, String, Float, MetaData, DateTime
-from charts import charts_bp
+from sqlalchemy import (create_engine, event, Table, Column, String, Float, MetaData, DateTime, Integer, Index,
+                        UniqueConstraint, select, func, inspect)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from charts import charts_bp, hour_of_week_baseline
+from route_segments import build_segment_index
+from analytics_pipeline import run_pipeline
+from trips import read_trips, reconstruct_trips
+from live_stats import load_collector_stats, persist_collector_stats
+from leaderboard import collector_leaderboard, persist_leaderboard
+from arrivals_fallback import LIVE_ARRIVALS_TIMEOUT, datamall_circuit, typical_arrivals
+from delay_model import delay_risks
+from downsample import downsample
 
 # Import auth module
-from database import init_users_db, init_bus_db, get_db_connection, get_bus_db_connection, IS_PRODUCTION
-from auth import auth_bp, login_required, current_user
+from database import (init_users_db, init_bus_db, get_db_connection, get_bus_db_connection, get_pool_stats,
+                      get_writer_stats, submit_write, flush_writes, apply_sqlite_pragmas, arrivals_source,
+                      insert_arrivals, maintain_arrival_partitions, read_arrival_rollups, read_only,
+                      get_routing_stats, bulk_write, iter_arrival_series, LAST_ETA_SQL, IS_PRODUCTION)
+from auth import auth_bp, login_required, current_user, cached_bus_favorites, write_bus_favorites
 
 #Chatbot module
 from chatbot import chatbot_bp 
@@ -60,36 +74,48 @@ def require_login():
     if not session.get("user_id"):
         return redirect(url_for("auth.login"))
 
+# ==================== METRICS ====================
+@app.route("/api/metrics/db")
+def db_metrics():
+    """Connection pool checkout counts, wait times, SQLite writer batching and replica routing for this worker process."""
+    return jsonify({"pid": os.getpid(), "pools": get_pool_stats(), "writer": get_writer_stats(),
+                    "routing": get_routing_stats()})
+
 # ==================== BUS MODULE ====================
 
 # Bus database setup
 
 # Load bus stops
-def load_bus_stops():
-    conn = get_bus_db_connection()
+def bus_table_empty(table):
+    conn = get_bus_db_connection(role="primary")
     c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM bus_stops")
-    if c.fetchone()[0] > 0:
-        conn.close()
-        return # Exit if data exists 
+    c.execute(f"SELECT COUNT(*) AS n FROM {table}")
+    count = c.fetchone()["n"]
+    conn.close()
+    return count == 0
 
-    print("📥 Loading bus stops ...")
-    skip = 0
+def fetch_lta_pages(endpoint):
+    """All records of a paged LTA DataMall endpoint (500 per page)."""
+    records, skip = [], 0
     while True:
-        r = requests.get(f"{BASE_URL}/BusStops?$skip={skip}", headers=BUS_HEADERS, timeout=20)
+        r = requests.get(f"{BASE_URL}/{endpoint}?$skip={skip}", headers=BUS_HEADERS, timeout=20)
         data = r.json().get("value", [])
-        if not data:
-            break
-        for s in data:
-            c.execute("INSERT OR REPLACE INTO bus_stops VALUES (?,?,?,?,?)",
-                      (s["BusStopCode"], s["Description"], s["RoadName"],
-                       s["Latitude"], s["Longitude"]))
-        conn.commit()
+        records.extend(data)
         if len(data) < 500:
-            break
+            return records
         skip += 500
-    conn.close()
-    print("✅ Bus stops cached.")
+
+def load_bus_stops():
+    if not bus_table_empty("bus_stops"):
+        return # Exit if data exists 
+
+    print("📥 Loading bus stops ...")
+    rows = [(s["BusStopCode"], s["Description"], s["RoadName"], s["Latitude"], s["Longitude"])
+            for s in fetch_lta_pages("BusStops")]
+    # One bulk load (COPY on PostgreSQL), swapped in as a whole
+    bulk_write("bus", "bus_stops", ("code", "description", "road", "lat", "lon"), rows,
+               key=("code",), replace=True)
+    print(f"✅ Bus stops cached ({len(rows)} stops).")
 
 # 
 
@@ -103,61 +129,36 @@ def load_bus_stops():
 
 # Loading bus routes on start-up 
 def load_bus_routes():
-    conn = sqlite3.connect(BUS_DB_FILE)
-    c = conn.cursor()
-    c.execute("""CREATE TABLE IF NOT EXISTS bus_routes (
-        ServiceNo TEXT,
-        Direction INTEGER,
-        StopSequence INTEGER,
-        BusStopCode TEXT,
-        Distance REAL
-    )""")
-    conn.commit()
-
      # If data already exist in the table then skip 
-    c.execute("SELECT COUNT(*) FROM bus_routes")
-    if c.fetchone()[0] > 0:
-        conn.close()
+    if not bus_table_empty("bus_routes"):
         print("✅ Bus routes already cached.")
         return #exit if data exist
 
     print("📥 Loading bus routes ...")
-    skip = 0
-    while True:
-        r = requests.get(f"{BASE_URL}/BusRoutes?$skip={skip}", headers=BUS_HEADERS, timeout=20)
-        data = r.json().get("value", [])
-        if not data:
-            break
-        for route in data:
-            c.execute("""
-                INSERT OR REPLACE INTO bus_routes VALUES (?,?,?,?,?)
-            """, (
-                route["ServiceNo"], route["Direction"],
-                route["StopSequence"], route["BusStopCode"],
-                route.get("Distance", 0.0)
-            ))
-        conn.commit()
-        if len(data) < 500:
-            break
-        skip += 500
-    
-    conn.close()
-    print("✅ Bus routes cached.")
-
-# Build bus_routes_by_service cache from SQLite
+    # All pages are fetched first and loaded in one transaction, so a failed
+    # download never leaves a partial table that the check above would skip
+    rows = [(route["ServiceNo"], route["Direction"], route["StopSequence"], route["BusStopCode"],
+             route.get("Distance", 0.0))
+            for route in fetch_lta_pages("BusRoutes")]
+    bulk_write("bus", "bus_routes", ("ServiceNo", "Direction", "StopSequence", "BusStopCode", "Distance"),
+               rows, replace=True)
+    print(f"✅ Bus routes cached ({len(rows)} route stops).")
+
+# Build bus_routes_by_service cache from the bus database
 def build_bus_routes_cache():
     print("🔧 Building bus_routes_by_service cache (deduplicated)...")
 
-    conn = sqlite3.connect(BUS_DB_FILE)
+    conn = get_bus_db_connection()
     c = conn.cursor()
 
     c.execute("""
-        SELECT ServiceNo, Direction, StopSequence, BusStopCode
+        SELECT ServiceNo AS service_no, Direction AS direction, StopSequence AS stop_sequence,
+               BusStopCode AS bus_stop_code
         FROM bus_routes
         ORDER BY ServiceNo, Direction, StopSequence
     """)
 
-    rows = c.fetchall()
+    rows = [(r["service_no"], r["direction"], r["stop_sequence"], r["bus_stop_code"]) for r in c.fetchall()]
     conn.close()
 
     cache = {}
@@ -192,21 +193,35 @@ def get_all_stops():
     conn = get_bus_db_connection()  # NEW
     c = conn.cursor()
     c.execute("SELECT code FROM bus_stops")
-    stops = [x[0] for x in c.fetchall()]
+    stops = [x["code"] for x in c.fetchall()]
     conn.close()
     return stops
 
+COLLECTOR_WRITE_ROWS = 500
+
+@read_only  # lookups may use the replica; inserts always go to the primary
 def collect_bus_arrivals():
     conn = get_bus_db_connection()  # NEW
     c = conn.cursor()
     stops = get_all_stops()
     now = datetime.now()
+    # Only today's and yesterday's partitions are needed for the last-ETA lookup
+    recent = arrivals_source(conn, now - timedelta(days=1), now)
+    param = "%s" if IS_PRODUCTION else "?"
+    pending = []  # rows of several stops, written in one COPY / batch
+    live = load_collector_stats()
+    try:
+        collector_leaderboard.set_baseline(hour_of_week_baseline())
+    except Exception as e:
+        print("Leaderboard baseline unavailable:", e)
 
     for code in stops:
         try:
             r = requests.get(f"{BASE_URL}/v3/BusArrival?BusStopCode={code}",
                              headers=BUS_HEADERS, timeout=10)
             data = r.json().get("Services", [])
+            rows = []
+            last_eta = {}  # ETA last stored per service, including rows queued in this stop
             for s in data:
                 service = s["ServiceNo"]
                 btype = s["NextBus"].get("Type", "Unknown")
@@ -217,26 +232,60 @@ def collect_bus_arrivals():
                     eta = datetime.fromisoformat(t.replace("+08:00", ""))
                     diff = (eta - now).total_seconds() / 60
                     if diff >= 0:
-                        c.execute("""SELECT eta_min FROM bus_arrivals
-                                     WHERE stop_code=? AND service=?
-                                     ORDER BY timestamp DESC LIMIT 1""",
-                                  (code, service))
-                        last = c.fetchone()
-                        if not last or abs(last[0] - diff) > 0.3:
-                            c.execute("""
-                                INSERT INTO bus_arrivals (stop_code, service, eta_min, bus_type, timestamp)
-                                VALUES (?,?,?,?,?)
-                            """, (code, service, round(diff, 1), btype, now.strftime("%Y-%m-%d %H:%M:%S")))
-            conn.commit()
+                        if service not in last_eta:
+                            c.execute(LAST_ETA_SQL.format(recent=recent, p=param), (code, service))
+                            last = c.fetchone()
+                            last_eta[service] = last["eta_min"] if last else None
+                        if last_eta[service] is None or abs(last_eta[service] - diff) > 0.3:
+                            rows.append((code, service, round(diff, 1), btype, now.strftime("%Y-%m-%d %H:%M:%S")))
+                            previous, last_eta[service] = last_eta[service], round(diff, 1)
+                            change = last_eta[service] - previous if previous is not None else None
+                            live.observe(service, now.hour, last_eta[service], change)
+                            collector_leaderboard.observe(service, now, last_eta[service], change)
+            pending.extend(rows)
+            if len(pending) >= COLLECTOR_WRITE_ROWS:
+                # Queued for the writer thread; readers never wait on this insert
+                insert_arrivals(pending)
+                pending = []
             time.sleep(0.4)
         except Exception as e:
             print(f"⚠️ Error fetching stop {code}: {e}")
     conn.close()
+    if pending:
+        insert_arrivals(pending)
+    flush_writes()
+    try:
+        persist_collector_stats()
+    except Exception as e:
+        print("Persisting collector live stats failed:", e)
+    try:
+        persist_leaderboard()
+    except Exception as e:
+        print("Persisting the live leaderboard failed:", e)
     print(f"✅ Bus collector cycle done at {datetime.now().strftime('%H:%M:%S')}")
 
+ARRIVAL_MAINTENANCE_SECONDS = 3600
+
 def background_bus_collector():
     print("🧠 Bus background collector started (every 1 min).")
+    last_maintenance = 0
     while True:
+        # Hourly: refresh the /charts datasets and trips from new arrivals, then roll
+        # daily partitions forward and archive expired ones (after they were aggregated)
+        if time.time() - last_maintenance >= ARRIVAL_MAINTENANCE_SECONDS:
+            try:
+                run_pipeline()
+            except Exception as e:
+                print("Bus analytics pipeline failed:", e)
+            try:
+                reconstruct_trips()
+            except Exception as e:
+                print("Bus trip reconstruction failed:", e)
+            try:
+                maintain_arrival_partitions()
+            except Exception as e:
+                print("Bus arrival partition maintenance failed:", e)
+            last_maintenance = time.time()
         try:
             collect_bus_arrivals()
         except Exception as e:
@@ -245,50 +294,105 @@ def background_bus_collector():
 
 # Bus API endpoints
 @app.route("/bus_stops")
+@read_only
 def bus_stops():
     q = request.args.get("query", "").strip().lower()
+    param = "%s" if IS_PRODUCTION else "?"
     conn = get_bus_db_connection()  # NEW
     c = conn.cursor()
     if q:
         like = f"%{q}%"
-        c.execute("""SELECT code,description,road,lat,lon FROM bus_stops
-                     WHERE LOWER(description) LIKE ? OR LOWER(road) LIKE ? OR code LIKE ?""",
+        c.execute(f"""SELECT code,description,road,lat,lon FROM bus_stops
+                      WHERE LOWER(description) LIKE {param} OR LOWER(road) LIKE {param} OR code LIKE {param}""",
                   (like, like, like))
     else:
         c.execute("SELECT code,description,road,lat,lon FROM bus_stops")
     rows = c.fetchall()
     conn.close()
-    return jsonify([{"code": r[0], "desc": r[1], "road": r[2], "lat": r[3], "lon": r[4]} for r in rows])
+    return jsonify([{"code": r["code"], "desc": r["description"], "road": r["road"], "lat": r["lat"], "lon": r["lon"]}
+                    for r in rows])
 
 @app.route("/bus_routes")
+@read_only
 def get_bus_routes():
     service = request.args.get("service")
-    direction = request.args.get("direction", 1)
-    conn = sqlite3.connect(BUS_DB_FILE)
+    direction = request.args.get("direction", 1, type=int)
+    param = "%s" if IS_PRODUCTION else "?"
+    conn = get_bus_db_connection()
     c = conn.cursor()
-    c.execute("SELECT ServiceNo, Direction, StopSequence, BusStopCode FROM bus_routes WHERE ServiceNo = ? AND Direction = ? ORDER BY StopSequence", (service, direction))
+    c.execute(f"""SELECT ServiceNo AS service_no, Direction AS direction, StopSequence AS stop_sequence,
+                         BusStopCode AS bus_stop_code
+                  FROM bus_routes WHERE ServiceNo = {param} AND Direction = {param} ORDER BY StopSequence""",
+              (service, direction))
     rows = c.fetchall()
     conn.close()
     return jsonify([
-        {"ServiceNo": r[0], "Direction": r[1], "StopSequence": r[2], "BusStopCode": r[3]}
+        {"ServiceNo": r["service_no"], "Direction": r["direction"], "StopSequence": r["stop_sequence"],
+         "BusStopCode": r["bus_stop_code"]}
         for r in rows
     ])
 
 
+def fetch_live_arrivals(code, headers=BUS_HEADERS, url=f"{BASE_URL}/v3/BusArrival"):
+    """BusArrival services of a stop from DataMall, or None if the call failed or the circuit is open.
+
+    Only timeouts and 5xx responses count towards opening the circuit; a 4xx (bad
+    stop code or key) means DataMall itself is answering.
+    """
+    if not datamall_circuit.allow():
+        return None
+    try:
+        r = requests.get(url, headers=headers, params={"BusStopCode": code}, timeout=LIVE_ARRIVALS_TIMEOUT)
+    except requests.Timeout as e:
+        datamall_circuit.record_failure()
+        print(f"⚠️ DataMall BusArrival timed out for {code}: {e}")
+        return None
+    except requests.RequestException as e:
+        datamall_circuit.release_trial()
+        print(f"⚠️ DataMall BusArrival failed for {code}: {e}")
+        return None
+    if r.status_code >= 500:
+        datamall_circuit.record_failure()
+        print(f"⚠️ DataMall BusArrival returned {r.status_code} for {code}")
+        return None
+    datamall_circuit.record_success()
+    if r.status_code != 200:
+        print(f"⚠️ DataMall BusArrival returned {r.status_code} for {code}")
+        return None
+    try:
+        return r.json().get("Services", [])
+    except ValueError as e:
+        print(f"⚠️ DataMall BusArrival sent invalid JSON for {code}: {e}")
+        return None
+
+def typical_arrivals_sg(code):
+    """Typical-wait estimates for a stop at the current Singapore hour of week."""
+    from datetime import timezone
+    return typical_arrivals(code, datetime.now(timezone(timedelta(hours=8))))
+
 #with fixed timezone issues
 @app.route("/bus_arrivals/<code>")
 @login_required
 def bus_arrivals(code):
     try:
-        # Call LTA API
-        r = requests.get(
-            f"{BASE_URL}/v3/BusArrival?BusStopCode={code}",
-            headers=BUS_HEADERS,
-            timeout=10
-        )
-        r.raise_for_status()
-        
-        data = r.json()
+        # Call LTA API (fails fast, and not at all while the DataMall circuit is open)
+        services = fetch_live_arrivals(code)
+        if services is None:
+            # Labelled estimates from history instead of an empty table
+            affected_services = get_traffic_snapshot()["affected_services"]
+            estimates = [{
+                "service": e["service"],
+                "type": "Estimate",
+                "eta": [round(e["wait"] + n * e["headway"], 1) for n in range(3)] if e["headway"] else [e["wait"]],
+                "incidents": affected_services.get(e["service"], []),
+                "estimated": True,
+                "estimate_basis": e["basis"],
+                "delay_risk": None,
+            } for e in typical_arrivals_sg(code)]
+            if not estimates:
+                return jsonify({"error": "Live arrivals unavailable and no history for this stop"}), 503
+            return jsonify(estimates)
+        data = {"Services": services}
         
         # Use Singapore timezone for proper comparison
         from datetime import timezone, timedelta
@@ -296,6 +400,7 @@ def bus_arrivals(code):
         now = datetime.now(sg_tz)  # ← Singapore time, not UTC!
         
         results = []
+        affected_services = get_traffic_snapshot()["affected_services"]
         
         for s in data.get("Services", []):
             waits = []
@@ -318,8 +423,19 @@ def bus_arrivals(code):
             results.append({
                 "service": s["ServiceNo"],
                 "type": s["NextBus"].get("Type", "Unknown"),
-                "eta": waits
+                "eta": waits,
+                "incidents": affected_services.get(s["ServiceNo"], [])
             })
+
+        # Delay risk for every service in one vectorized model call (null until a model is trained)
+        try:
+            risks = delay_risks([{"service": r["service"], "stop": code, "eta": r["eta"][0] if r["eta"] else None}
+                                 for r in results], now)
+        except Exception as e:
+            print(f"Delay risk error: {e}")
+            risks = None
+        for result, risk in zip(results, risks or [None] * len(results)):
+            result["delay_risk"] = risk
         
         return jsonify(results)
         
@@ -343,21 +459,30 @@ def get_bus_arrivals_api(bus_stop_code):
             'accept': 'application/json'
         }
         
-        response = requests.get(
-            'https://datamall2.mytransport.sg/ltaodataservice/v3/BusArrival',
-            headers=headers,
-            params={'BusStopCode': bus_stop_code},
-            timeout=10
-        )
-        
-        if response.status_code != 200:
+        services = fetch_live_arrivals(bus_stop_code, headers=headers,
+                                       url='https://datamall2.mytransport.sg/ltaodataservice/v3/BusArrival')
+        if services is None:
+            # Typical waits at this hour of week, clearly marked as estimates
+            estimates = typical_arrivals_sg(bus_stop_code)
+            if not estimates:
+                return jsonify({
+                    'success': False,
+                    'error': 'Live arrivals unavailable and no history for this stop'
+                }), 503
             return jsonify({
-                'success': False,
-                'error': f'LTA API returned status {response.status_code}'
-            }), 500
-        
-        data = response.json()
-        services = data.get('Services', [])
+                'success': True,
+                'estimated': True,
+                'bus_stop_code': bus_stop_code,
+                'services': [{
+                    'service_no': e['service'],
+                    'operator': None,
+                    'buses': [{'eta': None, 'minutes': int(e['wait']), 'load': 'N/A', 'type': 'Estimate',
+                               'feature': ''}],
+                    'typical_wait': e['wait'],
+                    'typical_headway': e['headway'],
+                } for e in estimates],
+                'timestamp': datetime.now(timezone(timedelta(hours=8))).isoformat()
+            })
         
         # Format response
         formatted_services = []
@@ -403,41 +528,114 @@ def get_bus_arrivals_api(bus_stop_code):
             'error': str(e)
         }), 500
 
+def average_rollups_by_hour(rows):
+    """Merge hourly rollup rows into {(hour_of_day, service): (count, eta_sum)}."""
+    merged = {}
+    for hour_start, svc, count, total, _ in rows:
+        hour = hour_start.hour if isinstance(hour_start, datetime) else int(str(hour_start)[11:13])
+        prev_count, prev_total = merged.get((hour, svc), (0, 0.0))
+        merged[(hour, svc)] = (prev_count + count, prev_total + total)
+    return merged
+
 @app.route("/bus/history/<stop_code>")
+@read_only
 def bus_history(stop_code):
-    conn = get_bus_db_connection()
-    c = conn.cursor()
-    c.execute("""
-        SELECT strftime('%H', timestamp) as hour, service, AVG(eta_min)
-        FROM bus_arrivals
-        WHERE stop_code = ? AND timestamp >= datetime('now', '-1 day')
-        GROUP BY hour, service
-        ORDER BY hour ASC
-    """, (stop_code,))
-    rows = c.fetchall()
-    conn.close()
+    rows = read_arrival_rollups(datetime.now() - timedelta(days=1), stop_code)
 
     data = {}
-    for hour, svc, eta in rows:
-        data.setdefault(svc, []).append({"x": int(hour), "y": round(eta, 2)})
+    for (hour, svc), (count, total) in sorted(average_rollups_by_hour(rows).items()):
+        data.setdefault(svc, []).append({"x": hour, "y": round(total / count, 2)})
     return render_template("bus_history.html", stop_code=stop_code, data=data)
 
 @app.route("/bus/history/all")
+@read_only
 def bus_history_all():
-    conn = get_bus_db_connection()  # NEW
-    c = conn.cursor()
-    c.execute("""
-        SELECT strftime('%H', timestamp) as hour, AVG(eta_min)
-        FROM bus_arrivals
-        WHERE timestamp >= datetime('now', '-1 day')
-        GROUP BY hour
-        ORDER BY hour ASC
-    """)
-    rows = c.fetchall()
-    conn.close()
-    data = [{"x": int(hour), "y": round(avg, 2)} for hour, avg in rows]
+    rows = read_arrival_rollups(datetime.now() - timedelta(days=1))
+    data = [{"x": hour, "y": round(total / count, 2)}
+            for (hour, _), (count, total) in sorted(average_rollups_by_hour(rows).items())]
     return render_template("bus_history_all.html", data=data)
 
+HISTORY_SERIES_DEFAULT_DAYS = 7
+HISTORY_SERIES_DEFAULT_POINTS = 500
+HISTORY_SERIES_MAX_POINTS = 5000
+
+def _series_time(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(str(value))
+
+def _local_naive(value):
+    """Stored timestamps are naive local time; convert an ISO input with an offset to match."""
+    return value.astimezone().replace(tzinfo=None) if value.tzinfo else value
+
+@app.route("/api/history/series")
+@read_only
+def history_series():
+    """
+    Raw ETA history of one stop and service, downsampled server-side for Chart.js.
+    ?stop=&service=&from=&to=&points=&mode=lttb|minmax; from/to are ISO dates or
+    datetimes (default: the last 7 days). Rows are streamed from the database, so
+    memory depends on `points`, not on the range.
+    """
+    stop, service = request.args.get("stop", "").strip(), request.args.get("service", "").strip()
+    mode = request.args.get("mode", "lttb")
+    points = request.args.get("points", HISTORY_SERIES_DEFAULT_POINTS, type=int)
+    if not stop or not service:
+        return jsonify({"error": "stop and service are required"}), 400
+    if mode not in ("lttb", "minmax"):
+        return jsonify({"error": "mode must be lttb or minmax"}), 400
+    if not 3 <= points <= HISTORY_SERIES_MAX_POINTS:
+        return jsonify({"error": f"points must be between 3 and {HISTORY_SERIES_MAX_POINTS}"}), 400
+    try:
+        until = _local_naive(datetime.fromisoformat(request.args["to"])) if request.args.get("to") else datetime.now()
+        since = (_local_naive(datetime.fromisoformat(request.args["from"])) if request.args.get("from")
+                 else until - timedelta(days=HISTORY_SERIES_DEFAULT_DAYS))
+    except ValueError:
+        return jsonify({"error": "from and to must be ISO dates or datetimes"}), 400
+    if len(request.args.get("to", "")) == 10:
+        until += timedelta(days=1) - timedelta(seconds=1)  # a date means the whole day
+    if since >= until:
+        return jsonify({"error": "from must be before to"}), 400
+
+    rows = iter_arrival_series(stop, service, since, until)
+    stream = ((_series_time(ts).timestamp(), eta) for ts, eta in rows)
+    kept, raw_count = downsample(stream, since.timestamp(), until.timestamp(), points, mode)
+    return jsonify({
+        "stop": stop,
+        "service": service,
+        "from": since.isoformat(),
+        "to": until.isoformat(),
+        "mode": mode,
+        "raw_count": raw_count,
+        "points": [{"x": datetime.fromtimestamp(t).isoformat(), "y": y} for t, y in kept],
+    })
+
+TRIPS_MAX = 500
+
+@app.route("/api/trips/<service_no>")
+@read_only
+def service_trips(service_no):
+    """
+    Reconstructed trips of one service on one day (see trips.py).
+    ?direction=1|2&date=YYYY-MM-DD (default yesterday, the latest closed day);
+    with &stop= also the arrivals at that stop and the headways between them.
+    """
+    direction = request.args.get("direction", 1, type=int)
+    service_date = request.args.get("date") or (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+    try:
+        datetime.strptime(service_date, "%Y-%m-%d")
+    except ValueError:
+        return jsonify({"error": "date must be YYYY-MM-DD"}), 400
+    trips = read_trips(service_no, direction, service_date, TRIPS_MAX)
+    result = {"service": service_no, "direction": direction, "date": service_date, "trips": trips}
+
+    stop = request.args.get("stop", "").strip()
+    if stop:
+        arrivals = sorted(s["arrival"] for trip in trips for s in trip["stops"] if s["stop"] == stop)
+        times = [datetime.fromisoformat(a) for a in arrivals]
+        result["stop"] = stop
+        result["arrivals"] = arrivals
+        result["headways_min"] = [round((b - a).total_seconds() / 60, 1) for a, b in zip(times, times[1:])]
+    return jsonify(result)
+
 @app.route("/bus")
 def bus_dashboard():
     return render_template("bus_main.html")
@@ -525,6 +723,7 @@ def get_user_locations():
         return jsonify([])
 
 @app.route("/api/nearby_bus_stops")
+@read_only
 def get_nearby_bus_stops():
     """Get bus stops near a given location"""
     
@@ -539,14 +738,7 @@ def get_nearby_bus_stops():
     print(f"[DEBUG] Searching for bus stops near ({latitude}, {longitude}) within {radius_km}km")
     
     try:
-        # Connect to SQLite bus database
-        bus_db_path = os.path.join(BASE_DIR, "database", "bus_data.db")
-        
-        if not os.path.exists(bus_db_path):
-            print(f"[ERROR] Bus database not found at {bus_db_path}")
-            return jsonify({"success": False, "error": "Bus database not found"}), 500
-        
-        bus_conn = sqlite3.connect(bus_db_path)
+        bus_conn = get_bus_db_connection()
         bus_cursor = bus_conn.cursor()
         
         # FIXED: Use correct table and column names
@@ -556,7 +748,7 @@ def get_nearby_bus_stops():
             WHERE lat IS NOT NULL AND lon IS NOT NULL
         """)
         
-        all_stops = bus_cursor.fetchall()
+        all_stops = [(r["code"], r["description"], r["lat"], r["lon"], r["road"]) for r in bus_cursor.fetchall()]
         bus_conn.close()
         
         print(f"[DEBUG] Total bus stops in database: {len(all_stops)}")
@@ -633,38 +825,10 @@ def get_bus_favorites():
     if not user:
         return jsonify([])
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        if IS_PRODUCTION:
-            cursor.execute("""
-                SELECT bus_stop_code, bus_stop_name
-                FROM bus_favorites
-                WHERE user_id = %s
-                ORDER BY created_at DESC
-            """, (user["id"],))
-        else:
-            cursor.execute("""
-                SELECT bus_stop_code, bus_stop_name
-                FROM bus_favorites
-                WHERE user_id = ?
-                ORDER BY created_at DESC
-            """, (user["id"],))
-        
-        favorites = []
-        for row in cursor.fetchall():
-            favorites.append({
-                "code": row["bus_stop_code"],
-                "desc": row["bus_stop_name"]
-            })
-        
-        cursor.close()
-        conn.close()
-        return jsonify(favorites)
+        return jsonify(cached_bus_favorites(user["id"]))
     except Exception as e:
         print(f"Error fetching bus favorites: {e}")
-        conn.close()
         return jsonify([])
 
 #Add to bus stops to favorites
@@ -683,10 +847,8 @@ def add_bus_favorite():
     if not code or not desc:
         return jsonify({"error": "Missing bus stop info"}), 400
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
+    def write(conn):
+        cursor = conn.cursor()
         if IS_PRODUCTION:
             cursor.execute("""
                 INSERT INTO bus_favorites (user_id, bus_stop_code, bus_stop_name)
@@ -698,14 +860,13 @@ def add_bus_favorite():
                 INSERT OR IGNORE INTO bus_favorites (user_id, bus_stop_code, bus_stop_name)
                 VALUES (?, ?, ?)
             """, (user["id"], code, desc))
-        
-        conn.commit()
         cursor.close()
-        conn.close()
+    
+    try:
+        write_bus_favorites(user["id"], write)
         return jsonify({"success": True, "message": "Added to favorites"})
     except Exception as e:
         print(f"Error adding bus favorite: {e}")
-        conn.close()
         return jsonify({"error": str(e)}), 500
 
 # Delete bus stop from favorites
@@ -723,10 +884,8 @@ def remove_bus_favorite():
     if not code:
         return jsonify({"error": "Missing bus stop code"}), 400
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
+    def write(conn):
+        cursor = conn.cursor()
         if IS_PRODUCTION:
             cursor.execute("""
                 DELETE FROM bus_favorites
@@ -737,14 +896,13 @@ def remove_bus_favorite():
                 DELETE FROM bus_favorites
                 WHERE user_id = ? AND bus_stop_code = ?
             """, (user["id"], code))
-        
-        conn.commit()
         cursor.close()
-        conn.close()
+    
+    try:
+        write_bus_favorites(user["id"], write)
         return jsonify({"success": True, "message": "Removed from favorites"})
     except Exception as e:
         print(f"Error removing bus favorite: {e}")
-        conn.close()
         return jsonify({"error": str(e)}), 500
 
 
@@ -754,6 +912,9 @@ traffic_last_update = ""
 # Traffic database - PostgreSQL in production, SQLite in development
 TRAFFIC_DB_FILE = os.path.join(BASE_DIR, "database/TrafficIncidents.db")
 traffic_engine = create_engine(f"sqlite:///{TRAFFIC_DB_FILE}", future=True)
+# Same WAL / pragma setup as the other SQLite files. The traffic thread is the
+# only writer of this file, so it keeps writing through the engine directly.
+event.listen(traffic_engine, "connect", lambda dbapi_conn, _record: apply_sqlite_pragmas(dbapi_conn))
 
 if IS_PRODUCTION:
     print("✅ Using SQLite for traffic data (Production - Local Cache)")
@@ -768,28 +929,182 @@ incidents_table = Table(
     Column("Latitude", Float),
     Column("Longitude", Float),
     Column("Message", String),
-    Column("FetchedAt", DateTime)
+    Column("FetchedAt", DateTime),
+    Column("RoadCategory", String),
+    Column("Area", String)
+)
+
+# Incident -> affected bus service/direction and stop range, filled in at ingest
+incident_services_table = Table(
+    "incident_services", traffic_metadata,
+    Column("IncidentId", String, index=True),
+    Column("ServiceNo", String, index=True),
+    Column("Direction", Integer),
+    Column("FromSeq", Integer),
+    Column("ToSeq", Integer),
+    Column("FromStop", String),
+    Column("ToStop", String)
+)
+
+# Incident counts per (grain, bucket, road category, type). Hourly rows are
+# compacted into daily rows, and daily rows into weekly rows, as they age.
+incident_rollups_table = Table(
+    "incident_rollups", traffic_metadata,
+    Column("Grain", String, nullable=False),
+    Column("BucketStart", DateTime, nullable=False),
+    Column("RoadCategory", String, nullable=False),
+    Column("Type", String, nullable=False),
+    Column("Count", Integer, nullable=False, default=0),
+    UniqueConstraint("Grain", "BucketStart", "RoadCategory", "Type"),
+    Index("idx_incident_rollups_road", "RoadCategory", "Grain", "BucketStart")
 )
 traffic_metadata.create_all(traffic_engine)
 
+# Older TrafficIncidents.db files were created before the classification columns
+with traffic_engine.begin() as conn:
+    existing_columns = {col["name"] for col in inspect(conn).get_columns("incidents")}
+    for column_name in ("RoadCategory", "Area"):
+        if column_name not in existing_columns:
+            conn.exec_driver_sql(f"ALTER TABLE incidents ADD COLUMN {column_name} VARCHAR")
+
+# ---- Incident classification (done once per message at ingest) ----
+EXPRESSWAYS = ("PIE", "CTE", "AYE", "ECP", "SLE", "TPE", "KPE", "MCE", "BKE")
+ROAD_SUFFIXES = ("Road", "Rd", "Avenue", "Ave", "Street", "St", "Boulevard", "Drive", "Dr",
+                 "Lane", "Expressway", "Exit", "Entrance")
+
+EXPRESSWAY_RE = re.compile(r"\b(" + "|".join(EXPRESSWAYS) + r")\b", re.IGNORECASE)
+ROAD_NAME_RE = re.compile(r"([A-Z][a-z]+(?:\s(?:" + "|".join(ROAD_SUFFIXES) + r")))", re.IGNORECASE)
+ROAD_FALLBACK_RE = re.compile(r"(?:on|at|along|near)\s+([A-Z][^,.\-]*)", re.IGNORECASE)
+AREA_RE = re.compile(r"(?:on|at|along|near|before|after)\s+([^,().-]+)", re.IGNORECASE)
+
+@lru_cache(maxsize=4096)
+def classify_incident(msg: str) -> tuple:
+    """Return (road category, area) for an incident message.
+
+    LTA re-sends the same messages every poll, so results are memoised.
+    """
+    if not msg:
+        return "", ""
+
+    exp_match = EXPRESSWAY_RE.search(msg)
+    if exp_match:
+        road = exp_match.group(1).upper()
+    else:
+        road_match = ROAD_NAME_RE.search(msg) or ROAD_FALLBACK_RE.search(msg)
+        road = road_match.group(1).strip().title() if road_match else ""
+
+    area_match = AREA_RE.search(msg)
+    area = area_match.group(1).strip() if area_match else ""
+    return road, area
+
 def extract_road(msg: str) -> str:
     """Extract clean, likely road name."""
     if pd.isna(msg) or not msg:
         return ""
-    exp_match = re.search(r"\b(PIE|CTE|AYE|ECP|SLE|TPE|KPE|MCE|BKE)\b", msg, flags=re.IGNORECASE)
-    if exp_match:
-        return exp_match.group(1).upper()
-    road_match = re.search(
-        r"([A-Z][a-z]+(?:\s(?:Road|Rd|Avenue|Ave|Street|St|Boulevard|Drive|Dr|Lane|Expressway|Exit|Entrance)))",
-        msg, flags=re.IGNORECASE)
-    if road_match:
-        return road_match.group(1).strip().title()
-    m = re.search(r"(?:on|at|along|near)\s+([A-Z][^,.\-]*)", msg, flags=re.IGNORECASE)
-    return m.group(1).strip().title() if m else ""
+    return classify_incident(msg)[0]
+
+# ---- Incident -> bus service spatial join ----
+route_segment_index = None
+route_segment_index_lock = threading.Lock()
+
+def get_route_segment_index():
+    """Segment index over bus routes, built on first use from the bus database."""
+    global route_segment_index
+    with route_segment_index_lock:
+        if route_segment_index is None:
+            conn = get_bus_db_connection()
+            try:
+                index = build_segment_index(conn)
+            finally:
+                conn.close()
+            if not len(index):
+                return index  # bus routes not loaded yet, try again next batch
+            route_segment_index = index
+            print(f"✅ Route segment index built: {len(index)} segments")
+        return route_segment_index
+
+def match_incidents_to_routes(records):
+    """incident_services rows for every bus route segment near each incident."""
+    index = get_route_segment_index()
+    matches = []
+    for record in records:
+        lat, lon = record.get("Latitude"), record.get("Longitude")
+        if lat is None or lon is None or pd.isna(lat) or pd.isna(lon):
+            continue
+        for m in index.match(float(lat), float(lon)):
+            matches.append({
+                "IncidentId": record["Id"],
+                "ServiceNo": m["service"],
+                "Direction": m["direction"],
+                "FromSeq": m["from_seq"],
+                "ToSeq": m["to_seq"],
+                "FromStop": m["from_stop"],
+                "ToStop": m["to_stop"]
+            })
+    return matches
+
+# ---- Incident rollups (trend history) ----
+ROLLUP_HOURLY_RETENTION_DAYS = 14
+ROLLUP_DAILY_RETENTION_DAYS = 180
+ROLLUP_COMPACTION_INTERVAL = timedelta(hours=1)
+last_rollup_compaction = None
+
+def rollup_bucket(ts: datetime, grain: str) -> datetime:
+    """Start of the hour/day/week (Monday) containing ts."""
+    hour = ts.replace(minute=0, second=0, microsecond=0)
+    if grain == "hour":
+        return hour
+    day = hour.replace(hour=0)
+    if grain == "day":
+        return day
+    return day - timedelta(days=day.weekday())
+
+def upsert_incident_rollups(conn, counts: dict, grain: str):
+    """Add {(bucket, road, type): n} to the rollup rows of the given grain."""
+    if not counts:
+        return
+    stmt = sqlite_insert(incident_rollups_table).values([
+        {"Grain": grain, "BucketStart": bucket, "RoadCategory": road, "Type": incident_type, "Count": n}
+        for (bucket, road, incident_type), n in counts.items()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["Grain", "BucketStart", "RoadCategory", "Type"],
+        set_={"Count": incident_rollups_table.c.Count + stmt.excluded.Count}
+    )
+    conn.execute(stmt)
+
+def record_new_incidents(conn, records, previous_ids, now: datetime):
+    """Count incidents that were not in the previous batch into this hour's rollup."""
+    bucket = rollup_bucket(now, "hour")
+    counts = Counter(
+        (bucket, r.get("RoadCategory") or "", r.get("Type") or "")
+        for r in records if r["Id"] not in previous_ids
+    )
+    upsert_incident_rollups(conn, counts, "hour")
+
+def compact_incident_rollups(now: datetime):
+    """Fold aged hourly rows into daily rows, and aged daily rows into weekly rows."""
+    t = incident_rollups_table
+    with traffic_engine.begin() as conn:
+        for grain, coarser, keep_days in (("hour", "day", ROLLUP_HOURLY_RETENTION_DAYS),
+                                          ("day", "week", ROLLUP_DAILY_RETENTION_DAYS)):
+            cutoff = rollup_bucket(now - timedelta(days=keep_days), coarser)
+            old = conn.execute(
+                select(t.c.BucketStart, t.c.RoadCategory, t.c.Type, t.c.Count)
+                .where(t.c.Grain == grain, t.c.BucketStart < cutoff)
+            ).all()
+            if not old:
+                continue
+            counts = Counter()
+            for bucket, road, incident_type, n in old:
+                counts[(rollup_bucket(bucket, coarser), road, incident_type)] += n
+            upsert_incident_rollups(conn, counts, coarser)
+            conn.execute(t.delete().where(t.c.Grain == grain, t.c.BucketStart < cutoff))
+            print(f"🗜️ Compacted {len(old)} {grain} incident rollups into {len(counts)} {coarser} rows")
 
 def fetch_and_store_traffic_loop(poll_seconds: int = 60):
     """Fetch latest traffic incidents every 60 seconds."""
-    global traffic_last_update
+    global traffic_last_update, last_rollup_compaction
     while True:
         try:
             now = datetime.now()
@@ -818,57 +1133,206 @@ def fetch_and_store_traffic_loop(poll_seconds: int = 60):
                 record_id = str(row["IncidentID"])
                 if record_id not in seen_ids:
                     seen_ids.add(record_id)
+                    message = row.get("Message")
+                    road, area = classify_incident(message) if isinstance(message, str) else ("", "")
                     unique_records.append({
                         "Id": record_id,
                         "Type": row.get("Type"),
                         "Latitude": row.get("Latitude"),
                         "Longitude": row.get("Longitude"),
-                        "Message": row.get("Message"),
-                        "FetchedAt": now
+                        "Message": message,
+                        "FetchedAt": now,
+                        "RoadCategory": road,
+                        "Area": area
                     })
 
+            try:
+                service_matches = match_incidents_to_routes(unique_records)
+            except Exception as e:
+                print("⚠️ Incident/bus route matching failed:", e)
+                service_matches = []
+
             with traffic_engine.begin() as conn:
+                previous_ids = set(conn.execute(select(incidents_table.c.Id)).scalars())
+                record_new_incidents(conn, unique_records, previous_ids, now)
                 conn.execute(incidents_table.delete())
+                conn.execute(incident_services_table.delete())
                 if unique_records:
                     conn.execute(incidents_table.insert(), unique_records)
+                if service_matches:
+                    conn.execute(incident_services_table.insert(), service_matches)
 
+            set_traffic_snapshot(unique_records, now, service_matches)
             traffic_last_update = now.strftime("%d %b %Y, %I:%M %p")
             print(f"✅ Updated {len(unique_records)} active traffic incidents at {traffic_last_update}")
 
+            if last_rollup_compaction is None or now - last_rollup_compaction >= ROLLUP_COMPACTION_INTERVAL:
+                compact_incident_rollups(now)
+                last_rollup_compaction = now
+
         except Exception as e:
             print("❌ Traffic fetch error:", e)
 
         time.sleep(poll_seconds)
 
-def build_traffic_map_from_df(df: pd.DataFrame) -> str:
-    """Generate a folium map with all traffic incidents."""
-    sg_bounds = [[1.1304753, 103.6920359], [1.4504753, 104.0120359]]
-    sg_map = folium.Map(location=[1.3521, 103.8198], zoom_start=12, control_scale=True)
-
-    if not df.empty:
-        for _, row in df.iterrows():
-            lat, lon = row.get("Latitude"), row.get("Longitude")
-            if pd.notna(lat) and pd.notna(lon):
-                msg = row.get("Message") or "No description"
-                type_info = row.get("Type") or "Incident"
-                match = re.search(r"\((\d{1,2}/\d{1,2})\)(\d{2}:\d{2})", msg)
-                reported_time = f"({match.group(1)}) {match.group(2)}" if match else None
-                clean_msg = re.sub(r"\(\d{1,2}/\d{1,2}\)\d{2}:\d{2}", "", msg).strip()
-
-                popup_html = f"""
-                <div style='font-size:14px; width:260px; line-height:1.4;'>
-                    <b>{type_info}</b><br>{clean_msg}
-                    {f"<br>🕒 Reported at: {reported_time}" if reported_time else ""}
-                </div>
-                """
-                folium.Marker(
-                    [lat, lon],
-                    popup=folium.Popup(popup_html, max_width=300, min_width=250),
-                    icon=folium.Icon(color="red", icon="info-sign"),
-                ).add_to(sg_map)
-
-    sg_map.fit_bounds(sg_bounds)
-    return sg_map._repr_html_()
+# ---- Incident snapshot (served to the dashboard and the GeoJSON API) ----
+# The incidents table is replaced wholesale on every poll, so we keep one
+# pre-processed copy of it in memory and rebuild it only when the batch
+# changes. Workers without a traffic loop re-check the table's FetchedAt
+# every few seconds to pick up batches written by another process.
+TRAFFIC_SNAPSHOT_RECHECK_SECONDS = 5
+GEOJSON_CACHE_MAX_ENTRIES = 128
+
+REPORTED_TIME_RE = re.compile(r"\((\d{1,2}/\d{1,2})\)(\d{2}:\d{2})")
+
+traffic_snapshot = {"version": None, "fetched_at": None, "records": [], "type_summary": {},
+                    "affected_services": {}, "pie_chart": None, "checked_at": 0.0}
+traffic_geojson_cache = {}
+traffic_snapshot_lock = threading.Lock()
+
+def build_incident_record(row) -> dict:
+    """Turn an incidents row into the compact record the dashboard works with."""
+    msg = row.get("Message") or ""
+    lat, lon = row.get("Latitude"), row.get("Longitude")
+    match = REPORTED_TIME_RE.search(msg)
+    return {
+        "id": str(row.get("Id")),
+        "type": row.get("Type") or "",
+        "road": row.get("RoadCategory") if row.get("RoadCategory") is not None else extract_road(msg),
+        "area": row.get("Area") if row.get("Area") is not None else classify_incident(msg)[1],
+        "msg": REPORTED_TIME_RE.sub("", msg).strip(),
+        "time": f"({match.group(1)}) {match.group(2)}" if match else None,
+        "lat": float(lat) if lat is not None and pd.notna(lat) else None,
+        "lon": float(lon) if lon is not None and pd.notna(lon) else None,
+    }
+
+def summarise_incident_types(records) -> dict:
+    """Per-type incident count and sorted list of areas involved."""
+    summary = {}
+    for r in records:
+        if not r["type"]:
+            continue
+        entry = summary.setdefault(r["type"], {"count": 0, "areas": set()})
+        entry["count"] += 1
+        if r["area"]:
+            entry["areas"].add(r["area"])
+    return {t: {"count": e["count"], "areas": sorted(e["areas"])} for t, e in sorted(summary.items())}
+
+def index_affected_services(records, service_matches) -> dict:
+    """Map service number -> incidents on its route, for request-time lookups."""
+    by_id = {r["id"]: r for r in records}
+    affected = {}
+    for m in service_matches:
+        record = by_id.get(str(m["IncidentId"]))
+        if record is None:
+            continue
+        affected.setdefault(m["ServiceNo"], []).append({
+            "id": record["id"],
+            "type": record["type"],
+            "road": record["road"],
+            "msg": record["msg"],
+            "lat": record["lat"],
+            "lon": record["lon"],
+            "direction": m["Direction"],
+            "from_stop": m["FromStop"],
+            "to_stop": m["ToStop"],
+            "from_seq": m["FromSeq"],
+            "to_seq": m["ToSeq"],
+        })
+    return affected
+
+def set_traffic_snapshot(rows, fetched_at, service_matches=()):
+    """Replace the in-memory snapshot with a freshly stored batch of incidents."""
+    records = [build_incident_record(row) for row in rows]
+    type_summary = summarise_incident_types(records)
+    affected_services = index_affected_services(records, service_matches)
+    with traffic_snapshot_lock:
+        traffic_snapshot.update({
+            "version": str(fetched_at) if fetched_at else None,
+            "fetched_at": fetched_at,
+            "records": records,
+            "type_summary": type_summary,
+            "affected_services": affected_services,
+            "pie_chart": None,
+            "checked_at": time.monotonic(),
+        })
+        traffic_geojson_cache.clear()
+
+def get_traffic_snapshot() -> dict:
+    """Return the current incident snapshot, reloading it if the table changed."""
+    with traffic_snapshot_lock:
+        if time.monotonic() - traffic_snapshot["checked_at"] < TRAFFIC_SNAPSHOT_RECHECK_SECONDS:
+            return traffic_snapshot
+
+    with traffic_engine.connect() as conn:
+        fetched_at = conn.execute(select(func.max(incidents_table.c.FetchedAt))).scalar()
+        if (str(fetched_at) if fetched_at else None) != traffic_snapshot["version"]:
+            rows = [dict(r._mapping) for r in conn.execute(select(incidents_table))]
+            matches = [dict(r._mapping) for r in conn.execute(select(incident_services_table))]
+            set_traffic_snapshot(rows, fetched_at, matches)
+
+    with traffic_snapshot_lock:
+        traffic_snapshot["checked_at"] = time.monotonic()
+        return traffic_snapshot
+
+def filter_incidents(records, search="", incident_type="", road=""):
+    """Apply the dashboard's search / type / road filters to snapshot records."""
+    search = search.lower()
+    return [
+        r for r in records
+        if (not incident_type or r["type"] == incident_type)
+        and (not road or r["road"] == road)
+        and (not search or search in r["msg"].lower() or search in r["road"].lower())
+    ]
+
+def incidents_to_geojson(records, version) -> str:
+    """Serialise incident records as a compact GeoJSON FeatureCollection."""
+    features = [
+        {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [round(r["lon"], 5), round(r["lat"], 5)]},
+            "properties": {"id": r["id"], "type": r["type"], "road": r["road"],
+                           "msg": r["msg"], "time": r["time"]},
+        }
+        for r in records if r["lat"] is not None and r["lon"] is not None
+    ]
+    return json.dumps({"type": "FeatureCollection", "version": version, "features": features},
+                      separators=(",", ":"), ensure_ascii=False)
+
+def format_traffic_update(snapshot) -> str:
+    fetched_at = snapshot["fetched_at"]
+    if not fetched_at:
+        return "No data available yet"
+    return fetched_at.strftime("%d %b %Y, %I:%M %p")
+
+@app.route("/api/incidents.geojson")
+def incidents_geojson():
+    """Current incidents as GeoJSON, filterable by ?type=, ?road= and ?q=.
+
+    The body for each (version, filters) combination is built once and served
+    with a strong ETag, so a polling client gets a 304 until the next batch.
+    """
+    incident_type = request.args.get("type", "").strip()
+    road = request.args.get("road", "").strip()
+    search = request.args.get("q", "").strip()
+
+    snapshot = get_traffic_snapshot()
+    key = (snapshot["version"], incident_type, road, search.lower())
+    cached = traffic_geojson_cache.get(key)
+    if cached is None:
+        records = filter_incidents(snapshot["records"], search, incident_type, road)
+        body = incidents_to_geojson(records, snapshot["version"])
+        cached = (body, hashlib.sha1(body.encode("utf-8")).hexdigest())
+        with traffic_snapshot_lock:
+            if len(traffic_geojson_cache) >= GEOJSON_CACHE_MAX_ENTRIES:
+                traffic_geojson_cache.clear()
+            traffic_geojson_cache[key] = cached
+
+    body, etag = cached
+    response = app.response_class(body, mimetype="application/geo+json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
 
 @app.route("/traffic", methods=["GET", "POST"])
 @app.route("/", methods=["GET", "POST"])
@@ -878,128 +1342,168 @@ def traffic_dashboard():
     selected_road = request.form.get("road", "").strip() if request.method == "POST" else ""
     clear_filter = request.form.get("clear") if request.method == "POST" else None
 
-    with traffic_engine.connect() as conn:
-        df = pd.read_sql("SELECT * FROM incidents", conn)
-
-    # Handle empty dataframe
-    if df.empty:
-        # No traffic data - show empty map
-        sg_map = folium.Map(location=[1.3521, 103.8198], zoom_start=12)
-        empty_html = sg_map._repr_html_()
-        
-        return render_template(
-            "traffic_main.html",
-            filtered_html=empty_html,
-            last_update="No data available yet",
-            total_incidents=0,
-            most_road="N/A",
-            most_type="N/A",
-            type_options=[],
-            road_options=[],
-            search_query="",
-            type_query="",
-            road_query="",
-            type_counts={},
-            no_results=True
-        )
-
-    # Process data only if not empty
-    df["RoadCategory"] = df["Message"].apply(extract_road)
-
-    # Safely get options
-    road_options = sorted([r for r in df["RoadCategory"].dropna().unique() if r]) if "RoadCategory" in df.columns else []
-    type_options = sorted([t for t in df["Type"].dropna().unique() if t]) if "Type" in df.columns else []
-
     if clear_filter:
         search_query = selected_type = selected_road = ""
 
-    filtered = df.copy()
-    if search_query:
-        mask = filtered["Message"].str.contains(search_query, case=False, na=False) | \
-               filtered["RoadCategory"].str.contains(search_query, case=False, na=False)
-        filtered = filtered[mask]
-    if selected_type:
-        filtered = filtered[filtered["Type"] == selected_type]
-    if selected_road:
-        filtered = filtered[filtered["RoadCategory"] == selected_road]
+    snapshot = get_traffic_snapshot()
+    records = snapshot["records"]
 
-    total_incidents = len(filtered)
-    most_road = filtered["RoadCategory"].value_counts().idxmax() if not filtered.empty and not filtered["RoadCategory"].dropna().empty else "N/A"
-    most_type = filtered["Type"].value_counts().idxmax() if not filtered.empty and not filtered["Type"].dropna().empty else "N/A"
-    type_counts = filtered["Type"].value_counts().to_dict() if not filtered.empty else {}
-    no_results = filtered.empty
+    road_options = sorted({r["road"] for r in records if r["road"]})
+    type_options = sorted({r["type"] for r in records if r["type"]})
 
-    filtered_html = build_traffic_map_from_df(filtered)
+    filtered = filter_incidents(records, search_query, selected_type, selected_road)
+    road_counts = Counter(r["road"] for r in filtered if r["road"])
+    type_counts = Counter(r["type"] for r in filtered if r["type"])
 
     return render_template(
         "traffic_main.html",
-        filtered_html=filtered_html,
-        last_update=traffic_last_update,
-        total_incidents=total_incidents,
-        most_road=most_road,
-        most_type=most_type,
+        last_update=format_traffic_update(snapshot),
+        total_incidents=len(filtered),
+        most_road=road_counts.most_common(1)[0][0] if road_counts else "N/A",
+        most_type=type_counts.most_common(1)[0][0] if type_counts else "N/A",
         type_options=type_options,
         road_options=road_options,
         search_query=search_query,
         type_query=selected_type,
         road_query=selected_road,
-        type_counts=type_counts,
-        no_results=no_results
+        type_counts=dict(type_counts.most_common()),
+        no_results=not filtered
     )
 
-@app.route("/traffic_pie_chart")
-def traffic_pie_chart():
-    """Interactive pie chart showing traffic incidents by type."""
-    import plotly.express as px
-    import plotly.io as pio
-
-    with traffic_engine.connect() as conn:
-        df = pd.read_sql("SELECT * FROM incidents", conn)
-
-    if df.empty:
-        return "<h3>No data available for pie chart yet.</h3>"
-
-    def extract_area(msg):
-        if not msg:
-            return ""
-        m = re.search(r"(?:on|at|along|near|before|after)\s+([^,().-]+)", msg, flags=re.IGNORECASE)
-        return m.group(1).strip() if m else ""
-
-    df["Area"] = df["Message"].apply(extract_area).fillna("Unknown")
-
-    type_groups = df.groupby("Type")
-    type_list, count_list, hover_texts = [], [], []
-
-    for incident_type, group in type_groups:
-        count = len(group)
-        areas = sorted(set(group["Area"].dropna()) - {""})
-        area_lines = "<br>".join(f"• {a}" for a in areas[:10])
-        hover_text = (
+# Same palette as plotly.express.colors.qualitative.Safe
+PIE_CHART_COLORS = [
+    "rgb(136, 204, 238)", "rgb(204, 102, 119)", "rgb(221, 204, 119)", "rgb(17, 119, 51)",
+    "rgb(51, 34, 136)", "rgb(170, 68, 153)", "rgb(68, 170, 153)", "rgb(153, 153, 51)",
+    "rgb(136, 34, 85)", "rgb(102, 17, 0)", "rgb(136, 136, 136)",
+]
+
+def build_pie_chart_figure(type_summary) -> dict:
+    """Plotly figure spec for the incidents-by-type pie, rendered by plotly.js."""
+    labels, values, hover_texts = [], [], []
+    for incident_type, entry in type_summary.items():
+        area_lines = "<br>".join(f"• {a}" for a in entry["areas"][:10])
+        hover_texts.append(
             f"<b>{incident_type}</b><br>"
-            f"Incidents: {count}<br>"
+            f"Incidents: {entry['count']}<br>"
             f"<b>Areas involved:</b><br>{area_lines}"
         )
-        type_list.append(incident_type)
-        count_list.append(count)
-        hover_texts.append(hover_text)
-
-    fig = px.pie(
-        names=type_list,
-        values=count_list,
-        title="Traffic Incidents by Type (Hover for Details)",
-        color_discrete_sequence=px.colors.qualitative.Safe
-    )
-    fig.update_traces(
-        hoverinfo="text",
-        hovertemplate="%{customdata}",
-        textinfo="percent",
-        customdata=hover_texts
+        labels.append(incident_type)
+        values.append(entry["count"])
+
+    return {
+        "data": [{
+            "type": "pie",
+            "labels": labels,
+            "values": values,
+            "customdata": hover_texts,
+            "hoverinfo": "text",
+            "hovertemplate": "%{customdata}<extra></extra>",
+            "textinfo": "percent",
+        }],
+        "layout": {
+            "title": {"text": "Traffic Incidents by Type (Hover for Details)"},
+            "piecolorway": PIE_CHART_COLORS,
+            "width": 800,
+            "height": 450,
+            "showlegend": True,
+        },
+    }
+
+@app.route("/api/traffic_pie_chart.json")
+def traffic_pie_chart_data():
+    """Cached figure spec for /traffic_pie_chart, keyed by the traffic data version."""
+    snapshot = get_traffic_snapshot()
+    with traffic_snapshot_lock:
+        cached = snapshot["pie_chart"]
+        if cached is None:
+            body = json.dumps(build_pie_chart_figure(snapshot["type_summary"]),
+                              separators=(",", ":"), ensure_ascii=False)
+            cached = (body, hashlib.sha1(body.encode("utf-8")).hexdigest())
+            snapshot["pie_chart"] = cached
+
+    body, etag = cached
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+@app.route("/api/traffic/trends")
+def traffic_trends():
+    """Incident counts over time from the rollup store.
+
+    ?road=PIE&type=Accident&days=7&bucket=hour|hour_of_day|day
+    Road and type are optional (all roads / all types when omitted). Only
+    pre-aggregated rows inside the window are read, so the cost does not
+    grow with how much history is retained. Hourly rows are only kept for
+    ROLLUP_HOURLY_RETENTION_DAYS, so hour buckets clamp `days` to that (the
+    response says so); day buckets leave out weekly rows that start before
+    the window rather than counting them in full.
+    """
+    road = request.args.get("road", "").strip()
+    incident_type = request.args.get("type", "").strip()
+    bucket = request.args.get("bucket", "hour")
+    try:
+        days = min(max(int(request.args.get("days", 7)), 1), 3660)
+    except ValueError:
+        return jsonify({"error": "days must be an integer"}), 400
+    if bucket not in ("hour", "hour_of_day", "day"):
+        return jsonify({"error": "bucket must be one of hour, hour_of_day, day"}), 400
+    requested_days = days
+    if bucket in ("hour", "hour_of_day"):
+        days = min(days, ROLLUP_HOURLY_RETENTION_DAYS)
+
+    since = rollup_bucket(datetime.now() - timedelta(days=days), "hour")
+    t = incident_rollups_table
+    grains = ["hour"] if bucket in ("hour", "hour_of_day") else ["hour", "day", "week"]
+    query = (
+        select(t.c.Grain, t.c.BucketStart, func.sum(t.c.Count))
+        .where(t.c.Grain.in_(grains), t.c.BucketStart >= rollup_bucket(since, "day"))
+        .group_by(t.c.Grain, t.c.BucketStart)
+        .order_by(t.c.BucketStart)
     )
-    fig.update_layout(width=800, height=450, showlegend=True)
+    if road:
+        query = query.where(t.c.RoadCategory == road)
+    if incident_type:
+        query = query.where(t.c.Type == incident_type)
 
-    chart_html = pio.to_html(fig, full_html=False)
+    with traffic_engine.connect() as conn:
+        rows = conn.execute(query).all()
+
+    if bucket == "hour":
+        series = [{"t": b.isoformat(), "count": n} for grain, b, n in rows if b >= since]
+    elif bucket == "hour_of_day":
+        by_hour = [0] * 24
+        for grain, b, n in rows:
+            if b >= since:
+                by_hour[b.hour] += n
+        series = [{"hour": h, "count": n} for h, n in enumerate(by_hour)]
+    else:
+        # Weekly rows are reported at their week start; one that starts before the
+        # window would bring in incidents from outside it, so it is left out
+        by_day = Counter()
+        for grain, b, n in rows:
+            by_day[rollup_bucket(b, "day")] += n
+        series = [{"t": d.date().isoformat(), "count": by_day[d]} for d in sorted(by_day)]
+
+    return jsonify({
+        "road": road or None,
+        "type": incident_type or None,
+        "since": since.isoformat(),
+        "days": days,
+        "days_clamped": days != requested_days,
+        "bucket": bucket,
+        "series": series
+    })
+
+@app.route("/traffic_pie_chart")
+def traffic_pie_chart():
+    """Interactive pie chart showing traffic incidents by type."""
+    snapshot = get_traffic_snapshot()
+    if not snapshot["type_summary"]:
+        return "<h3>No data available for pie chart yet.</h3>"
 
-    return render_template("traffic_pie_chart.html", chart_html=chart_html, last_update=traffic_last_update)
+    return render_template("traffic_pie_chart.html", has_data=True,
+                           last_update=format_traffic_update(snapshot))
 
     # ==================== BUS ROUTES MODULE ====================
 
@@ -1177,13 +1681,20 @@ def get_bus_route(service_no, bus_stop_code):
         if not route_data:
             return jsonify({"error": "No valid route data found"}), 404
         
+        # Traffic incidents on this service/direction (matched at ingest)
+        incidents = [
+            i for i in get_traffic_snapshot()["affected_services"].get(service_no, [])
+            if i["direction"] == current_direction
+        ]
+
         # Return data to frontend for map rendering (SAME FORMAT)
         return jsonify({
             "service_no": service_no,
             "direction": current_direction,
             "current_stop": bus_stop_code,
             "full_route": route_data,
-            "stops_remaining": len(remaining_routes)
+            "stops_remaining": len(remaining_routes),
+            "incidents": incidents
         })
         
     except Exception as e:
@@ -0,0 +1,125 @@
+"""
+arrivals_fallback.py
+--------------------
+Keeps the arrivals endpoints answering when DataMall does not.
+
+  * datamall_circuit: after CIRCUIT_FAILURES consecutive BusArrival timeouts
+    or 5xx responses the circuit opens and requests skip DataMall for
+    CIRCUIT_COOLDOWN_SECONDS; then one trial call decides whether it closes.
+  * typical_arrivals(): estimates from bus_typical_waits, the mean next-bus
+    wait and headway per (stop, service, weekday, hour) that insert_arrivals
+    maintains. A stop's rows are loaded once into memory and kept for
+    TYPICAL_WAIT_TTL seconds.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from database import read_typical_waits
+
+LIVE_ARRIVALS_TIMEOUT = float(os.getenv("LIVE_ARRIVALS_TIMEOUT", 4))
+CIRCUIT_FAILURES = int(os.getenv("DATAMALL_CIRCUIT_FAILURES", 3))
+CIRCUIT_COOLDOWN_SECONDS = float(os.getenv("DATAMALL_CIRCUIT_COOLDOWN", 30))
+TYPICAL_WAIT_TTL = 3600
+TYPICAL_WAIT_CACHE_STOPS = 2048
+TYPICAL_MIN_POLLS = 3     # polls behind an hour-of-week estimate before it is shown
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker: closed -> open -> half-open (one trial) -> closed."""
+
+    def __init__(self, failures, cooldown):
+        self.failures_to_open = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self):
+        """True if a live call may be made now (a single trial once the cooldown is over)."""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.cooldown or self.trial_running:
+                return False
+            self.trial_running = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures, self.opened_at, self.trial_running = 0, None, False
+
+    def release_trial(self):
+        """A call that says nothing about DataMall's health: let the next call be the trial."""
+        with self.lock:
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            # A failed trial re-opens; calls already in flight when it opened do not extend it
+            if self.trial_running or (self.opened_at is None and self.failures >= self.failures_to_open):
+                print(f"⚠️ DataMall circuit open for {self.cooldown:.0f}s after {self.failures} failures")
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+datamall_circuit = CircuitBreaker(CIRCUIT_FAILURES, CIRCUIT_COOLDOWN_SECONDS)
+
+# stop_code -> (loaded_at, {service: {(weekday, hour): (polls, wait_sum, headway_count, headway_sum)}})
+_stops = OrderedDict()
+_stops_lock = threading.Lock()
+
+
+def _stop_waits(stop_code):
+    with _stops_lock:
+        entry = _stops.get(stop_code)
+        if entry and time.monotonic() - entry[0] < TYPICAL_WAIT_TTL:
+            _stops.move_to_end(stop_code)
+            return entry[1]
+    services = {}
+    for service, weekday, hour, *stats in read_typical_waits(stop_code):
+        services.setdefault(service, {})[(int(weekday), int(hour))] = stats
+    with _stops_lock:
+        _stops[stop_code] = (time.monotonic(), services)
+        _stops.move_to_end(stop_code)
+        while len(_stops) > TYPICAL_WAIT_CACHE_STOPS:
+            _stops.popitem(last=False)
+    return services
+
+
+def typical_arrivals(stop_code, now):
+    """[{service, wait, headway, polls, basis}] for `now`, best-served first.
+
+    Uses the same weekday and hour; when that has fewer than TYPICAL_MIN_POLLS
+    polls, the same hour over all weekdays.
+    """
+    weekday, hour = now.isoweekday() % 7 + 1, now.hour
+    estimates = []
+    for service, hours in _stop_waits(stop_code).items():
+        stats, basis = hours.get((weekday, hour)), "weekday_hour"
+        if not stats or stats[0] < TYPICAL_MIN_POLLS:
+            same_hour = [s for (_, h), s in hours.items() if h == hour]
+            stats, basis = [sum(column) for column in zip(*same_hour)] if same_hour else None, "hour"
+        if not stats or stats[0] < TYPICAL_MIN_POLLS:
+            continue
+        polls, wait_sum, headway_count, headway_sum = stats
+        estimates.append({
+            "service": service,
+            "wait": round(wait_sum / polls, 1),
+            "headway": round(headway_sum / headway_count, 1) if headway_count else None,
+            "polls": int(polls),
+            "basis": basis,
+        })
+    estimates.sort(key=lambda e: e["wait"])
+    return estimates
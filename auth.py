@@ -1,13 +1,15 @@
 # auth.py - FIXED for bcrypt issues
 import os
+import threading
+import time
 from datetime import datetime
 from functools import wraps
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, g
 import bcrypt  # Use bcrypt directly instead of passlib
 import traceback
 
 # Import from database.py
-from database import get_db_connection, IS_PRODUCTION
+from database import get_db_connection, submit_write, IS_PRODUCTION
 
 auth_bp = Blueprint("auth", __name__, template_folder="templates", static_folder="static")
 
@@ -25,12 +27,161 @@ def verify_password(password, hashed):
     return bcrypt.checkpw(password_bytes, hashed.encode('utf-8'))
 
 # ---- helpers ----
+# Short-lived per-worker cache of user rows, keyed by user id. Other workers
+# may serve a profile change for up to USER_CACHE_TTL seconds.
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 30))
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+
+
+def invalidate_user(uid):
+    """Drop a user's cached row (this worker and the current request)."""
+    with _user_cache_lock:
+        _user_cache.pop(uid, None)
+    g.pop("current_user", None)
+
+
+# Per-user saved locations and bus favourites, cached per worker. Every write
+# to either collection bumps users.collections_version in the same
+# transaction; each request reads the current version once (a primary-key
+# lookup) and a cached copy is only used while its version still matches,
+# so a write through any worker is seen by all of them on their next request.
+USER_COLLECTION_CACHE_TTL = float(os.getenv("USER_COLLECTION_CACHE_TTL", 300))
+_collection_cache = {}
+
+
+def _collections_version(uid):
+    """The user's collections_version, read once per request."""
+    memo = g.get("collections_version")
+    if memo is not None and memo[0] == uid:
+        return memo[1]
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    param = "%s" if IS_PRODUCTION else "?"
+    cursor.execute(f"SELECT collections_version FROM users WHERE id = {param}", (uid,))
+    row = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    version = row["collections_version"] if row else 0
+    g.collections_version = (uid, version)
+    return version
+
+
+def _cached_collection(kind, uid, load):
+    key = (kind, uid)
+    # Read the version before loading: a result cached under it is at least that new
+    version = _collections_version(uid)
+    with _user_cache_lock:
+        expires_at, cached_version, value = _collection_cache.get(key, (0, None, None))
+    if value is not None and cached_version == version and expires_at > time.monotonic():
+        return value
+    value = load(uid)
+    with _user_cache_lock:
+        _collection_cache[key] = (time.monotonic() + USER_COLLECTION_CACHE_TTL, version, value)
+    return value
+
+
+def _write_collection(kind, uid, write):
+    """Run write(conn) and bump the user's collections_version in one write transaction."""
+    def job(conn):
+        write(conn)
+        cursor = conn.cursor()
+        param = "%s" if IS_PRODUCTION else "?"
+        cursor.execute(
+            f"UPDATE users SET collections_version = collections_version + 1 WHERE id = {param}", (uid,))
+        cursor.close()
+
+    submit_write("users", job)
+    with _user_cache_lock:
+        _collection_cache.pop((kind, uid), None)
+    g.pop("collections_version", None)
+
+
+def write_user_locations(uid, write):
+    _write_collection("locations", uid, write)
+
+
+def write_bus_favorites(uid, write):
+    _write_collection("bus_favorites", uid, write)
+
+
+def _load_user_locations(uid):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    param = "%s" if IS_PRODUCTION else "?"
+    cursor.execute(f"""
+        SELECT id, label, latitude, longitude, address, postal_code, is_favourite, is_primary
+        FROM locations
+        WHERE user_id = {param}
+        ORDER BY id ASC
+    """, (uid,))
+    locations = [{
+        "id": row["id"],
+        "label": row["label"],
+        "latitude": float(row["latitude"]) if row["latitude"] is not None else None,
+        "longitude": float(row["longitude"]) if row["longitude"] is not None else None,
+        "address": row["address"],
+        "postal_code": row["postal_code"],
+        "is_favourite": bool(row["is_favourite"]),
+        "is_primary": bool(row["is_primary"]),
+    } for row in cursor.fetchall()]
+    cursor.close()
+    conn.close()
+
+    # Lower-cased label -> first location with that label, for chatbot lookups
+    by_label = {}
+    for loc in locations:
+        by_label.setdefault((loc["label"] or "").lower(), loc)
+    return {"list": locations, "by_label": by_label}
+
+
+def _load_bus_favorites(uid):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    param = "%s" if IS_PRODUCTION else "?"
+    cursor.execute(f"""
+        SELECT bus_stop_code, bus_stop_name
+        FROM bus_favorites
+        WHERE user_id = {param}
+        ORDER BY created_at DESC
+    """, (uid,))
+    favorites = [{"code": row["bus_stop_code"], "desc": row["bus_stop_name"]} for row in cursor.fetchall()]
+    cursor.close()
+    conn.close()
+    return favorites
+
+
+def cached_user_locations(uid):
+    """All saved locations of a user, oldest first (cached)."""
+    return _cached_collection("locations", uid, _load_user_locations)["list"]
+
+
+def find_user_location(uid, label):
+    """A user's saved location by case-insensitive label, or None (cached)."""
+    return _cached_collection("locations", uid, _load_user_locations)["by_label"].get((label or "").lower())
+
+
+def cached_bus_favorites(uid):
+    """A user's favourite bus stops, newest first (cached)."""
+    return _cached_collection("bus_favorites", uid, _load_bus_favorites)
+
+
 def current_user():
-    """Get current logged-in user"""
+    """Get current logged-in user (memoized per request, cached briefly per worker)"""
     uid = session.get("user_id")
     if not uid:
         return None
     
+    cached = g.get("current_user")
+    if cached is not None and cached[0] == uid:
+        return cached[1]
+    
+    with _user_cache_lock:
+        expires_at, user = _user_cache.get(uid, (0, None))
+    if user is not None and expires_at > time.monotonic():
+        g.current_user = (uid, user)
+        return user
+    
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
@@ -43,6 +194,11 @@ def current_user():
         user = cursor.fetchone()
         cursor.close()
         conn.close()
+        
+        if user is not None:
+            with _user_cache_lock:
+                _user_cache[uid] = (time.monotonic() + USER_CACHE_TTL, user)
+            g.current_user = (uid, user)
         return user
     except Exception as e:
         print(f"❌ Error fetching current user: {e}")
@@ -175,33 +331,36 @@ def register():
             )
         
         exists = cursor.fetchone()
+        cursor.close()
+        conn.close()
         
         if exists:
             flash("Username or email already exists.", "error")
-            cursor.close()
-            conn.close()
             return render_template("register.html"), 400
         
         # Hash password
         password_hash = hash_password(password)
         
         # Insert new user
-        if IS_PRODUCTION:
-            cursor.execute(
-                """INSERT INTO users (username, email, phone, password_hash, date_of_birth, created_at)
-                   VALUES (%s, %s, %s, %s, %s, %s)""",
-                (username, email, phone or None, password_hash, dob or None, datetime.utcnow())
-            )
-        else:
-            cursor.execute(
-                """INSERT INTO users (username, email, phone, password_hash, date_of_birth, created_at)
-                   VALUES (?, ?, ?, ?, ?, ?)""",
-                (username, email, phone or None, password_hash, dob or None, datetime.utcnow().isoformat())
-            )
+        def write(conn):
+            cursor = conn.cursor()
+            
+            if IS_PRODUCTION:
+                cursor.execute(
+                    """INSERT INTO users (username, email, phone, password_hash, date_of_birth, created_at)
+                       VALUES (%s, %s, %s, %s, %s, %s)""",
+                    (username, email, phone or None, password_hash, dob or None, datetime.utcnow())
+                )
+            else:
+                cursor.execute(
+                    """INSERT INTO users (username, email, phone, password_hash, date_of_birth, created_at)
+                       VALUES (?, ?, ?, ?, ?, ?)""",
+                    (username, email, phone or None, password_hash, dob or None, datetime.utcnow().isoformat())
+                )
+            
+            cursor.close()
         
-        conn.commit()
-        cursor.close()
-        conn.close()
+        submit_write("users", write)
         
         flash("Registration successful! Please login.", "success")
         return redirect(url_for("auth.login"))
@@ -279,35 +438,36 @@ def update_profile():
         phone = request.form.get("phone", "").strip()
         new_pw = request.form.get("new_password", "")
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        if IS_PRODUCTION:
-            if new_pw:
-                cursor.execute(
-                    "UPDATE users SET email=%s, phone=%s, password_hash=%s WHERE id=%s",
-                    (email, phone, hash_password(new_pw), user["id"])
-                )
-            else:
-                cursor.execute(
-                    "UPDATE users SET email=%s, phone=%s WHERE id=%s",
-                    (email, phone, user["id"])
-                )
-        else:
-            if new_pw:
-                cursor.execute(
-                    "UPDATE users SET email=?, phone=?, password_hash=? WHERE id=?",
-                    (email, phone, hash_password(new_pw), user["id"])
-                )
+        def write(conn):
+            cursor = conn.cursor()
+            
+            if IS_PRODUCTION:
+                if new_pw:
+                    cursor.execute(
+                        "UPDATE users SET email=%s, phone=%s, password_hash=%s WHERE id=%s",
+                        (email, phone, hash_password(new_pw), user["id"])
+                    )
+                else:
+                    cursor.execute(
+                        "UPDATE users SET email=%s, phone=%s WHERE id=%s",
+                        (email, phone, user["id"])
+                    )
             else:
-                cursor.execute(
-                    "UPDATE users SET email=?, phone=? WHERE id=?",
-                    (email, phone, user["id"])
-                )
+                if new_pw:
+                    cursor.execute(
+                        "UPDATE users SET email=?, phone=?, password_hash=? WHERE id=?",
+                        (email, phone, hash_password(new_pw), user["id"])
+                    )
+                else:
+                    cursor.execute(
+                        "UPDATE users SET email=?, phone=? WHERE id=?",
+                        (email, phone, user["id"])
+                    )
         
-        conn.commit()
-        cursor.close()
-        conn.close()
+            cursor.close()
+        
+        submit_write("users", write)
+        invalidate_user(user["id"])
         
         flash("Profile updated successfully.", "success")
     except Exception as e:
@@ -336,25 +496,25 @@ def add_location():
             flash("Location label is required.", "error")
             return redirect(url_for("auth.settings"))
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        def write(conn):
+            cursor = conn.cursor()
+            
+            if IS_PRODUCTION:
+                cursor.execute(
+                    """INSERT INTO locations (user_id, label, latitude, longitude, address, postal_code, is_favourite)
+                       VALUES (%s, %s, %s, %s, %s, %s, FALSE)""",
+                    (user["id"], label, lat, lon, address, postal_code)
+                )
+            else:
+                cursor.execute(
+                    """INSERT INTO locations (user_id, label, latitude, longitude, address, postal_code, is_favourite)
+                       VALUES (?, ?, ?, ?, ?, ?, 0)""",
+                    (user["id"], label, lat, lon, address, postal_code)
+                )
         
-        if IS_PRODUCTION:
-            cursor.execute(
-                """INSERT INTO locations (user_id, label, latitude, longitude, address, postal_code, is_favourite)
-                   VALUES (%s, %s, %s, %s, %s, %s, FALSE)""",
-                (user["id"], label, lat, lon, address, postal_code)
-            )
-        else:
-            cursor.execute(
-                """INSERT INTO locations (user_id, label, latitude, longitude, address, postal_code, is_favourite)
-                   VALUES (?, ?, ?, ?, ?, ?, 0)""",
-                (user["id"], label, lat, lon, address, postal_code)
-            )
+            cursor.close()
         
-        conn.commit()
-        cursor.close()
-        conn.close()
+        write_user_locations(user["id"], write)
         
         flash("Location added successfully.", "success")
     except Exception as e:
@@ -373,23 +533,23 @@ def delete_location(loc_id):
         return redirect(url_for("auth.login"))
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        def write(conn):
+            cursor = conn.cursor()
+            
+            if IS_PRODUCTION:
+                cursor.execute(
+                    "DELETE FROM locations WHERE id=%s AND user_id=%s",
+                    (loc_id, user["id"])
+                )
+            else:
+                cursor.execute(
+                    "DELETE FROM locations WHERE id=? AND user_id=?",
+                    (loc_id, user["id"])
+                )
         
-        if IS_PRODUCTION:
-            cursor.execute(
-                "DELETE FROM locations WHERE id=%s AND user_id=%s",
-                (loc_id, user["id"])
-            )
-        else:
-            cursor.execute(
-                "DELETE FROM locations WHERE id=? AND user_id=?",
-                (loc_id, user["id"])
-            )
+            cursor.close()
         
-        conn.commit()
-        cursor.close()
-        conn.close()
+        write_user_locations(user["id"], write)
         
         flash("Location deleted.", "success")
     except Exception as e:
@@ -413,24 +573,24 @@ def delete_locations():
         if not ids:
             return redirect(url_for("auth.settings"))
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        def write(conn):
+            cursor = conn.cursor()
+            
+            if IS_PRODUCTION:
+                cursor.execute(
+                    "DELETE FROM locations WHERE id = ANY(%s) AND user_id=%s",
+                    (ids, user["id"])
+                )
+            else:
+                qmarks = ",".join("?" for _ in ids)
+                cursor.execute(
+                    f"DELETE FROM locations WHERE id IN ({qmarks}) AND user_id=?",
+                    (*ids, user["id"])
+                )
         
-        if IS_PRODUCTION:
-            cursor.execute(
-                "DELETE FROM locations WHERE id = ANY(%s) AND user_id=%s",
-                (ids, user["id"])
-            )
-        else:
-            qmarks = ",".join("?" for _ in ids)
-            cursor.execute(
-                f"DELETE FROM locations WHERE id IN ({qmarks}) AND user_id=?",
-                (*ids, user["id"])
-            )
+            cursor.close()
         
-        conn.commit()
-        cursor.close()
-        conn.close()
+        write_user_locations(user["id"], write)
         
         flash(f"{len(ids)} location(s) deleted.", "success")
     except Exception as e:
@@ -449,31 +609,31 @@ def primary_location(loc_id):
         return redirect(url_for("auth.login"))
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        def write(conn):
+            cursor = conn.cursor()
+            
+            if IS_PRODUCTION:
+                cursor.execute(
+                    "UPDATE locations SET is_primary=FALSE WHERE user_id=%s",
+                    (user["id"],)
+                )
+                cursor.execute(
+                    "UPDATE locations SET is_primary=TRUE WHERE id=%s AND user_id=%s",
+                    (loc_id, user["id"])
+                )
+            else:
+                cursor.execute(
+                    "UPDATE locations SET is_primary=0 WHERE user_id=?",
+                    (user["id"],)
+                )
+                cursor.execute(
+                    "UPDATE locations SET is_primary=1 WHERE id=? AND user_id=?",
+                    (loc_id, user["id"])
+                )
         
-        if IS_PRODUCTION:
-            cursor.execute(
-                "UPDATE locations SET is_primary=FALSE WHERE user_id=%s",
-                (user["id"],)
-            )
-            cursor.execute(
-                "UPDATE locations SET is_primary=TRUE WHERE id=%s AND user_id=%s",
-                (loc_id, user["id"])
-            )
-        else:
-            cursor.execute(
-                "UPDATE locations SET is_primary=0 WHERE user_id=?",
-                (user["id"],)
-            )
-            cursor.execute(
-                "UPDATE locations SET is_primary=1 WHERE id=? AND user_id=?",
-                (loc_id, user["id"])
-            )
+            cursor.close()
         
-        conn.commit()
-        cursor.close()
-        conn.close()
+        write_user_locations(user["id"], write)
         
         flash("Primary location updated.", "success")
     except Exception as e:
@@ -492,31 +652,31 @@ def favourite_location(loc_id):
         return redirect(url_for("auth.login"))
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        def write(conn):
+            cursor = conn.cursor()
+            
+            if IS_PRODUCTION:
+                cursor.execute(
+                    "UPDATE locations SET is_favourite=FALSE WHERE user_id=%s",
+                    (user["id"],)
+                )
+                cursor.execute(
+                    "UPDATE locations SET is_favourite=TRUE WHERE id=%s AND user_id=%s",
+                    (loc_id, user["id"])
+                )
+            else:
+                cursor.execute(
+                    "UPDATE locations SET is_favourite=0 WHERE user_id=?",
+                    (user["id"],)
+                )
+                cursor.execute(
+                    "UPDATE locations SET is_favourite=1 WHERE id=? AND user_id=?",
+                    (loc_id, user["id"])
+                )
         
-        if IS_PRODUCTION:
-            cursor.execute(
-                "UPDATE locations SET is_favourite=FALSE WHERE user_id=%s",
-                (user["id"],)
-            )
-            cursor.execute(
-                "UPDATE locations SET is_favourite=TRUE WHERE id=%s AND user_id=%s",
-                (loc_id, user["id"])
-            )
-        else:
-            cursor.execute(
-                "UPDATE locations SET is_favourite=0 WHERE user_id=?",
-                (user["id"],)
-            )
-            cursor.execute(
-                "UPDATE locations SET is_favourite=1 WHERE id=? AND user_id=?",
-                (loc_id, user["id"])
-            )
+            cursor.close()
         
-        conn.commit()
-        cursor.close()
-        conn.close()
+        write_user_locations(user["id"], write)
         
         flash("Default location updated.", "success")
     except Exception as e:
@@ -0,0 +1,105 @@
+"""
+Benchmark loading bus routes: per-row INSERTs vs database.bulk_write.
+
+The per-row path is what load_bus_routes used to do (one INSERT per route
+stop, a commit per 500-row API page). The bulk path is bulk_write with
+replace=True: COPY FROM STDIN on PostgreSQL, batched executemany through the
+writer thread on SQLite. Runs against whichever backend database.py is
+configured for, using a scratch table that is dropped afterwards.
+
+Usage:
+    python benchmark_bulk_load.py [--rows 26000] [--repeat 3]
+    FLASK_ENV=production DB_HOST=... python benchmark_bulk_load.py
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import database
+from database import IS_PRODUCTION, bulk_write, get_bus_db_connection
+
+TABLE = "bench_bus_routes"
+COLUMNS = ("ServiceNo", "Direction", "StopSequence", "BusStopCode", "Distance")
+
+
+def route_rows(count):
+    rows, service = [], 1
+    while len(rows) < count:
+        for direction in (1, 2):
+            for seq in range(1, random.randint(20, 80)):
+                rows.append((str(service), direction, seq, f"{random.randint(10000, 99999)}",
+                             round(seq * random.uniform(0.3, 0.6), 1)))
+        service += 1
+    return rows[:count]
+
+
+def create_table(conn):
+    cursor = conn.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    cursor.execute(f"""
+        CREATE TABLE {TABLE} (
+            ServiceNo VARCHAR(10), Direction INTEGER, StopSequence INTEGER,
+            BusStopCode VARCHAR(10), Distance DECIMAL(10, 2)
+        )
+    """)
+    conn.commit()
+
+
+def per_row_load(conn, rows):
+    param = "%s" if IS_PRODUCTION else "?"
+    cursor = conn.cursor()
+    cursor.execute(f"DELETE FROM {TABLE}")
+    for start in range(0, len(rows), 500):
+        for row in rows[start:start + 500]:
+            cursor.execute(f"INSERT INTO {TABLE} VALUES ({', '.join([param] * 5)})", row)
+        conn.commit()
+
+
+def bulk_load(conn, rows):
+    bulk_write("bus", TABLE, COLUMNS, rows, replace=True)
+
+
+def count_rows(conn):
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT COUNT(*) AS n FROM {TABLE}")
+    return cursor.fetchone()["n"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=26000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if not IS_PRODUCTION:
+            # Keep the real bus_data.db out of it
+            database.BUS_DB_FILE = os.path.join(tmp, "bench_bus.db")
+        conn = get_bus_db_connection(role="primary")
+        create_table(conn)
+        rows = route_rows(args.rows)
+        backend = "PostgreSQL" if IS_PRODUCTION else "SQLite"
+        print(f"📥 Loading {len(rows)} route rows into {backend}, {args.repeat} runs each")
+        try:
+            for label, load in (("per-row INSERT", per_row_load), ("bulk_write", bulk_load)):
+                timings = []
+                for _ in range(args.repeat):
+                    t0 = time.perf_counter()
+                    load(conn, rows)
+                    timings.append(time.perf_counter() - t0)
+                assert count_rows(conn) == len(rows)
+                best = min(timings)
+                print(f"  {label:15s} median={statistics.median(timings):.2f}s best={best:.2f}s "
+                      f"({len(rows) / best:,.0f} rows/s)")
+        finally:
+            conn.cursor().execute(f"DROP TABLE IF EXISTS {TABLE}")
+            conn.commit()
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
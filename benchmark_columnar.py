@@ -0,0 +1,91 @@
+"""
+Benchmark CSV vs Parquet for the analytics datasets and bus_arrivals archives.
+
+1. Every dataset in static/datasets: load time and DataFrame memory from the
+   CSV (all columns) vs the Parquet copy (only the columns charts.py reads).
+2. A synthetic day archive the size of the notebook's input (670k rows):
+   file size, load time and memory of .csv.gz vs Parquet, reading all
+   columns and only (service, eta_min).
+
+Needs pyarrow. Usage:
+    python benchmark_columnar.py [--rows 670000] [--repeat 5]
+"""
+
+import argparse
+import gzip
+import csv
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from charts import DATASET_COLUMNS, DATASET_DIR
+from columnar import PARQUET_AVAILABLE, read_frame, write_arrival_archive, write_frame
+
+
+def timed(load, repeat):
+    timings, frame = [], None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        frame = load()
+        timings.append(time.perf_counter() - t0)
+    return statistics.median(timings) * 1000, frame.memory_usage(deep=True).sum() / 1024
+
+
+def synthetic_arrivals(count):
+    stops = [f"{n:05d}" for n in range(10000, 15000)]
+    services = [str(n) for n in range(1, 400)] + [f"{n}A" for n in range(1, 160)]
+    start = datetime(2026, 10, 19)
+    return [(i + 1, random.choice(stops), random.choice(services), round(random.uniform(0, 40), 1),
+             random.choice(("SD", "DD", "BD")), start + timedelta(seconds=i * 86400 // count))
+            for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=670000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    if not PARQUET_AVAILABLE:
+        raise SystemExit("❌ pyarrow is not installed (pip install pyarrow)")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print("=== static/datasets (median of", args.repeat, "loads) ===")
+        for name in sorted(n for n in os.listdir(DATASET_DIR) if n.endswith(".csv")):
+            csv_path = os.path.join(DATASET_DIR, name)
+            pq_path = os.path.join(tmp, name.replace(".csv", ".parquet"))
+            write_frame(pd.read_csv(csv_path), pq_path)
+            columns = DATASET_COLUMNS.get(name)
+            csv_ms, csv_kb = timed(lambda: pd.read_csv(csv_path), args.repeat)
+            pq_ms, pq_kb = timed(lambda: read_frame(pq_path, columns, categorical=False), args.repeat)
+            print(f"  {name:26s} csv {csv_ms:6.2f}ms {csv_kb:7.1f}KiB | parquet {pq_ms:6.2f}ms {pq_kb:7.1f}KiB")
+
+        print(f"=== bus_arrivals day archive, {args.rows} rows ===")
+        rows = synthetic_arrivals(args.rows)
+        gz_path, pq_path = os.path.join(tmp, "arrivals.csv.gz"), os.path.join(tmp, "arrivals.parquet")
+        t0 = time.perf_counter()
+        with gzip.open(gz_path, "wt", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["id", "stop_code", "service", "eta_min", "bus_type", "timestamp"])
+            writer.writerows(rows)
+        gz_write = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        write_arrival_archive(pq_path, (rows[i:i + 100000] for i in range(0, len(rows), 100000)))
+        pq_write = time.perf_counter() - t0
+        print(f"  write    csv.gz {gz_write:6.2f}s {os.path.getsize(gz_path) / 1e6:6.1f}MB | "
+              f"parquet {pq_write:6.2f}s {os.path.getsize(pq_path) / 1e6:6.1f}MB")
+        repeat = max(1, args.repeat // 2)
+        for label, columns in (("all columns", None), ("service, eta", ["service", "eta_min"])):
+            csv_ms, csv_kb = timed(lambda: pd.read_csv(gz_path, usecols=columns, parse_dates=None if columns else ["timestamp"]),
+                                   repeat)
+            pq_ms, pq_kb = timed(lambda: read_frame(pq_path, columns), repeat)
+            print(f"  {label:12s} csv.gz {csv_ms:7.0f}ms {csv_kb / 1024:6.1f}MiB | "
+                  f"parquet {pq_ms:6.0f}ms {pq_kb / 1024:6.1f}MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Benchmark SQLite read/write latency under concurrent load.
+
+Compares the old operating mode (rollback journal, every thread writes and
+commits on its own connection) with WAL + tuned pragmas + the single
+SQLiteWriter thread from database.py. Reader threads run the bus history
+query while writer threads insert collector-sized batches into bus_arrivals.
+
+Usage:
+    python benchmark_sqlite.py [--readers 8] [--writers 4] [--seconds 10] [--rows 200000]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from database import SQLiteWriter, apply_sqlite_pragmas, SQLITE_BUSY_TIMEOUT_MS
+
+STOPS = [f"{n:05d}" for n in range(10000, 10500)]
+SERVICES = [str(n) for n in range(1, 200)]
+
+
+def create_db(path, rows):
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE bus_arrivals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            stop_code TEXT, service TEXT, eta_min REAL, bus_type TEXT, timestamp TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX idx_bus_arrivals_stop_service_ts ON bus_arrivals(stop_code, service, timestamp)")
+    start = datetime.now() - timedelta(days=2)
+    conn.executemany(
+        "INSERT INTO bus_arrivals (stop_code, service, eta_min, bus_type, timestamp) VALUES (?,?,?,?,?)",
+        ((random.choice(STOPS), random.choice(SERVICES), round(random.uniform(0, 30), 1), "SD",
+          (start + timedelta(seconds=i)).strftime("%Y-%m-%d %H:%M:%S")) for i in range(rows))
+    )
+    conn.commit()
+    conn.close()
+
+
+def collector_batch():
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    stop = random.choice(STOPS)
+    return [(stop, random.choice(SERVICES), round(random.uniform(0, 30), 1), "SD", now) for _ in range(15)]
+
+
+INSERT_SQL = "INSERT INTO bus_arrivals (stop_code, service, eta_min, bus_type, timestamp) VALUES (?,?,?,?,?)"
+HISTORY_SQL = """
+    SELECT service, AVG(eta_min) FROM bus_arrivals
+    WHERE stop_code = ? AND timestamp >= ?
+    GROUP BY service
+"""
+
+
+def run(path, mode, readers, writers, seconds):
+    stop_at = time.monotonic() + seconds
+    read_lat, write_lat, errors = [], [], []
+    lock = threading.Lock()
+    writer = SQLiteWriter() if mode == "wal" else None
+    since = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+
+    def connect():
+        conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+        if mode == "wal":
+            apply_sqlite_pragmas(conn)
+        return conn
+
+    def reader():
+        conn, samples = connect(), []
+        while time.monotonic() < stop_at:
+            t0 = time.perf_counter()
+            try:
+                conn.execute(HISTORY_SQL, (random.choice(STOPS), since)).fetchall()
+                samples.append(time.perf_counter() - t0)
+            except sqlite3.OperationalError as e:
+                with lock:
+                    errors.append(str(e))
+        conn.close()
+        with lock:
+            read_lat.extend(samples)
+
+    def direct_writer():
+        conn, samples = connect(), []
+        while time.monotonic() < stop_at:
+            t0 = time.perf_counter()
+            try:
+                conn.executemany(INSERT_SQL, collector_batch())
+                conn.commit()
+                samples.append(time.perf_counter() - t0)
+            except sqlite3.OperationalError as e:
+                conn.rollback()
+                with lock:
+                    errors.append(str(e))
+            time.sleep(0.01)
+        conn.close()
+        with lock:
+            write_lat.extend(samples)
+
+    def queued_writer():
+        samples = []
+        while time.monotonic() < stop_at:
+            rows = collector_batch()
+            t0 = time.perf_counter()
+            try:
+                writer.submit(path, lambda wc: wc.executemany(INSERT_SQL, rows))
+                samples.append(time.perf_counter() - t0)
+            except sqlite3.OperationalError as e:
+                with lock:
+                    errors.append(str(e))
+            time.sleep(0.01)
+        with lock:
+            write_lat.extend(samples)
+
+    if mode == "wal":
+        # journal_mode=WAL is persistent, set it once before the threads start
+        connect().close()
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads += [threading.Thread(target=queued_writer if mode == "wal" else direct_writer) for _ in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return read_lat, write_lat, errors, (writer.stats() if writer else None)
+
+
+def summarise(label, samples):
+    if not samples:
+        return f"{label}: no samples"
+    ms = sorted(s * 1000 for s in samples)
+    p95 = ms[int(len(ms) * 0.95) - 1] if len(ms) >= 20 else ms[-1]
+    p99 = ms[int(len(ms) * 0.99) - 1] if len(ms) >= 100 else ms[-1]
+    return (f"{label}: n={len(ms)} p50={statistics.median(ms):.2f}ms "
+            f"p95={p95:.2f}ms p99={p99:.2f}ms max={ms[-1]:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--rows", type=int, default=200000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("legacy", "wal"):
+            path = os.path.join(tmp, f"bench_{mode}.db")
+            print(f"📥 Seeding {args.rows} rows for {mode} mode ...")
+            create_db(path, args.rows)
+            read_lat, write_lat, errors, writer_stats = run(path, mode, args.readers, args.writers, args.seconds)
+            print(f"=== {mode} ({args.readers} readers, {args.writers} writers, {args.seconds:g}s) ===")
+            print("  " + summarise("reads ", read_lat))
+            print("  " + summarise("writes", write_lat))
+            if errors:
+                print(f"  ⚠️ {len(errors)} errors, e.g. {errors[0]}")
+            if writer_stats:
+                print(f"  writer: {writer_stats['jobs']} jobs in {writer_stats['batches']} batches "
+                      f"(max batch {writer_stats['batch_size_max']})")
+
+
+if __name__ == "__main__":
+    main()
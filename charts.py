@@ -1,7 +1,13 @@
 # charts.py
+import hashlib
 import os
+import threading
 import pandas as pd
-from flask import Blueprint, render_template, jsonify
+from live_stats import merged_live_stats
+from leaderboard import merged_leaderboard
+from columnar import PARQUET_AVAILABLE, parquet_path, read_frame
+from delay_model import delay_risks, get_model
+from flask import Blueprint, render_template, jsonify, request
 
 # Create Blueprint
 charts_bp = Blueprint('charts', __name__, template_folder='templates')
@@ -9,70 +15,249 @@ charts_bp = Blueprint('charts', __name__, template_folder='templates')
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATASET_DIR = os.path.join(BASE_DIR, "static/datasets")
 
+# ===== CHART-READY RECORDS, built once per dataset version =====
+def _hourly_records(df):
+    # CHART 1: mean ETA per hour across weekdays
+    return (
+        df.groupby("hour")["avg_eta"]
+        .mean()
+        .reset_index()
+        .sort_values("hour")
+        .to_dict(orient="records")
+    )
+
+
+def _sorted_records(column):
+    # CHART 2 / 3: services ordered worst first
+    return lambda df: df.sort_values(column, ascending=False).to_dict(orient="records")
+
+
+CHART_DATASETS = {
+    "avg_by_hour.csv": _hourly_records,
+    "median_by_service.csv": _sorted_records("median_eta"),
+    "drift_by_service.csv": _sorted_records("avg_eta_drift"),
+    "top10_worst.csv": lambda df: df.to_dict(orient="records"),  # CHART 4
+}
+
+# Columns the charts and analytics lookups use; anything else in a file is not read
+DATASET_COLUMNS = {
+    "avg_by_hour.csv": ("weekday", "hour", "avg_eta", "eta_variability"),
+    "avg_by_service_hour.csv": ("service", "weekday", "hour", "avg_eta", "eta_variability"),
+    "median_by_service.csv": ("service", "median_eta", "p90_eta", "avg_eta", "eta_variability"),
+    "drift_by_service.csv": ("service", "avg_eta_drift", "drift_variability", "avg_volatility"),
+    "top10_worst.csv": ("service", "avg_eta_drift", "drift_variability", "avg_volatility"),
+}
+
+# filename -> {"path", "mtime", "size", "digest", "frame", "records"}
+_datasets = {}
+_datasets_lock = threading.Lock()
+
+
+def _file_digest(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _dataset_file(filename):
+    """Path and stat of a dataset: its Parquet copy when present and not older than the CSV."""
+    csv_path = os.path.join(DATASET_DIR, filename)
+    candidates = [csv_path]
+    if PARQUET_AVAILABLE:
+        candidates.insert(0, parquet_path(csv_path))
+    found = []
+    for path in candidates:
+        try:
+            found.append((path, os.stat(path)))
+        except FileNotFoundError:
+            pass
+    if not found:
+        raise FileNotFoundError(f"Dataset not found: {csv_path}")
+    if len(found) == 2 and found[0][1].st_mtime_ns < found[1][1].st_mtime_ns:
+        return found[1]  # the CSV was updated after the Parquet copy was written
+    return found[0]
+
+
+def _read_dataset(path, columns):
+    if path.endswith(".parquet"):
+        return read_frame(path, columns, categorical=False)
+    return pd.read_csv(path, usecols=(lambda col: col in columns) if columns else None)
+
+
+def get_dataset(filename):
+    """Cached dataset entry for a dataset in /datasets.
+
+    The file (Parquet if available, else CSV; only DATASET_COLUMNS) is parsed
+    once; later calls only stat it. A changed mtime or size triggers a content
+    hash, and the dataset (plus its chart records) is rebuilt only if the
+    content really changed.
+    """
+    full_path, st = _dataset_file(filename)
+
+    with _datasets_lock:
+        entry = _datasets.get(filename)
+        if entry and (entry["path"], entry["mtime"], entry["size"]) == (full_path, st.st_mtime_ns, st.st_size):
+            return entry
+
+        digest = _file_digest(full_path)
+        if entry and (entry["path"], entry["digest"]) == (full_path, digest):
+            entry["mtime"], entry["size"] = st.st_mtime_ns, st.st_size
+            return entry
+
+        frame = _read_dataset(full_path, DATASET_COLUMNS.get(filename)).fillna(0)
+        build = CHART_DATASETS.get(filename)
+        entry = {
+            "path": full_path,
+            "mtime": st.st_mtime_ns,
+            "size": st.st_size,
+            "digest": digest,
+            "frame": frame,
+            "records": build(frame) if build else None,
+        }
+        _datasets[filename] = entry
+        print(f"📄 Loaded dataset {os.path.basename(full_path)} ({len(frame)} rows)")
+        return entry
+
+
 def load_csv(filename):
-    """Loads a CSV file from /datasets."""
-    full_path = os.path.join(DATASET_DIR, filename)
-    print(f"📄 Loading: {full_path}")
+    """Loads a CSV file from /datasets (cached, see get_dataset)."""
+    return get_dataset(filename)["frame"]
 
-    if not os.path.exists(full_path):
-        raise FileNotFoundError(f"Dataset not found: {full_path}")
 
-    df = pd.read_csv(full_path)
-    return df.fillna(0)
+def _live_leaderboard():
+    try:
+        return merged_leaderboard()
+    except Exception as e:
+        print(f"Error reading the live leaderboard: {e}")
+        return None
 
 
 @charts_bp.route("/charts")
 def chart_dashboard():
-    print("\n============================")
-    print("🔍 ENTERED /charts ROUTE")
-    print("============================\n")
-
-    # Load datasets from /datasets
-    avg_by_hour_df = load_csv("avg_by_hour.csv")
-    median_by_service_df = load_csv("median_by_service.csv")
-    drift_by_service_df = load_csv("drift_by_service.csv")
-    top10_worst_df = load_csv("top10_worst.csv")
-
-    # ===== CHART 1 CLEANING =====
-    hourly_df = (
-        avg_by_hour_df.groupby("hour")["avg_eta"]
-        .mean()
-        .reset_index()
-        .sort_values("hour")
+    # ?source=live: the collector's streaming statistics instead of the batch datasets
+    source = request.args.get("source", "batch")
+    leaderboard = _live_leaderboard()
+    if source == "live":
+        live = merged_live_stats().records()
+        if live["hourly"]:
+            return render_template("chart_dashboard.html", source="live", leaderboard=leaderboard, **live)
+        source = "batch"
+        live_unavailable = True
+    else:
+        live_unavailable = False
+    return render_template(
+        "chart_dashboard.html",
+        source=source,
+        live_unavailable=live_unavailable,
+        leaderboard=leaderboard,
+        hourly=get_dataset("avg_by_hour.csv")["records"],
+        median_by_service=get_dataset("median_by_service.csv")["records"],
+        drift_by_service=get_dataset("drift_by_service.csv")["records"],
+        top10_worst=get_dataset("top10_worst.csv")["records"]
     )
-    hourly = hourly_df.to_dict(orient="records")
 
-    # ===== CHART 2 CLEANING =====
-    median_sorted_df = (
-        median_by_service_df.sort_values("median_eta", ascending=False)
-    )
-    median_by_service = median_sorted_df.to_dict(orient="records")
+@charts_bp.route("/api/live_leaderboard")
+def get_live_leaderboard():
+    """Current worst services by rolling drift and hour-of-week anomalies, from the collectors."""
+    leaderboard = _live_leaderboard()
+    if leaderboard is None:
+        return jsonify({"error": "Live leaderboard unavailable"}), 503
+    return jsonify(leaderboard)
 
-    # ===== CHART 3 CLEANING =====
-    drift_sorted_df = (
-        drift_by_service_df.sort_values("avg_eta_drift", ascending=False)
-    )
-    drift_by_service = drift_sorted_df.to_dict(orient="records")
+# ===== PER-SERVICE ANALYTICS, indexed once per dataset version =====
+MEDIAN_METRICS = ("median_eta", "avg_eta", "eta_variability")
+DRIFT_METRICS = ("avg_eta_drift", "drift_variability", "avg_volatility")
+BATCH_MAX_SERVICES = 200
+DELAY_RISK_MAX_ITEMS = 500
 
-    # ===== CHART 4 =====
-    top10_worst = top10_worst_df.to_dict(orient="records")
+# (median digest, drift digest) -> {service: analytics}
+_service_index = {"key": None, "metrics": {}}
 
-    # Print debug
-    print("Hourly:", hourly[:3])
-    print("Median:", median_by_service[:3])
-    print("Drift:", drift_by_service[:3])
-    print("Top10:", top10_worst[:3])
-    print("============================\n")
 
-    return render_template(
-        "chart_dashboard.html",
-        hourly=hourly,
-        median_by_service=median_by_service,
-        drift_by_service=drift_by_service,
-        top10_worst=top10_worst
-    )
+def _drift_status(avg_eta_drift):
+    """Status label and colour from the absolute average ETA drift."""
+    drift_abs = abs(avg_eta_drift)
+    if drift_abs >= 30:
+        return "Critical", "#dc2626"
+    if drift_abs >= 20:
+        return "High Drift", "#ea580c"
+    if drift_abs >= 10:
+        return "Medium", "#d97706"
+    return "Stable", "#059669"
+
+
+def _first_rows(df, columns):
+    """service -> {column: float} using each service's first row."""
+    rows = {}
+    for service, *values in df[["service", *columns]].itertuples(index=False):
+        rows.setdefault(str(service).strip(), dict(zip(columns, map(float, values))))
+    return rows
+
+
+def service_metrics():
+    """service -> analytics dict, rebuilt when either source dataset changes."""
+    median = get_dataset("median_by_service.csv")
+    drift = get_dataset("drift_by_service.csv")
+    key = (median["digest"], drift["digest"])
+    if _service_index["key"] == key:
+        return _service_index["metrics"]
+
+    by_median = _first_rows(median["frame"], MEDIAN_METRICS)
+    by_drift = _first_rows(drift["frame"], DRIFT_METRICS)
+    metrics = {}
+    for service in by_median.keys() | by_drift.keys():
+        analytics = {"service": service, "found": True}
+        analytics.update(by_median.get(service, dict.fromkeys(MEDIAN_METRICS, 0)))
+        analytics.update(by_drift.get(service, dict.fromkeys(DRIFT_METRICS, 0)))
+        analytics["status"], analytics["status_color"] = _drift_status(analytics["avg_eta_drift"])
+        metrics[service] = analytics
+
+    _service_index.update(key=key, metrics=metrics)
+    return metrics
+
+
+def lookup_service_analytics(service_no):
+    service_no = str(service_no).strip()
+    analytics = service_metrics().get(service_no)
+    if analytics is None:
+        return {
+            "service": service_no,
+            "found": False,
+            "message": "No analytics data available for this service"
+        }
+    return analytics
+
+
+# (service digest, hourly digest) -> {(service or None, weekday, hour): (mean, std)}
+_baseline_index = {"key": None, "baseline": {}}
+
+
+def hour_of_week_baseline():
+    """Mean and std of the ETA per (service, weekday, hour), plus (None, weekday, hour) over all services.
+
+    The live leaderboard z-scores recent ETAs against these; rebuilt when either dataset changes.
+    """
+    by_service = get_dataset("avg_by_service_hour.csv")
+    overall = get_dataset("avg_by_hour.csv")
+    key = (by_service["digest"], overall["digest"])
+    if _baseline_index["key"] == key:
+        return _baseline_index["baseline"]
+
+    baseline = {}
+    for entry, service_column in ((overall, None), (by_service, "service")):
+        frame = entry["frame"]
+        if service_column and service_column not in frame.columns:
+            continue  # older exports of avg_by_service_hour.csv have no service column
+        columns = ([service_column] if service_column else []) + ["weekday", "hour", "avg_eta", "eta_variability"]
+        for row in frame[columns].itertuples(index=False):
+            *service, weekday, hour, mean, std = row
+            baseline[(str(service[0]).strip() if service else None, int(weekday), int(hour))] = (float(mean), float(std))
+
+    _baseline_index.update(key=key, baseline=baseline)
+    return baseline
 
-# charts.py - ANEW ENDPOINT
 
 @charts_bp.route("/api/bus_analytics/<service_no>")
 def get_bus_analytics(service_no):
@@ -81,64 +266,55 @@ def get_bus_analytics(service_no):
     Returns metrics like median ETA, drift, volatility, etc.
     """
     try:
-        # Load the analytics datasets
-        median_by_service_df = load_csv("median_by_service.csv")
-        drift_by_service_df = load_csv("drift_by_service.csv")
-        
-        # Find data for this specific service
-        service_no = str(service_no).strip()
-        
-        # Get median/ETA data
-        median_data = median_by_service_df[
-            median_by_service_df['service'].astype(str).str.strip() == service_no
-        ]
-        
-        # Get drift data
-        drift_data = drift_by_service_df[
-            drift_by_service_df['service'].astype(str).str.strip() == service_no
-        ]
-        
-        # If no data found, return defaults
-        if median_data.empty and drift_data.empty:
-            return jsonify({
-                "service": service_no,
-                "found": False,
-                "message": "No analytics data available for this service"
-            })
-        
-        # Extract metrics
-        analytics = {
-            "service": service_no,
-            "found": True,
-            "median_eta": float(median_data['median_eta'].iloc[0]) if not median_data.empty else 0,
-            "avg_eta": float(median_data['avg_eta'].iloc[0]) if not median_data.empty else 0,
-            "eta_variability": float(median_data['eta_variability'].iloc[0]) if not median_data.empty else 0,
-            "avg_eta_drift": float(drift_data['avg_eta_drift'].iloc[0]) if not drift_data.empty else 0,
-            "drift_variability": float(drift_data['drift_variability'].iloc[0]) if not drift_data.empty else 0,
-            "avg_volatility": float(drift_data['avg_volatility'].iloc[0]) if not drift_data.empty else 0
-        }
-        
-        # Determine status based on drift
-        drift_abs = abs(analytics['avg_eta_drift'])
-        if drift_abs >= 30:
-            analytics['status'] = 'Critical'
-            analytics['status_color'] = '#dc2626'
-        elif drift_abs >= 20:
-            analytics['status'] = 'High Drift'
-            analytics['status_color'] = '#ea580c'
-        elif drift_abs >= 10:
-            analytics['status'] = 'Medium'
-            analytics['status_color'] = '#d97706'
-        else:
-            analytics['status'] = 'Stable'
-            analytics['status_color'] = '#059669'
-        
-        return jsonify(analytics)
-        
+        return jsonify(lookup_service_analytics(service_no))
     except Exception as e:
         print(f"Error fetching bus analytics: {e}")
         return jsonify({
             "service": service_no,
             "found": False,
             "error": str(e)
-        }), 500
\ No newline at end of file
+        }), 500
+
+
+@charts_bp.route("/api/bus_analytics/batch", methods=["POST"])
+def get_bus_analytics_batch():
+    """
+    Analytics for several services in one call, e.g. every row of the
+    arrivals table. Body: {"services": ["10", "14", ...]}.
+    """
+    services = (request.get_json(silent=True) or {}).get("services")
+    if not isinstance(services, list):
+        return jsonify({"error": "services must be a list"}), 400
+    if len(services) > BATCH_MAX_SERVICES:
+        return jsonify({"error": f"at most {BATCH_MAX_SERVICES} services per request"}), 400
+    try:
+        return jsonify({"results": {str(s).strip(): lookup_service_analytics(s) for s in services}})
+    except Exception as e:
+        print(f"Error fetching bus analytics: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@charts_bp.route("/api/delay_risk", methods=["POST"])
+def get_delay_risk():
+    """
+    Delay risk for many arrivals in one vectorized model call.
+    Body: {"items": [{"service": "10", "stop": "83139", "hour": 8, "eta": 4.5}, ...]};
+    hour, minute and weekday default to now, eta (the last known ETA) to 0.
+    """
+    items = (request.get_json(silent=True) or {}).get("items")
+    if not isinstance(items, list) or not all(isinstance(i, dict) and "service" in i and "stop" in i
+                                              for i in items):
+        return jsonify({"error": "items must be a list of {service, stop, ...} objects"}), 400
+    if len(items) > DELAY_RISK_MAX_ITEMS:
+        return jsonify({"error": f"at most {DELAY_RISK_MAX_ITEMS} items per request"}), 400
+    try:
+        risks = delay_risks(items)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"invalid item: {e}"}), 400
+    if risks is None:
+        return jsonify({"error": "No delay model trained yet (python delay_model.py train)"}), 503
+    model = get_model().meta
+    return jsonify({
+        "results": [{"service": str(i["service"]), "stop": str(i["stop"]), **risk} for i, risk in zip(items, risks)],
+        "model": {"trained_at": model.get("trained_at"), "test_auc": model.get("test_auc")},
+    })
@@ -9,8 +9,8 @@ import requests
 import re
 
 # Import database and auth
-from database import get_db_connection, IS_PRODUCTION
-from auth import login_required
+from database import IS_PRODUCTION
+from auth import login_required, cached_user_locations, find_user_location
 
 # ---- LEX CONFIG ----
 LEX_BOT_ID = os.environ.get("LEX_BOT_ID")
@@ -42,36 +42,16 @@ def get_user_location_by_label(user_id, label):
     Returns: dict with {label, lat, lon, address} or None
     """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        # Search by label (case-insensitive) in the user's cached locations
+        loc = find_user_location(user_id, label)
         
-        # Search by label (case-insensitive)
-        if IS_PRODUCTION:
-            cursor.execute("""
-                SELECT label, latitude, longitude, address, postal_code
-                FROM locations
-                WHERE user_id = %s AND LOWER(label) = LOWER(%s)
-                LIMIT 1
-            """, (user_id, label))
-        else:
-            cursor.execute("""
-                SELECT label, latitude, longitude, address, postal_code
-                FROM locations
-                WHERE user_id = ? AND LOWER(label) = LOWER(?)
-                LIMIT 1
-            """, (user_id, label))
-        
-        row = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        
-        if row:
+        if loc and loc["latitude"] is not None and loc["longitude"] is not None:
             return {
-                "label": row["label"] if IS_PRODUCTION else row[0],
-                "latitude": float(row["latitude"] if IS_PRODUCTION else row[1]),
-                "longitude": float(row["longitude"] if IS_PRODUCTION else row[2]),
-                "address": row["address"] if IS_PRODUCTION else row[3],
-                "postal_code": row["postal_code"] if IS_PRODUCTION else row[4]
+                "label": loc["label"],
+                "latitude": loc["latitude"],
+                "longitude": loc["longitude"],
+                "address": loc["address"],
+                "postal_code": loc["postal_code"]
             }
         return None
         
@@ -431,47 +411,15 @@ def get_user_locations():
     try:
         user_id = session.get("user_id")
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        if IS_PRODUCTION:
-            cursor.execute("""
-                SELECT label, latitude, longitude, address, postal_code, is_favourite
-                FROM locations
-                WHERE user_id = %s
-                ORDER BY is_favourite DESC, label ASC
-            """, (user_id,))
-        else:
-            cursor.execute("""
-                SELECT label, latitude, longitude, address, postal_code, is_favourite
-                FROM locations
-                WHERE user_id = ?
-                ORDER BY is_favourite DESC, label ASC
-            """, (user_id,))
-        
-        locations = []
-        for row in cursor.fetchall():
-            if IS_PRODUCTION:
-                locations.append({
-                    "label": row["label"],
-                    "latitude": float(row["latitude"]),
-                    "longitude": float(row["longitude"]),
-                    "address": row["address"],
-                    "postal_code": row["postal_code"],
-                    "is_favourite": row["is_favourite"]
-                })
-            else:
-                locations.append({
-                    "label": row[0],
-                    "latitude": float(row[1]),
-                    "longitude": float(row[2]),
-                    "address": row[3],
-                    "postal_code": row[4],
-                    "is_favourite": bool(row[5])
-                })
-        
-        cursor.close()
-        conn.close()
+        ordered = sorted(cached_user_locations(user_id), key=lambda loc: (not loc["is_favourite"], loc["label"] or ""))
+        locations = [{
+            "label": loc["label"],
+            "latitude": loc["latitude"],
+            "longitude": loc["longitude"],
+            "address": loc["address"],
+            "postal_code": loc["postal_code"],
+            "is_favourite": loc["is_favourite"]
+        } for loc in ordered]
         
         return jsonify({"locations": locations})
         
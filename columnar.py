@@ -0,0 +1,107 @@
+"""
+columnar.py
+-----------
+Optional Parquet storage for the analytics datasets and bus_arrivals archives.
+
+pyarrow is optional: without it PARQUET_AVAILABLE is False and callers keep
+using CSV. Text columns that repeat a handful of values (service, stop code,
+bus type) are dictionary-encoded, so they are stored once per row group and
+come back as pandas categoricals.
+
+Usage:
+    python columnar.py convert [static/datasets]   # write a .parquet next to every .csv
+"""
+
+import os
+import sys
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+PARQUET_AVAILABLE = pq is not None
+DICTIONARY_COLUMNS = ("service", "stop_code", "bus_stop", "bus_type")
+ARCHIVE_ROW_GROUP = 100000
+
+
+def parquet_path(csv_path):
+    return os.path.splitext(csv_path)[0] + ".parquet"
+
+
+def _dictionary_columns(columns):
+    return [col for col in columns if col in DICTIONARY_COLUMNS]
+
+
+def write_frame(df, path):
+    """Write a DataFrame as Parquet (atomically), dictionary-encoding the repeated text columns."""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    tmp = f"{path}.tmp"
+    pq.write_table(table, tmp, use_dictionary=_dictionary_columns(df.columns), compression="snappy")
+    os.replace(tmp, path)
+
+
+def read_frame(path, columns=None, categorical=True):
+    """Read only `columns` of a Parquet file.
+
+    With categorical=True the dictionary columns come back as pandas
+    categoricals; worth it for archives, not for small per-service tables
+    where every value is distinct.
+    """
+    parquet = pq.ParquetFile(path)
+    available = parquet.schema_arrow.names
+    wanted = [col for col in columns if col in available] if columns else available
+    if not categorical:
+        return parquet.read(columns=wanted).to_pandas()
+    return pq.read_table(path, columns=wanted, read_dictionary=_dictionary_columns(wanted)).to_pandas()
+
+
+ARRIVAL_SCHEMA = None if pa is None else pa.schema([
+    ("id", pa.int64()),
+    ("stop_code", pa.string()),
+    ("service", pa.string()),
+    ("eta_min", pa.float64()),
+    ("bus_type", pa.string()),
+    ("timestamp", pa.timestamp("s")),
+])
+
+
+def write_arrival_archive(path, chunks):
+    """Write chunks of (id, stop_code, service, eta_min, bus_type, timestamp) rows to one Parquet file.
+
+    Each chunk becomes a row group, so memory stays bounded by the chunk size.
+    """
+    tmp = f"{path}.tmp"
+    writer = pq.ParquetWriter(tmp, ARRIVAL_SCHEMA, use_dictionary=_dictionary_columns(ARRIVAL_SCHEMA.names),
+                              compression="zstd")
+    try:
+        for rows in chunks:
+            df = pd.DataFrame(rows, columns=ARRIVAL_SCHEMA.names)
+            df["timestamp"] = pd.to_datetime(df["timestamp"]).astype("datetime64[s]")
+            writer.write_table(pa.Table.from_pandas(df, schema=ARRIVAL_SCHEMA, preserve_index=False))
+    finally:
+        writer.close()
+    os.replace(tmp, path)
+
+
+def convert_datasets(directory):
+    """Write a Parquet copy of every CSV dataset in `directory`."""
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".csv"):
+            path = os.path.join(directory, name)
+            write_frame(pd.read_csv(path), parquet_path(path))
+            print(f"✅ {name} -> {os.path.basename(parquet_path(path))}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "convert":
+        print(__doc__)
+        sys.exit(1)
+    if not PARQUET_AVAILABLE:
+        print("❌ pyarrow is not installed (pip install pyarrow)")
+        sys.exit(1)
+    convert_datasets(sys.argv[2] if len(sys.argv) > 2 else
+                     os.path.join(os.path.dirname(os.path.abspath(__file__)), "static/datasets"))
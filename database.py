@@ -1,69 +1,737 @@
+import csv
+import gzip
+import io
 import os
+import queue
+import re
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import date, datetime, timedelta
+from functools import wraps
 
 # Check if running on AWS or production
 IS_PRODUCTION = os.getenv('AWS_EXECUTION_ENV') or os.getenv('FLASK_ENV') == 'production'
 
 if IS_PRODUCTION:
     import psycopg2
+    import psycopg2.extensions
     from psycopg2.extras import RealDictCursor
+    from psycopg2.pool import ThreadedConnectionPool
 
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+USERS_DB_FILE = "database/users.db"
+BUS_DB_FILE = os.path.join(BASE_DIR, "database/bus_data.db")
 
-def get_db_connection():
+# ---- Connection pool settings (per worker process) ----
+# Gunicorn sync workers serve one request at a time, so a handful of
+# connections covers the request thread plus the background collectors.
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 4))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))            # seconds to wait for a free connection
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', 1800))  # recycle connections older than this
+DB_POOL_PING_AFTER = float(os.getenv('DB_POOL_PING_AFTER', 30))        # health-check connections idle this long
+
+# ---- Read replica routing ----
+# Reads marked read_only (history pages, the collector's lookups, rollups) go
+# to the replica while its heartbeat is fresh, and to the primary otherwise.
+# PostgreSQL: DB_REPLICA_HOST (+ optional DB_REPLICA_PORT/NAME/USER/PASSWORD,
+# defaulting to the primary's). SQLite: SQLITE_REPLICA_DIR holding copies of
+# users.db / bus_data.db kept in sync by an external replicator.
+DB_REPLICA_HOST = os.getenv('DB_REPLICA_HOST')
+SQLITE_REPLICA_DIR = os.getenv('SQLITE_REPLICA_DIR')
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', 30))                     # seconds
+DB_REPLICA_LAG_CHECK_SECONDS = float(os.getenv('DB_REPLICA_LAG_CHECK_SECONDS', 2))  # cache lag this long
+DB_HEARTBEAT_SECONDS = float(os.getenv('DB_HEARTBEAT_SECONDS', 5))
+
+# ---- SQLite operating mode (development / single-node installs) ----
+# WAL lets readers run alongside the single writer; synchronous=NORMAL is
+# durable across application crashes and only fsyncs at checkpoints.
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))   # bytes
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', 64 * 1024))    # page cache per connection
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_WRITE_BATCH = int(os.getenv('SQLITE_WRITE_BATCH', 200))              # max jobs per writer transaction
+SQLITE_WRITE_LINGER = float(os.getenv('SQLITE_WRITE_LINGER', 0.005))        # seconds to wait for more jobs
+SQLITE_WRITER_MAX_FILES = 8                                                 # write connections kept open
+DB_BULK_BATCH_ROWS = int(os.getenv('DB_BULK_BATCH_ROWS', 5000))             # rows per COPY buffer / executemany
+
+# ---- bus_arrivals daily partitions ----
+# PostgreSQL: declarative range partitions of bus_arrivals, one per day.
+# SQLite: one file per day under ARRIVALS_DIR, attached on demand.
+ARRIVALS_DIR = os.path.join(BASE_DIR, "database/arrivals")
+ARRIVALS_ARCHIVE_DIR = os.getenv('BUS_ARRIVALS_ARCHIVE_DIR', os.path.join(BASE_DIR, "database/archive"))
+ARRIVALS_RETENTION_DAYS = int(os.getenv('BUS_ARRIVALS_RETENTION_DAYS', 30))
+ARRIVALS_ARCHIVE_FORMAT = os.getenv('BUS_ARRIVALS_ARCHIVE_FORMAT', 'csv')   # or 'parquet' (needs pyarrow)
+ARRIVALS_PARTITIONS_AHEAD = int(os.getenv('BUS_ARRIVALS_PARTITIONS_AHEAD', 2))
+ARRIVALS_MAX_ATTACHED = 8   # SQLite allows 10 attached databases per connection
+ARRIVAL_ROLLUP_RETENTION_DAYS = int(os.getenv('BUS_ARRIVAL_ROLLUP_RETENTION_DAYS', 365))
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection becomes free within DB_POOL_TIMEOUT."""
+
+
+_pool_stats = {}
+_pool_stats_lock = threading.Lock()
+
+
+def _record_stat(pool_name, **increments):
+    with _pool_stats_lock:
+        stats = _pool_stats.setdefault(pool_name, {
+            "checkouts": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0,
+            "connections_opened": 0, "recycled": 0, "failed_health_checks": 0, "timeouts": 0,
+        })
+        for key, value in increments.items():
+            if key == "wait_seconds":
+                stats["wait_seconds_total"] += value
+                stats["wait_seconds_max"] = max(stats["wait_seconds_max"], value)
+            else:
+                stats[key] += value
+
+
+def get_pool_stats():
+    """Checkout counts, wait times and recycling counters per connection pool."""
+    with _pool_stats_lock:
+        snapshot = {name: dict(stats) for name, stats in _pool_stats.items()}
+    for stats in snapshot.values():
+        stats["wait_seconds_avg"] = stats["wait_seconds_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+    return snapshot
+
+
+class PooledConnection:
+    """Wraps a pooled DB-API connection so that close() hands it back instead.
+
+    Everything else (cursor, commit, rollback, ...) is passed straight through,
+    so existing `conn = get_db_connection() ... conn.close()` code is unchanged.
     """
-    Get database connection for USER DATA based on environment.
-    - Production (AWS): PostgreSQL via RDS
-    - Development (Local): SQLite
+
+    def __init__(self, conn, release):
+        self._conn = conn
+        self._release = release
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get("_conn")
+        if conn is None:
+            raise AttributeError(f"connection already returned to the pool ({name})")
+        return getattr(conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._release(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Commit or roll back like a plain connection would, then release the slot
+        try:
+            if exc_type is None:
+                self._conn.commit()
+            else:
+                self._conn.rollback()
+        finally:
+            self.close()
+        return False
+
+    def __del__(self):
+        # Safety net for code paths that forget to close()
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class PostgresPool:
+    """ThreadedConnectionPool with blocking checkout, health checks and max-lifetime recycling."""
+
+    def __init__(self, name, minconn, maxconn, **connect_kwargs):
+        self.name = name
+        self.pid = os.getpid()
+        self._pool = ThreadedConnectionPool(minconn, maxconn, **connect_kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._opened_at = {}
+        self._last_used = {}
+        self._meta_lock = threading.Lock()
+        print(f"✅ PostgreSQL pool '{name}' ready ({minconn}-{maxconn} connections, pid {self.pid})")
+
+    def _fresh(self, conn):
+        """Close a stale connection and take a new one from the pool."""
+        with self._meta_lock:
+            self._opened_at.pop(id(conn), None)
+            self._last_used.pop(id(conn), None)
+        self._pool.putconn(conn, close=True)
+        _record_stat(self.name, recycled=1)
+        conn = self._pool.getconn()
+        self._track(conn)
+        return conn
+
+    def _track(self, conn):
+        """Remember when a connection was first seen; returns (opened_at, idle seconds)."""
+        now = time.monotonic()
+        with self._meta_lock:
+            if id(conn) not in self._opened_at:
+                self._opened_at[id(conn)] = now
+                _record_stat(self.name, connections_opened=1)
+            return self._opened_at[id(conn)], now - self._last_used.get(id(conn), now)
+
+    def _checked(self, conn):
+        now = time.monotonic()
+        opened_at, idle = self._track(conn)
+
+        if conn.closed or now - opened_at > DB_POOL_MAX_LIFETIME:
+            return self._fresh(conn)
+
+        if idle > DB_POOL_PING_AFTER:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except Exception:
+                _record_stat(self.name, failed_health_checks=1)
+                return self._fresh(conn)
+        return conn
+
+    def getconn(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+            _record_stat(self.name, timeouts=1)
+            raise PoolTimeoutError(f"No free connection in pool '{self.name}' after {DB_POOL_TIMEOUT}s")
+        try:
+            conn = self._checked(self._pool.getconn())
+        except Exception:
+            self._slots.release()
+            raise
+        _record_stat(self.name, checkouts=1, wait_seconds=time.monotonic() - started)
+        return PooledConnection(conn, self.putconn)
+
+    def putconn(self, conn):
+        try:
+            if conn.closed:
+                self._pool.putconn(conn, close=True)
+                return
+            if conn.status != psycopg2.extensions.STATUS_READY:
+                conn.rollback()  # discard anything the caller left uncommitted
+            with self._meta_lock:
+                self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn)
+        finally:
+            self._slots.release()
+
+
+_pg_pools = {}
+_pg_pools_lock = threading.Lock()
+
+
+def _pg_connect_kwargs(name):
+    """Connection settings for a role; replica settings default to the primary's."""
+    kwargs = dict(
+        host=os.getenv('DB_HOST'),
+        port=int(os.getenv('DB_PORT', 5432)),
+        database=os.getenv('DB_NAME', 'transport_db'),
+        user=os.getenv('DB_USER', 'postgres'),
+        password=os.getenv('DB_PASSWORD'),
+    )
+    if name == "replica":
+        kwargs.update(
+            host=DB_REPLICA_HOST,
+            port=int(os.getenv('DB_REPLICA_PORT', kwargs["port"])),
+            database=os.getenv('DB_REPLICA_NAME', kwargs["database"]),
+            user=os.getenv('DB_REPLICA_USER', kwargs["user"]),
+            password=os.getenv('DB_REPLICA_PASSWORD', kwargs["password"]),
+        )
+    return kwargs
+
+
+def _get_pg_pool(name="primary"):
+    """Per-process pool; recreated after a fork so workers never share sockets."""
+    pool = _pg_pools.get(name)
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pg_pools_lock:
+        pool = _pg_pools.get(name)
+        if pool is None or pool.pid != os.getpid():
+            pool = PostgresPool(
+                name, DB_POOL_MIN, DB_POOL_MAX,
+                cursor_factory=RealDictCursor,
+                **_pg_connect_kwargs(name)
+            )
+            _pg_pools[name] = pool
+    return pool
+
+
+# ---- Persistent per-thread SQLite connections ----
+_sqlite_local = threading.local()
+
+
+def apply_sqlite_pragmas(conn):
+    """Switch a raw sqlite3 connection to WAL mode with the tuned pragmas.
+
+    Also used as a SQLAlchemy "connect" listener for the traffic engine.
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def _sqlite_connection(path, pool_name):
+    """Reuse one SQLite connection per (thread, file).
+
+    Nested checkouts in the same thread share the connection; an uncommitted
+    transaction is only rolled back when the outermost user closes it.
+    """
+    conns = getattr(_sqlite_local, "conns", None)
+    if conns is None:
+        conns = _sqlite_local.conns = {}
+        _sqlite_local.refs = {}
+
+    conn = conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+        apply_sqlite_pragmas(conn)
+        conn.row_factory = sqlite3.Row
+        conns[path] = conn
+        _record_stat(pool_name, connections_opened=1)
+
+    _sqlite_local.refs[path] = _sqlite_local.refs.get(path, 0) + 1
+    _record_stat(pool_name, checkouts=1, wait_seconds=0.0)
+
+    def release(c):
+        _sqlite_local.refs[path] -= 1
+        if _sqlite_local.refs[path] == 0 and c.in_transaction:
+            c.rollback()
+
+    return PooledConnection(conn, release)
+
+
+class SQLiteWriter:
+    """Single background thread that performs every write to the SQLite files.
+
+    Jobs are callables taking the writer's own connection. The thread drains
+    the queue in batches and runs each batch in one BEGIN IMMEDIATE
+    transaction per file, with a savepoint around every job so a failing job
+    does not take its neighbours down. Readers keep using their per-thread
+    connections and, thanks to WAL, never wait on the writer.
+
+    Jobs must not call commit()/rollback() themselves.
+    """
+
+    def __init__(self, batch_size=SQLITE_WRITE_BATCH, linger=SQLITE_WRITE_LINGER):
+        self.batch_size = batch_size
+        self.linger = linger
+        self.pid = None
+        self._queue = queue.Queue()
+        self._conns = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"jobs": 0, "failed_jobs": 0, "batches": 0, "batch_size_max": 0,
+                       "queue_wait_seconds_total": 0.0, "queue_wait_seconds_max": 0.0}
+
+    def _ensure_started(self):
+        # A forked worker inherits the object but not the thread, so restart per pid
+        if self.pid == os.getpid():
+            return
+        with self._lock:
+            if self.pid != os.getpid():
+                self._queue = queue.Queue()
+                self._conns = OrderedDict()
+                threading.Thread(target=self._run, name="sqlite-writer", daemon=True).start()
+                self.pid = os.getpid()
+
+    def submit(self, path, job, wait=True):
+        """Queue job(conn) for the SQLite file at `path`.
+
+        With wait=True blocks until the batch holding the job has committed
+        and returns the job's result (or raises its exception); otherwise
+        returns a Future.
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put((path, job, future, time.monotonic()))
+        return future.result() if wait else future
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far has been written."""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((None, None, future, time.monotonic()))
+        future.result(timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize()
+        return stats
+
+    def _connection(self, path):
+        conn = self._conns.get(path)
+        if conn is None:
+            conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+            apply_sqlite_pragmas(conn)
+            conn.row_factory = sqlite3.Row
+            self._conns[path] = conn
+            # Daily arrival files come and go; don't hold yesterday's open forever
+            while len(self._conns) > SQLITE_WRITER_MAX_FILES:
+                self._conns.popitem(last=False)[1].close()
+        self._conns.move_to_end(path)
+        return conn
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            started = time.monotonic()
+            by_path = {}
+            for path, job, future, queued_at in batch:
+                by_path.setdefault(path, []).append((job, future, queued_at))
+
+            failed = 0
+            for path, jobs in by_path.items():
+                if path is None:
+                    continue
+                failed += self._write_batch(path, jobs)
+
+            # Flush markers resolve once every write queued before them is done
+            for job, future, _ in by_path.get(None, ()):
+                future.set_result(None)
+
+            waits = [started - queued_at for _, _, _, queued_at in batch]
+            with self._lock:
+                self._stats["jobs"] += len(batch)
+                self._stats["failed_jobs"] += failed
+                self._stats["batches"] += 1
+                self._stats["batch_size_max"] = max(self._stats["batch_size_max"], len(batch))
+                self._stats["queue_wait_seconds_total"] += sum(waits)
+                self._stats["queue_wait_seconds_max"] = max(self._stats["queue_wait_seconds_max"], max(waits))
+
+    def _write_batch(self, path, jobs):
+        results, failed, conn = [], 0, None
+        try:
+            conn = self._connection(path)
+            conn.execute("BEGIN IMMEDIATE")
+            for job, future, _ in jobs:
+                conn.execute("SAVEPOINT job")
+                try:
+                    results.append((future, job(conn), None))
+                    conn.execute("RELEASE job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((future, None, e))
+                    failed += 1
+            conn.execute("COMMIT")
+        except Exception as e:
+            print(f"❌ SQLite writer batch failed for {path}: {e}")
+            try:
+                if conn is not None and conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            except Exception:
+                pass
+            done = {id(future) for future, _, _ in results}
+            results = [(future, None, e) for future, _, _ in results]
+            results += [(future, None, e) for _, future, _ in jobs if id(future) not in done]
+            failed = len(jobs)
+
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        return failed
+
+
+_sqlite_writer = SQLiteWriter()
+
+
+def submit_write(db, job, wait=True):
+    """Run job(conn) as a write against "users" or "bus".
+
+    SQLite: goes through the single writer thread (see SQLiteWriter), batched
+    with other queued writes. PostgreSQL: runs on a pooled connection and
+    commits straight away, since the server handles concurrent writers.
     """
     if IS_PRODUCTION:
-        # PostgreSQL connection for production
-        conn = psycopg2.connect(
-            host=os.getenv('DB_HOST'),
-            port=int(os.getenv('DB_PORT', 5432)),
-            database=os.getenv('DB_NAME', 'transport_db'),
-            user=os.getenv('DB_USER', 'postgres'),
-            password=os.getenv('DB_PASSWORD'),
-            cursor_factory=RealDictCursor
-        )
-        print("✅ Connected to PostgreSQL (Production)")
+        conn = get_db_connection(role="primary") if db == "users" else get_bus_db_connection(role="primary")
+        try:
+            result = job(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        if wait:
+            return result
+        future = Future()
+        future.set_result(result)
+        return future
+
+    path = USERS_DB_FILE if db == "users" else BUS_DB_FILE
+    if db == "bus":
+        os.makedirs(os.path.dirname(BUS_DB_FILE), exist_ok=True)
+    return _sqlite_writer.submit(path, job, wait=wait)
+
+
+def flush_writes(timeout=None):
+    """Wait for all queued SQLite writes to commit (no-op on PostgreSQL)."""
+    if not IS_PRODUCTION:
+        _sqlite_writer.flush(timeout)
+
+
+def get_writer_stats():
+    """Batching and queue-wait counters of the SQLite writer thread."""
+    if IS_PRODUCTION:
+        return {}
+    stats = _sqlite_writer.stats()
+    stats["queue_wait_seconds_avg"] = stats["queue_wait_seconds_total"] / stats["jobs"] if stats["jobs"] else 0.0
+    return stats
+
+
+# ---- Bulk loading ----
+def _copy_text(value):
+    """One field in PostgreSQL COPY text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "\\\\x" + bytes(value).hex()
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def copy_rows(cursor, table, columns, rows, batch_rows=DB_BULK_BATCH_ROWS):
+    """COPY rows into a PostgreSQL table from in-memory buffers of batch_rows rows."""
+    sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN"
+    for start in range(0, len(rows), batch_rows):
+        buffer = io.StringIO()
+        for row in rows[start:start + batch_rows]:
+            buffer.write("\t".join(_copy_text(value) for value in row))
+            buffer.write("\n")
+        buffer.seek(0)
+        cursor.copy_expert(sql, buffer)
+
+
+def _dedupe_on_key(columns, rows, key):
+    """Keep the last row per key, like INSERT OR REPLACE would."""
+    positions = [columns.index(col) for col in key]
+    latest = {}
+    for row in rows:
+        latest[tuple(row[p] for p in positions)] = row
+    return list(latest.values())
+
+
+def bulk_write(db, table, columns, rows, key=None, replace=False, batch_rows=DB_BULK_BATCH_ROWS, wait=True):
+    """Load many rows into `table` of "users" or "bus" in a single transaction.
+
+    PostgreSQL streams the rows with COPY FROM STDIN; SQLite runs executemany
+    in batch_rows chunks through the writer thread.
+    key: unique-key columns; rows matching an existing key replace it.
+    replace: swap the table contents. Old rows are deleted and the new ones
+    loaded in the same transaction, so readers see either the previous set or
+    the complete new one, never a half-loaded table.
+    """
+    columns, rows = list(columns), [tuple(row) for row in rows]
+    if key:
+        rows = _dedupe_on_key(columns, rows, key)
+    column_list = ", ".join(columns)
+    updates = ", ".join(f"{col} = excluded.{col}" for col in columns if col not in (key or ()))
+    conflict = f"ON CONFLICT ({', '.join(key)}) DO {'UPDATE SET ' + updates if updates else 'NOTHING'}" if key else ""
+
+    if IS_PRODUCTION:
+        def write(conn):
+            cursor = conn.cursor()
+            if replace:
+                # DELETE rather than TRUNCATE: readers keep seeing the old rows until commit
+                cursor.execute(f"DELETE FROM {table}")
+            if key and not replace:
+                cursor.execute(f"CREATE TEMP TABLE bulk_stage (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+                copy_rows(cursor, "bulk_stage", columns, rows, batch_rows)
+                cursor.execute(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM bulk_stage {conflict}")
+            else:
+                copy_rows(cursor, table, columns, rows, batch_rows)
+            cursor.close()
+            return len(rows)
+        return submit_write(db, write, wait=wait)
+
+    insert_sql = f"INSERT INTO {table} ({column_list}) VALUES ({', '.join('?' for _ in columns)}) {conflict}"
+
+    def write(conn):
+        if replace:
+            conn.execute(f"DELETE FROM {table}")
+        for start in range(0, len(rows), batch_rows):
+            conn.executemany(insert_sql, rows[start:start + batch_rows])
+        return len(rows)
+    return submit_write(db, write, wait=wait)
+
+
+# ---- Replica routing ----
+_route_local = threading.local()
+_replica_lag = {}          # scope -> (checked_at, lag seconds)
+_routing_stats = {}
+_routing_lock = threading.Lock()
+_heartbeat_pid = None
+
+
+def replica_configured():
+    return bool(DB_REPLICA_HOST) if IS_PRODUCTION else bool(SQLITE_REPLICA_DIR)
+
+
+def read_only(func):
+    """Mark a function (typically a Flask view) whose database reads may use the replica.
+
+    Writes are unaffected: submit_write() and the init/maintenance helpers
+    always ask for the primary explicitly.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_route_local, "role", None)
+        _route_local.role = "replica"
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _route_local.role = previous
+    return wrapper
+
+
+def _replica_sqlite_path(path):
+    return os.path.join(SQLITE_REPLICA_DIR, os.path.basename(path))
+
+
+def _count_route(scope, key, lag=None):
+    with _routing_lock:
+        stats = _routing_stats.setdefault(scope, {"replica_reads": 0, "primary_fallbacks": 0, "lag_seconds": None})
+        stats[key] += 1
+        if lag is not None:
+            stats["lag_seconds"] = lag if lag != float("inf") else None  # None: no heartbeat seen
+
+
+def get_routing_stats():
+    """Replica reads, lag fallbacks and last measured lag per scope."""
+    with _routing_lock:
+        return {scope: dict(stats) for scope, stats in _routing_stats.items()}
+
+
+def _measure_replica_lag(scope):
+    """Seconds since the primary's heartbeat for `scope` reached the replica."""
+    param = "%s" if IS_PRODUCTION else "?"
+    if IS_PRODUCTION:
+        conn = _get_pg_pool("replica").getconn()
     else:
-        # SQLite connection for local development
-        conn = sqlite3.connect("database/users.db")
-        conn.row_factory = sqlite3.Row
-        print("✅ Connected to SQLite (Development)")
-    
-    return conn
+        path = USERS_DB_FILE if scope == "users" else BUS_DB_FILE
+        conn = _sqlite_connection(_replica_sqlite_path(path), f"sqlite:{scope}:replica")
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT beat_at FROM replication_heartbeat WHERE scope = {param}", (scope,))
+        row = cursor.fetchone()
+        cursor.close()
+        if IS_PRODUCTION:
+            conn.rollback()
+    finally:
+        conn.close()
+    if row is None:
+        return float("inf")
+    beat_at = row["beat_at"] if isinstance(row, dict) else row[0]
+    return max(0.0, time.time() - beat_at)
+
+
+def _replica_is_fresh(scope):
+    _ensure_heartbeat()
+    checked_at, lag = _replica_lag.get(scope, (0.0, None))
+    if time.monotonic() - checked_at > DB_REPLICA_LAG_CHECK_SECONDS:
+        try:
+            lag = _measure_replica_lag(scope)
+        except Exception as e:
+            print(f"⚠️ Replica lag check failed for {scope}: {e}")
+            lag = float("inf")
+        _replica_lag[scope] = (time.monotonic(), lag)
+    return lag <= DB_REPLICA_MAX_LAG, lag
+
+
+def _resolve_role(scope, role):
+    role = role or getattr(_route_local, "role", None) or "primary"
+    if role != "replica" or not replica_configured():
+        return "primary"
+    fresh, lag = _replica_is_fresh(scope)
+    _count_route(scope, "replica_reads" if fresh else "primary_fallbacks", lag)
+    return "replica" if fresh else "primary"
+
+
+def _heartbeat_loop():
+    while True:
+        for scope in ("users", "bus"):
+            try:
+                param = "%s" if IS_PRODUCTION else "?"
+                submit_write(scope, lambda conn, scope=scope: conn.cursor().execute(f"""
+                    INSERT INTO replication_heartbeat (scope, beat_at) VALUES ({param}, {param})
+                    ON CONFLICT (scope) DO UPDATE SET beat_at = excluded.beat_at
+                """, (scope, time.time())))
+            except Exception as e:
+                print(f"⚠️ Replication heartbeat failed for {scope}: {e}")
+        time.sleep(DB_HEARTBEAT_SECONDS)
 
 
-def get_bus_db_connection():
+def _ensure_heartbeat():
+    """Start the per-process thread that stamps replication_heartbeat on the primary."""
+    global _heartbeat_pid
+    if _heartbeat_pid == os.getpid():
+        return
+    with _routing_lock:
+        if _heartbeat_pid != os.getpid():
+            threading.Thread(target=_heartbeat_loop, name="replication-heartbeat", daemon=True).start()
+            _heartbeat_pid = os.getpid()
+
+
+def get_db_connection(role=None):
+    """
+    Get database connection for USER DATA based on environment.
+    - Production (AWS): PostgreSQL via RDS (pooled)
+    - Development (Local): SQLite (one connection per thread)
+    Call close() as before; it returns the connection for reuse.
+    role: "primary", "replica", or None to follow the read_only marker.
+    """
+    role = _resolve_role("users", role)
+    if IS_PRODUCTION:
+        return _get_pg_pool(role).getconn()
+    if role == "replica":
+        return _sqlite_connection(_replica_sqlite_path(USERS_DB_FILE), "sqlite:users:replica")
+    return _sqlite_connection(USERS_DB_FILE, "sqlite:users")
+
+
+def get_bus_db_connection(role=None):
     """
     Get database connection for BUS DATA.
     - Production: PostgreSQL RDS (use existing bus_stops and bus_arrivals tables)
     - Development: SQLite local cache
+    role: "primary", "replica", or None to follow the read_only marker.
     """
+    role = _resolve_role("bus", role)
     if IS_PRODUCTION:
-        # Use PostgreSQL for bus data in production
-        conn = psycopg2.connect(
-            host=os.getenv('DB_HOST'),
-            port=int(os.getenv('DB_PORT', 5432)),
-            database=os.getenv('DB_NAME', 'transport_db'),
-            user=os.getenv('DB_USER', 'postgres'),
-            password=os.getenv('DB_PASSWORD'),
-            cursor_factory=RealDictCursor
-        )
-        print("✅ Connected to PostgreSQL for bus data (Production)")
-        return conn
-    else:
-        # SQLite for local development
-        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-        BUS_DB_FILE = os.path.join(BASE_DIR, "database/bus_data.db")
-        
-        # Ensure database directory exists
-        os.makedirs(os.path.dirname(BUS_DB_FILE), exist_ok=True)
-        
-        conn = sqlite3.connect(BUS_DB_FILE)
-        conn.row_factory = sqlite3.Row
-        return conn
+        # Bus data lives in the same RDS database, so it shares the pool
+        return _get_pg_pool(role).getconn()
+
+    if role == "replica":
+        return _sqlite_connection(_replica_sqlite_path(BUS_DB_FILE), "sqlite:bus:replica")
+
+    # Ensure database directory exists
+    os.makedirs(os.path.dirname(BUS_DB_FILE), exist_ok=True)
+    return _sqlite_connection(BUS_DB_FILE, "sqlite:bus")
 
 
 def init_users_db():
@@ -71,7 +739,7 @@ def init_users_db():
     Initialize USER database tables.
     Works with both SQLite (local) and PostgreSQL (production).
     """
-    conn = get_db_connection()
+    conn = get_db_connection(role="primary")
     
     if IS_PRODUCTION:
         # PostgreSQL syntax
@@ -161,6 +829,7 @@ def init_users_db():
         conn.commit()
         print("✅ SQLite user tables initialized")
     
+    apply_migrations(conn, "users", USERS_MIGRATIONS)
     conn.close()
 
 
@@ -170,12 +839,32 @@ def init_bus_db():
     In production, this uses your EXISTING PostgreSQL tables.
     In development, creates local SQLite tables.
     """
-    conn = get_bus_db_connection()
+    conn = get_bus_db_connection(role="primary")
     cursor = conn.cursor()
     
     if IS_PRODUCTION:
         # PostgreSQL - Create missing tables only
-        # bus_stops and bus_arrivals already exist in your RDS
+        # bus_stops and bus_arrivals already exist in your RDS (these are no-ops there)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS bus_stops (
+                code VARCHAR(10) PRIMARY KEY,
+                description VARCHAR(255),
+                road VARCHAR(255),
+                lat DOUBLE PRECISION,
+                lon DOUBLE PRECISION
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS bus_arrivals (
+                id SERIAL PRIMARY KEY,
+                stop_code VARCHAR(10),
+                service VARCHAR(10),
+                eta_min REAL,
+                bus_type VARCHAR(10),
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
         
         # Create bus_routes table (needed for route planning)
         cursor.execute("""
@@ -202,10 +891,16 @@ def init_bus_db():
                 Latitude DOUBLE PRECISION,
                 Longitude DOUBLE PRECISION,
                 Message TEXT,
-                FetchedAt TIMESTAMP
+                FetchedAt TIMESTAMP,
+                RoadCategory VARCHAR(255),
+                Area VARCHAR(255)
             )
         """)
         
+        # Road/area classification columns (filled in at ingest)
+        cursor.execute("ALTER TABLE incidents ADD COLUMN IF NOT EXISTS RoadCategory VARCHAR(255)")
+        cursor.execute("ALTER TABLE incidents ADD COLUMN IF NOT EXISTS Area VARCHAR(255)")
+        
         conn.commit()
         print("✅ PostgreSQL bus tables initialized (using existing bus_stops and bus_arrivals)")
         
@@ -219,14 +914,7 @@ def init_bus_db():
             lon REAL
         )""")
         
-        cursor.execute("""CREATE TABLE IF NOT EXISTS bus_arrivals(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            stop_code TEXT,
-            service TEXT,
-            eta_min REAL,
-            bus_type TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )""")
+        # bus_arrivals lives in one file per day, see ensure_arrival_day()
         
         cursor.execute("""CREATE TABLE IF NOT EXISTS bus_routes(
             ServiceNo TEXT,
@@ -239,13 +927,997 @@ def init_bus_db():
         conn.commit()
         print("✅ SQLite bus tables initialized")
     
+    apply_migrations(conn, "bus", BUS_MIGRATIONS)
     conn.close()
+    ensure_arrival_partitions()
+
+
+# ==================== SCHEMA MIGRATIONS ====================
+# Stamped by the primary and read back from the replica to measure lag
+HEARTBEAT_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS replication_heartbeat (
+        scope VARCHAR(20) PRIMARY KEY,
+        beat_at DOUBLE PRECISION NOT NULL
+    )
+"""
+
+# Versioned, forward-only changes applied on top of the base tables above.
+# Each entry is (version, description, {"sqlite": [...], "postgres": [...]});
+# a list item is either an SQL string or a callable taking the cursor.
+# Versions are tracked per scope in schema_migrations, so the user and bus
+# schemas can evolve independently even when they share one PostgreSQL DB.
+USERS_MIGRATIONS = [
+    (1, "Index saved locations and bus favourites by user", {
+        "sqlite": [
+            "CREATE INDEX IF NOT EXISTS idx_locations_user_label ON locations(user_id, LOWER(label))",
+            "CREATE INDEX IF NOT EXISTS idx_bus_favorites_user_created ON bus_favorites(user_id, created_at)",
+        ],
+        "postgres": [
+            "CREATE INDEX IF NOT EXISTS idx_locations_user_label ON locations(user_id, LOWER(label))",
+            "CREATE INDEX IF NOT EXISTS idx_bus_favorites_user_created ON bus_favorites(user_id, created_at)",
+        ],
+    }),
+    (2, "Replication heartbeat", {
+        "sqlite": [HEARTBEAT_TABLE_SQL],
+        "postgres": [HEARTBEAT_TABLE_SQL],
+    }),
+    (3, "Version of each user's saved locations and bus favourites", {
+        # Bumped with every write to either collection, so all workers can tell a cached copy is stale
+        "sqlite": ["ALTER TABLE users ADD COLUMN collections_version INTEGER NOT NULL DEFAULT 0"],
+        "postgres": ["ALTER TABLE users ADD COLUMN IF NOT EXISTS collections_version INTEGER NOT NULL DEFAULT 0"],
+    }),
+]
+
+BUS_MIGRATIONS = [
+    (1, "Index bus_arrivals lookups and bus_routes", {
+        # SQLite bus_arrivals indexes are part of the per-day file schema since migration 2
+        "sqlite": [
+            "CREATE INDEX IF NOT EXISTS idx_bus_routes_service ON bus_routes(ServiceNo, Direction, StopSequence)",
+            "CREATE INDEX IF NOT EXISTS idx_bus_routes_stop ON bus_routes(BusStopCode)",
+        ],
+        "postgres": [
+            "CREATE INDEX IF NOT EXISTS idx_bus_arrivals_stop_service_ts ON bus_arrivals(stop_code, service, timestamp)",
+            "CREATE INDEX IF NOT EXISTS idx_bus_arrivals_timestamp ON bus_arrivals(timestamp)",
+            "CREATE INDEX IF NOT EXISTS idx_bus_routes_stop ON bus_routes(BusStopCode)",
+        ],
+    }),
+    (2, "Partition bus_arrivals by day", {
+        "sqlite": [lambda cursor: _split_sqlite_arrivals(cursor.connection)],
+        "postgres": [lambda cursor: _partition_pg_arrivals(cursor)],
+    }),
+    (3, "Hourly bus_arrivals rollups", {
+        "sqlite": [
+            """CREATE TABLE IF NOT EXISTS bus_arrival_rollups (
+                stop_code TEXT NOT NULL,
+                service TEXT NOT NULL,
+                hour_start DATETIME NOT NULL,
+                sample_count INTEGER NOT NULL,
+                eta_sum REAL NOT NULL,
+                eta_sumsq REAL NOT NULL,
+                PRIMARY KEY (stop_code, service, hour_start)
+            )""",
+            "CREATE INDEX IF NOT EXISTS idx_bus_arrival_rollups_hour ON bus_arrival_rollups(hour_start)",
+            lambda cursor: _backfill_sqlite_rollups(cursor),
+        ],
+        "postgres": [
+            """CREATE TABLE IF NOT EXISTS bus_arrival_rollups (
+                stop_code VARCHAR(10) NOT NULL,
+                service VARCHAR(10) NOT NULL,
+                hour_start TIMESTAMP NOT NULL,
+                sample_count INTEGER NOT NULL,
+                eta_sum DOUBLE PRECISION NOT NULL,
+                eta_sumsq DOUBLE PRECISION NOT NULL,
+                PRIMARY KEY (stop_code, service, hour_start)
+            )""",
+            "CREATE INDEX IF NOT EXISTS idx_bus_arrival_rollups_hour ON bus_arrival_rollups(hour_start)",
+            """INSERT INTO bus_arrival_rollups
+               SELECT stop_code, service, date_trunc('hour', timestamp), COUNT(*),
+                      SUM(eta_min), SUM(eta_min * eta_min)
+               FROM bus_arrivals
+               WHERE timestamp IS NOT NULL AND stop_code IS NOT NULL AND service IS NOT NULL
+                 AND eta_min IS NOT NULL
+               GROUP BY 1, 2, 3
+               ON CONFLICT DO NOTHING""",
+        ],
+    }),
+    (4, "Replication heartbeat", {
+        "sqlite": [HEARTBEAT_TABLE_SQL],
+        "postgres": [HEARTBEAT_TABLE_SQL],
+    }),
+    (5, "Collector live statistics shards", {
+        "sqlite": [
+            """CREATE TABLE IF NOT EXISTS collector_stats (
+                shard TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )""",
+        ],
+        "postgres": [
+            """CREATE TABLE IF NOT EXISTS collector_stats (
+                shard VARCHAR(100) PRIMARY KEY,
+                payload TEXT NOT NULL,
+                updated_at DOUBLE PRECISION NOT NULL
+            )""",
+        ],
+    }),
+    (6, "Collector live leaderboard shards", {
+        "sqlite": [
+            """CREATE TABLE IF NOT EXISTS collector_leaderboard (
+                shard TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )""",
+        ],
+        "postgres": [
+            """CREATE TABLE IF NOT EXISTS collector_leaderboard (
+                shard VARCHAR(100) PRIMARY KEY,
+                payload TEXT NOT NULL,
+                updated_at DOUBLE PRECISION NOT NULL
+            )""",
+        ],
+    }),
+    (7, "Typical waits per stop, service and hour of week", {
+        "sqlite": [
+            """CREATE TABLE IF NOT EXISTS bus_typical_waits (
+                stop_code TEXT NOT NULL,
+                service TEXT NOT NULL,
+                weekday INTEGER NOT NULL,
+                hour INTEGER NOT NULL,
+                polls INTEGER NOT NULL,
+                wait_sum REAL NOT NULL,
+                headway_count INTEGER NOT NULL,
+                headway_sum REAL NOT NULL,
+                PRIMARY KEY (stop_code, service, weekday, hour)
+            )""",
+            lambda cursor: _backfill_sqlite_typical_waits(cursor),
+        ],
+        "postgres": [
+            """CREATE TABLE IF NOT EXISTS bus_typical_waits (
+                stop_code VARCHAR(10) NOT NULL,
+                service VARCHAR(10) NOT NULL,
+                weekday SMALLINT NOT NULL,
+                hour SMALLINT NOT NULL,
+                polls INTEGER NOT NULL,
+                wait_sum DOUBLE PRECISION NOT NULL,
+                headway_count INTEGER NOT NULL,
+                headway_sum DOUBLE PRECISION NOT NULL,
+                PRIMARY KEY (stop_code, service, weekday, hour)
+            )""",
+            lambda cursor: cursor.execute("INSERT INTO bus_typical_waits " + TYPICAL_WAIT_SELECT_SQL.format(
+                weekday="EXTRACT(DOW FROM timestamp)::int + 1", hour="EXTRACT(HOUR FROM timestamp)::int")),
+        ],
+    }),
+    (8, "Reconstructed bus trips", {
+        "sqlite": [
+            """CREATE TABLE IF NOT EXISTS bus_trips (
+                source_unit TEXT NOT NULL,
+                service TEXT NOT NULL,
+                direction INTEGER NOT NULL,
+                trip_no INTEGER NOT NULL,
+                service_date TEXT NOT NULL,
+                start_time TIMESTAMP NOT NULL,
+                end_time TIMESTAMP NOT NULL,
+                first_seq INTEGER NOT NULL,
+                last_seq INTEGER NOT NULL,
+                stops_observed INTEGER NOT NULL,
+                observations INTEGER NOT NULL,
+                payload BLOB NOT NULL,
+                PRIMARY KEY (source_unit, service, direction, trip_no)
+            )""",
+            "CREATE INDEX IF NOT EXISTS idx_bus_trips_service ON bus_trips(service, direction, service_date)",
+            """CREATE TABLE IF NOT EXISTS bus_trip_units (
+                source_unit TEXT PRIMARY KEY,
+                arrivals INTEGER NOT NULL,
+                trips INTEGER NOT NULL,
+                payload_bytes INTEGER NOT NULL,
+                built_at REAL NOT NULL
+            )""",
+        ],
+        "postgres": [
+            """CREATE TABLE IF NOT EXISTS bus_trips (
+                source_unit VARCHAR(100) NOT NULL,
+                service VARCHAR(10) NOT NULL,
+                direction SMALLINT NOT NULL,
+                trip_no INTEGER NOT NULL,
+                service_date DATE NOT NULL,
+                start_time TIMESTAMP NOT NULL,
+                end_time TIMESTAMP NOT NULL,
+                first_seq SMALLINT NOT NULL,
+                last_seq SMALLINT NOT NULL,
+                stops_observed SMALLINT NOT NULL,
+                observations INTEGER NOT NULL,
+                payload BYTEA NOT NULL,
+                PRIMARY KEY (source_unit, service, direction, trip_no)
+            )""",
+            "CREATE INDEX IF NOT EXISTS idx_bus_trips_service ON bus_trips(service, direction, service_date)",
+            """CREATE TABLE IF NOT EXISTS bus_trip_units (
+                source_unit VARCHAR(100) PRIMARY KEY,
+                arrivals INTEGER NOT NULL,
+                trips INTEGER NOT NULL,
+                payload_bytes BIGINT NOT NULL,
+                built_at DOUBLE PRECISION NOT NULL
+            )""",
+        ],
+    }),
+    (9, "Index bus trips by source partition", {
+        "sqlite": ["CREATE INDEX IF NOT EXISTS idx_bus_trips_source_unit ON bus_trips(source_unit)"],
+        "postgres": ["CREATE INDEX IF NOT EXISTS idx_bus_trips_source_unit ON bus_trips(source_unit)"],
+    }),
+]
+
+
+def apply_migrations(conn, scope, migrations):
+    """Apply any migrations for `scope` that have not been recorded yet."""
+    backend = "postgres" if IS_PRODUCTION else "sqlite"
+    param = "%s" if IS_PRODUCTION else "?"
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            scope VARCHAR(50) NOT NULL,
+            version INTEGER NOT NULL,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (scope, version)
+        )
+    """)
+    cursor.execute(f"SELECT version FROM schema_migrations WHERE scope = {param}", (scope,))
+    applied = {row[0] if not isinstance(row, dict) else row["version"] for row in cursor.fetchall()}
+    conn.commit()
+
+    for version, description, statements in migrations:
+        if version in applied:
+            continue
+        try:
+            for statement in statements[backend]:
+                # Plain SQL, or a callable for data moves that need more than one statement
+                if callable(statement):
+                    statement(cursor)
+                else:
+                    cursor.execute(statement)
+            cursor.execute(
+                f"INSERT INTO schema_migrations (scope, version, description) VALUES ({param}, {param}, {param})",
+                (scope, version, description)
+            )
+            conn.commit()
+            print(f"✅ Applied {scope} migration {version}: {description}")
+        except Exception:
+            conn.rollback()
+            raise
+    cursor.close()
+
+
+# ==================== QUERY PLAN CHECKS ====================
+# Statements shared by the app and check_query_plans(), so the plans checked
+# are the plans run. {p} is the driver's placeholder; {recent} is an
+# arrivals_source() expression and {table} a single bus_arrivals table.
+LAST_ETA_SQL = ("SELECT eta_min FROM {recent} AS a WHERE stop_code = {p} AND service = {p} "
+                "ORDER BY timestamp DESC LIMIT 1")
+ARRIVAL_SERIES_SQL = ("SELECT timestamp, eta_min FROM {table} WHERE stop_code = {p} AND service = {p} "
+                      "AND timestamp >= {p} AND timestamp <= {p} AND eta_min IS NOT NULL ORDER BY timestamp")
+ROLLUPS_ALL_STOPS_SQL = ("SELECT hour_start, NULL AS service, SUM(sample_count) AS sample_count, "
+                         "SUM(eta_sum) AS eta_sum, SUM(eta_sumsq) AS eta_sumsq FROM bus_arrival_rollups "
+                         "WHERE hour_start >= {p} GROUP BY hour_start")
+ROLLUPS_ONE_STOP_SQL = ("SELECT hour_start, service, sample_count, eta_sum, eta_sumsq FROM bus_arrival_rollups "
+                        "WHERE stop_code = {p} AND hour_start >= {p}")
+
+# The hot queries of the app. check_query_plans() runs EXPLAIN on each and
+# reports any that fall back to a full table scan. "arrivals" queries run on
+# the bus connection with {recent} covering today and yesterday (as the
+# collector does); "arrival_day" queries run on one day's SQLite file.
+HOT_QUERIES = [
+    ("arrivals", "collector last ETA lookup", LAST_ETA_SQL,
+     ("01012", "10")),
+    ("arrival_day", "arrival series for a stop and service", ARRIVAL_SERIES_SQL,
+     ("01012", "10", "2025-01-01 00:00:00", "2025-01-02 00:00:00")),
+    ("bus", "hourly rollups for one stop", ROLLUPS_ONE_STOP_SQL,
+     ("01012", "2025-01-01 00:00:00")),
+    ("bus", "hourly rollups for all stops", ROLLUPS_ALL_STOPS_SQL,
+     ("2025-01-01 00:00:00",)),
+    ("bus", "route stops for a service",
+     "SELECT ServiceNo, Direction, StopSequence, BusStopCode, Distance FROM bus_routes "
+     "WHERE ServiceNo = {p} ORDER BY Direction, StopSequence",
+     ("10",)),
+    ("bus", "route stops for a service and direction",
+     "SELECT ServiceNo, Direction, StopSequence, BusStopCode FROM bus_routes "
+     "WHERE ServiceNo = {p} AND Direction = {p} ORDER BY StopSequence",
+     ("10", 1)),
+    ("bus", "services calling at a stop",
+     "SELECT ServiceNo, Direction, StopSequence FROM bus_routes WHERE BusStopCode = {p}",
+     ("01012",)),
+    ("bus", "bus stop by code",
+     "SELECT lat, lon, description, road, code FROM bus_stops WHERE code = {p}",
+     ("01012",)),
+    ("users", "current user by id",
+     "SELECT * FROM users WHERE id = {p}",
+     (1,)),
+    ("users", "collections version of a user",
+     "SELECT collections_version FROM users WHERE id = {p}",
+     (1,)),
+    ("users", "login by username",
+     "SELECT * FROM users WHERE username = {p}",
+     ("alice",)),
+    ("users", "saved locations for a user",
+     "SELECT id, label, latitude, longitude FROM locations WHERE user_id = {p} ORDER BY is_primary DESC, id DESC",
+     (1,)),
+    ("users", "saved location by label",
+     "SELECT label, latitude, longitude FROM locations WHERE user_id = {p} AND LOWER(label) = LOWER({p}) LIMIT 1",
+     (1, "home")),
+    ("users", "bus favourites for a user",
+     "SELECT bus_stop_code, bus_stop_name FROM bus_favorites WHERE user_id = {p} ORDER BY created_at DESC",
+     (1,)),
+]
+
+
+def _plan_full_scans_sqlite(cursor, sql, params):
+    cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+    details = [row[3] for row in cursor.fetchall()]
+    # "SCAN t" is a full table scan; "SCAN t USING INDEX ..." walks an index.
+    # Scanning a subquery's rows ("SCAN a" after "CO-ROUTINE a") is not.
+    subqueries = {d.split(" ", 1)[1] for d in details if d.startswith(("CO-ROUTINE ", "MATERIALIZE "))}
+    scans = [d for d in details if d.startswith("SCAN ") and " USING " not in d
+             and d[5:] not in subqueries and not d[5:].startswith(("SUBQUERY", "CONSTANT ROW"))]
+    return scans, details
+
+
+def _plan_full_scans_postgres(cursor, sql, params):
+    cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+    row = cursor.fetchone()
+    plan = (row["QUERY PLAN"] if isinstance(row, dict) else row[0])[0]["Plan"]
+    scans, details, stack = [], [], [plan]
+    while stack:
+        node = stack.pop()
+        details.append(f"{node['Node Type']} {node.get('Relation Name', '')}".strip())
+        if node["Node Type"] == "Seq Scan":
+            scans.append(details[-1])
+        stack.extend(node.get("Plans", []))
+    return scans, details
+
+
+def check_query_plans(verbose=True):
+    """EXPLAIN every hot query; returns the list of (name, full scans) that regressed.
+
+    On PostgreSQL sequential scans are disabled for the session, so a
+    "Seq Scan" in the plan means no usable index exists (tiny tables would
+    otherwise always be scanned).
+    """
+    failures = []
+    param = "%s" if IS_PRODUCTION else "?"
+    now = datetime.now()
+    for scope in ("users", "bus", "arrivals", "arrival_day"):
+        if scope == "users":
+            conn = get_db_connection(role="primary")
+        elif scope == "arrival_day" and not IS_PRODUCTION:
+            # Each day's SQLite file has the same schema; check today's
+            conn = sqlite3.connect(ensure_arrival_day(now))
+        else:
+            conn = get_bus_db_connection(role="primary")
+        cursor = conn.cursor()
+        try:
+            if IS_PRODUCTION:
+                cursor.execute("SET enable_seqscan = off")
+            recent = None
+            if scope == "arrivals":
+                # The collector's range: yesterday's and today's partitions
+                if not IS_PRODUCTION:
+                    ensure_arrival_day(now - timedelta(days=1))
+                    ensure_arrival_day(now)
+                recent = arrivals_source(conn, now - timedelta(days=1), now)
+            for query_scope, name, sql, params in HOT_QUERIES:
+                if query_scope != scope:
+                    continue
+                sql = sql.format(p=param, recent=recent, table="bus_arrivals")
+                if IS_PRODUCTION:
+                    scans, details = _plan_full_scans_postgres(cursor, sql, params)
+                else:
+                    scans, details = _plan_full_scans_sqlite(cursor, sql, params)
+                if scans:
+                    failures.append((name, scans))
+                if verbose:
+                    status = "❌ FULL SCAN" if scans else "✅"
+                    print(f"{status} {name}: {' | '.join(details)}")
+        finally:
+            if IS_PRODUCTION:
+                conn.rollback()
+            cursor.close()
+            conn.close()
+    return failures
+
+
+# ==================== BUS ARRIVAL PARTITIONS ====================
+ARRIVAL_COLUMNS = ("id", "stop_code", "service", "eta_min", "bus_type", "timestamp")
+
+SQLITE_ARRIVALS_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS bus_arrivals(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        stop_code TEXT,
+        service TEXT,
+        eta_min REAL,
+        bus_type TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_bus_arrivals_stop_service_ts ON bus_arrivals(stop_code, service, timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_bus_arrivals_timestamp ON bus_arrivals(timestamp)",
+]
+
+
+def _as_day(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def arrival_day_path(day):
+    """SQLite file holding bus_arrivals rows for one calendar day."""
+    return os.path.join(ARRIVALS_DIR, f"bus_arrivals_{_as_day(day):%Y%m%d}.db")
+
+
+def ensure_arrival_day(day):
+    """Create the SQLite file for `day` if needed and return its path."""
+    path = arrival_day_path(day)
+    if not os.path.exists(path):
+        os.makedirs(ARRIVALS_DIR, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+        apply_sqlite_pragmas(conn)
+        for statement in SQLITE_ARRIVALS_SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+        conn.close()
+    return path
+
+
+def sqlite_arrival_days():
+    """Days that have a SQLite arrivals file, oldest first."""
+    if not os.path.isdir(ARRIVALS_DIR):
+        return []
+    days = []
+    for name in os.listdir(ARRIVALS_DIR):
+        match = re.fullmatch(r"bus_arrivals_(\d{8})\.db", name)
+        if match:
+            days.append(datetime.strptime(match.group(1), "%Y%m%d").date())
+    return sorted(days)
+
+
+def arrivals_source(conn, since, until=None):
+    """FROM-clause expression covering bus_arrivals between `since` and `until`.
+
+    PostgreSQL returns the partitioned table itself; the caller's timestamp
+    predicate lets the planner prune to the matching day partitions. SQLite
+    attaches the day files in range to `conn` and returns a UNION ALL
+    subquery over them. The caller still filters on timestamp.
+    """
+    if IS_PRODUCTION:
+        return "bus_arrivals"
+
+    first, last = _as_day(since), _as_day(until or datetime.now())
+    days = [first + timedelta(days=n) for n in range((last - first).days + 1)]
+    days = [d for d in days if os.path.exists(arrival_day_path(d))]
+    if len(days) > ARRIVALS_MAX_ATTACHED:
+        raise ValueError(f"{len(days)} days requested; query at most {ARRIVALS_MAX_ATTACHED} days at a time")
+    if not days:
+        columns = ", ".join(f"NULL AS {col}" for col in ARRIVAL_COLUMNS)
+        return f"(SELECT {columns} WHERE 0)"
+
+    wanted = {f"arr_{d:%Y%m%d}": d for d in days}
+    attached = {row[1] for row in conn.execute("PRAGMA database_list").fetchall()}
+    stale = [name for name in attached if name.startswith("arr_") and name not in wanted]
+    missing = [name for name in wanted if name not in attached]
+    attached_count = len([name for name in attached if name.startswith("arr_")])
+    for name in stale:
+        if attached_count + len(missing) <= ARRIVALS_MAX_ATTACHED:
+            break
+        conn.execute(f"DETACH DATABASE {name}")
+        attached_count -= 1
+    for name in missing:
+        conn.execute("ATTACH DATABASE ? AS " + name, (arrival_day_path(wanted[name]),))
+
+    columns = ", ".join(ARRIVAL_COLUMNS)
+    return "(" + " UNION ALL ".join(f"SELECT {columns} FROM {name}.bus_arrivals" for name in wanted) + ")"
+
+
+def iter_arrival_series(stop_code, service, since, until, chunk_size=5000):
+    """Yield (timestamp, eta_min) of one stop and service between `since` and `until`, oldest first.
+
+    Rows are fetched chunk_size at a time (a server-side cursor on
+    PostgreSQL, one day file after another on SQLite), so any range can be
+    streamed without holding it in memory or attaching more than one day.
+    """
+    since, until = since.strftime("%Y-%m-%d %H:%M:%S"), until.strftime("%Y-%m-%d %H:%M:%S")
+    if IS_PRODUCTION:
+        conn = get_bus_db_connection()
+        cursor = conn.cursor(name=f"series_{threading.get_ident()}")
+        cursor.itersize = chunk_size
+        try:
+            cursor.execute(ARRIVAL_SERIES_SQL.format(table="bus_arrivals", p="%s"), (stop_code, service, since, until))
+            for rows in _fetch_chunks(cursor, chunk_size):
+                yield from rows
+        finally:
+            cursor.close()
+            conn.rollback()
+            conn.close()
+        return
+
+    first, last = _as_day(since), _as_day(until)
+    for day in sqlite_arrival_days():
+        if not first <= day <= last:
+            continue
+        conn = sqlite3.connect(arrival_day_path(day), timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+        try:
+            cursor = conn.execute(ARRIVAL_SERIES_SQL.format(table="bus_arrivals", p="?"), (stop_code, service, since, until))
+            for rows in _fetch_chunks(cursor, chunk_size):
+                yield from rows
+        finally:
+            conn.close()
+
+
+def insert_arrivals(rows, wait=False):
+    """Insert (stop_code, service, eta_min, bus_type, timestamp) rows into bus_arrivals.
+
+    On SQLite rows are routed to their day's file through the writer thread.
+    Returns the last Future when wait=False.
+    """
+    rows = [(stop, service, eta, btype, ts.strftime("%Y-%m-%d %H:%M:%S") if isinstance(ts, datetime) else ts)
+            for stop, service, eta, btype, ts in rows]
+    rollups = _hourly_rollups(rows)
+    waits = _typical_wait_rows(rows)
+    if IS_PRODUCTION:
+        def write(conn):
+            cursor = conn.cursor()
+            copy_rows(cursor, "bus_arrivals", ARRIVAL_COLUMNS[1:], rows)
+            cursor.executemany(ROLLUP_UPSERT_SQL.replace("?", "%s"), rollups)
+            cursor.executemany(TYPICAL_WAIT_UPSERT_SQL.replace("?", "%s"), waits)
+            cursor.close()
+        return submit_write("bus", write, wait=wait)
+
+    by_day = {}
+    for row in rows:
+        by_day.setdefault(_as_day(row[4]), []).append(row)
+    for day, day_rows in by_day.items():
+        path = ensure_arrival_day(day)
+        _sqlite_writer.submit(path, lambda conn, day_rows=day_rows: conn.executemany("""
+            INSERT INTO bus_arrivals (stop_code, service, eta_min, bus_type, timestamp)
+            VALUES (?,?,?,?,?)
+        """, day_rows), wait=False)
+    # Queued after the raw rows, so a flush covers both
+    def write_aggregates(conn):
+        conn.executemany(ROLLUP_UPSERT_SQL, rollups)
+        conn.executemany(TYPICAL_WAIT_UPSERT_SQL, waits)
+    return _sqlite_writer.submit(BUS_DB_FILE, write_aggregates, wait=wait)
+
+
+# ---- Hourly rollups of bus_arrivals: (stop, service, hour) -> count, sum, sum of squares ----
+ROLLUP_UPSERT_SQL = """
+    INSERT INTO bus_arrival_rollups (stop_code, service, hour_start, sample_count, eta_sum, eta_sumsq)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (stop_code, service, hour_start) DO UPDATE SET
+        sample_count = bus_arrival_rollups.sample_count + excluded.sample_count,
+        eta_sum = bus_arrival_rollups.eta_sum + excluded.eta_sum,
+        eta_sumsq = bus_arrival_rollups.eta_sumsq + excluded.eta_sumsq
+"""
+
+
+def _hourly_rollups(rows):
+    """Fold arrival rows into (stop, service, hour_start, count, sum, sumsq) tuples."""
+    buckets = {}
+    for stop, service, eta, _, ts in rows:
+        if eta is None:
+            continue
+        key = (stop, service, ts[:13] + ":00:00")
+        count, total, total_sq = buckets.get(key, (0, 0.0, 0.0))
+        buckets[key] = (count + 1, total + eta, total_sq + eta * eta)
+    return [key + value for key, value in buckets.items()]
+
+
+def _backfill_sqlite_rollups(cursor):
+    """Migration: build rollups for the day files that already exist."""
+    for day in sqlite_arrival_days():
+        day_conn = sqlite3.connect(arrival_day_path(day))
+        rows = day_conn.execute("""
+            SELECT stop_code, service, substr(timestamp, 1, 13) || ':00:00', COUNT(*),
+                   SUM(eta_min), SUM(eta_min * eta_min)
+            FROM bus_arrivals
+            WHERE eta_min IS NOT NULL AND stop_code IS NOT NULL AND service IS NOT NULL
+            GROUP BY 1, 2, 3
+        """).fetchall()
+        day_conn.close()
+        cursor.executemany(ROLLUP_UPSERT_SQL, rows)
+
+
+# ---- Typical waits: (stop, service, weekday, hour) -> next-bus wait and headway per poll ----
+# One collector poll stores the ETAs of the next (up to) three buses of a
+# service at one timestamp: the smallest is the wait, the mean gap between
+# them the headway. Weekday is 1 = Sunday ... 7 = Saturday, as in the notebook.
+TYPICAL_WAIT_UPSERT_SQL = """
+    INSERT INTO bus_typical_waits (stop_code, service, weekday, hour, polls, wait_sum, headway_count, headway_sum)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (stop_code, service, weekday, hour) DO UPDATE SET
+        polls = bus_typical_waits.polls + excluded.polls,
+        wait_sum = bus_typical_waits.wait_sum + excluded.wait_sum,
+        headway_count = bus_typical_waits.headway_count + excluded.headway_count,
+        headway_sum = bus_typical_waits.headway_sum + excluded.headway_sum
+"""
+
+# Per poll, then per hour of week; {weekday} and {hour} are dialect expressions on timestamp
+TYPICAL_WAIT_SELECT_SQL = """
+    SELECT stop_code, service, {weekday}, {hour}, COUNT(*), SUM(wait),
+           COUNT(headway), COALESCE(SUM(headway), 0)
+    FROM (
+        SELECT stop_code, service, timestamp, MIN(eta_min) AS wait,
+               CASE WHEN COUNT(*) > 1 THEN (MAX(eta_min) - MIN(eta_min)) / (COUNT(*) - 1) END AS headway
+        FROM bus_arrivals
+        WHERE eta_min IS NOT NULL AND stop_code IS NOT NULL AND service IS NOT NULL AND timestamp IS NOT NULL
+        GROUP BY stop_code, service, timestamp
+    ) AS polls
+    GROUP BY 1, 2, 3, 4
+"""
+
+
+def _typical_wait_rows(rows):
+    """Fold arrival rows into (stop, service, weekday, hour, polls, wait sum, headways, headway sum) tuples."""
+    polls, weekdays = {}, {}
+    for stop, service, eta, _, ts in rows:
+        if eta is not None:
+            polls.setdefault((stop, service, ts), []).append(eta)
+    buckets = {}
+    for (stop, service, ts), etas in polls.items():
+        day = ts[:10]
+        if day not in weekdays:
+            weekdays[day] = date.fromisoformat(day).isoweekday() % 7 + 1
+        key = (stop, service, weekdays[day], int(ts[11:13]))
+        count, wait_sum, headways, headway_sum = buckets.get(key, (0, 0.0, 0, 0.0))
+        if len(etas) > 1:
+            headways, headway_sum = headways + 1, headway_sum + (max(etas) - min(etas)) / (len(etas) - 1)
+        buckets[key] = (count + 1, wait_sum + min(etas), headways, headway_sum)
+    return [key + value for key, value in buckets.items()]
+
+
+def _backfill_sqlite_typical_waits(cursor):
+    """Migration: build typical waits from the day files that already exist."""
+    select = TYPICAL_WAIT_SELECT_SQL.format(weekday="CAST(strftime('%w', timestamp) AS INTEGER) + 1",
+                                            hour="CAST(strftime('%H', timestamp) AS INTEGER)")
+    for day in sqlite_arrival_days():
+        day_conn = sqlite3.connect(arrival_day_path(day))
+        rows = day_conn.execute(select).fetchall()
+        day_conn.close()
+        cursor.executemany(TYPICAL_WAIT_UPSERT_SQL, rows)
+
+
+def read_typical_waits(stop_code):
+    """(service, weekday, hour, polls, wait_sum, headway_count, headway_sum) rows of one stop."""
+    param = "%s" if IS_PRODUCTION else "?"
+    conn = get_bus_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT service, weekday, hour, polls, wait_sum, headway_count, headway_sum
+        FROM bus_typical_waits WHERE stop_code = {param}
+    """, (stop_code,))
+    rows = [tuple(row.values()) if isinstance(row, dict) else tuple(row) for row in cursor.fetchall()]
+    cursor.close()
+    conn.close()
+    return rows
+
+
+def read_arrival_rollups(since, stop_code=None):
+    """Hourly rollup rows since `since`, optionally for one stop.
+
+    Returns (hour_start, service, sample_count, eta_sum, eta_sumsq) tuples;
+    with no stop_code, services are summed per hour and service is None.
+    """
+    since = since.strftime("%Y-%m-%d %H:00:00") if isinstance(since, datetime) else since
+    param = "%s" if IS_PRODUCTION else "?"
+    conn = get_bus_db_connection()
+    cursor = conn.cursor()
+    if stop_code is None:
+        cursor.execute(ROLLUPS_ALL_STOPS_SQL.format(p=param), (since,))
+    else:
+        cursor.execute(ROLLUPS_ONE_STOP_SQL.format(p=param), (stop_code, since))
+    rows = [tuple(row.values()) if isinstance(row, dict) else tuple(row) for row in cursor.fetchall()]
+    cursor.close()
+    conn.close()
+    return rows
+
+
+def expire_arrival_rollups(retention_days=ARRIVAL_ROLLUP_RETENTION_DAYS, today=None):
+    """Drop rollup hours older than the (longer) rollup retention window."""
+    cutoff = f"{(today or date.today()) - timedelta(days=retention_days):%Y-%m-%d} 00:00:00"
+    param = "%s" if IS_PRODUCTION else "?"
+    return submit_write("bus", lambda conn: conn.cursor().execute(
+        f"DELETE FROM bus_arrival_rollups WHERE hour_start < {param}", (cutoff,)))
+
+
+BUS_TRIP_COLUMNS = ("source_unit", "service", "direction", "trip_no", "service_date", "start_time", "end_time",
+                    "first_seq", "last_seq", "stops_observed", "observations", "payload")
+
+
+def write_bus_trips(unit, rows, arrivals, payload_bytes):
+    """Replace the trips of one arrivals partition and record it in bus_trip_units.
+
+    Delete, inserts and the unit row commit in one transaction, so readers see the
+    previous trips of the unit or the complete new set.
+    """
+    param = "%s" if IS_PRODUCTION else "?"
+    rows = [tuple(row) for row in rows]
+    unit_row = (unit, arrivals, len(rows), payload_bytes, time.time())
+    unit_sql = (f"INSERT INTO bus_trip_units (source_unit, arrivals, trips, payload_bytes, built_at) "
+                f"VALUES ({', '.join([param] * 5)}) ON CONFLICT (source_unit) DO UPDATE SET "
+                "arrivals = excluded.arrivals, trips = excluded.trips, "
+                "payload_bytes = excluded.payload_bytes, built_at = excluded.built_at")
+
+    def write(conn):
+        cursor = conn.cursor()
+        cursor.execute(f"DELETE FROM bus_trips WHERE source_unit = {param}", (unit,))
+        if IS_PRODUCTION:
+            copy_rows(cursor, "bus_trips", BUS_TRIP_COLUMNS, rows)
+        else:
+            insert_sql = (f"INSERT INTO bus_trips ({', '.join(BUS_TRIP_COLUMNS)}) "
+                          f"VALUES ({', '.join('?' for _ in BUS_TRIP_COLUMNS)})")
+            for start in range(0, len(rows), DB_BULK_BATCH_ROWS):
+                cursor.executemany(insert_sql, rows[start:start + DB_BULK_BATCH_ROWS])
+        cursor.execute(unit_sql, unit_row)
+        cursor.close()
+        return len(rows)
+    return submit_write("bus", write)
+
+
+def expire_bus_trips():
+    """Drop the trips of arrivals partitions that no longer exist (archived by expire_arrival_partitions)."""
+    if IS_PRODUCTION:
+        conn = get_bus_db_connection(role="primary")
+        cursor = conn.cursor()
+        # The default partition is never dropped, so trips built from it by hand stay
+        units = [name for name, _, _ in _pg_arrival_partitions(cursor)] + ["bus_arrivals_default"]
+        cursor.close()
+        conn.close()
+    else:
+        units = [f"{day:%Y%m%d}" for day in sqlite_arrival_days()]
+    param = "%s" if IS_PRODUCTION else "?"
+    keep = f" WHERE source_unit NOT IN ({', '.join([param] * len(units))})" if units else ""
+
+    def write(conn):
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM bus_trips" + keep, units)
+        removed = cursor.rowcount
+        cursor.execute("DELETE FROM bus_trip_units" + keep, units)
+        cursor.close()
+        return removed
+    return submit_write("bus", write)
+
+
+def _split_sqlite_arrivals(conn):
+    """Migration: move rows of the old single bus_arrivals table into day files."""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='bus_arrivals'"
+    ).fetchone()
+    if not exists:
+        return
+    conn.commit()
+    days = [row[0] for row in conn.execute(
+        "SELECT DISTINCT substr(timestamp, 1, 10) FROM bus_arrivals WHERE timestamp IS NOT NULL"
+    ).fetchall()]
+    for day in days:
+        conn.execute("ATTACH DATABASE ? AS migrate_day", (ensure_arrival_day(day),))
+        # A run interrupted after this day was copied must not copy it twice;
+        # the collector only starts once migrations are done, so the day file
+        # holds nothing but the rows copied here.
+        conn.execute("DELETE FROM migrate_day.bus_arrivals WHERE substr(timestamp, 1, 10) = ?", (day,))
+        conn.execute("""
+            INSERT INTO migrate_day.bus_arrivals (stop_code, service, eta_min, bus_type, timestamp)
+            SELECT stop_code, service, eta_min, bus_type, timestamp FROM bus_arrivals
+            WHERE substr(timestamp, 1, 10) = ? ORDER BY timestamp
+        """, (day,))
+        conn.commit()
+        conn.execute("DETACH DATABASE migrate_day")
+    # Rows without a timestamp belong to no day file; archive them like an expired day
+    untimed = conn.execute("SELECT COUNT(*) FROM bus_arrivals WHERE timestamp IS NULL").fetchone()[0]
+    if untimed:
+        archive = _archive_path("untimed")
+        _write_sqlite_archive(archive, conn.execute(
+            f"SELECT {', '.join(ARRIVAL_COLUMNS)} FROM bus_arrivals WHERE timestamp IS NULL ORDER BY id"))
+        print(f"📦 Archived {untimed} bus_arrivals rows without a timestamp to {archive}")
+    conn.execute("DROP TABLE bus_arrivals")
+    print(f"✅ Moved bus_arrivals into {len(days)} daily files")
+
+
+def _pg_fetch_value(cursor):
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return list(row.values())[0] if isinstance(row, dict) else row[0]
+
+
+def _partition_pg_arrivals(cursor):
+    """Migration: turn the plain bus_arrivals table into a range-partitioned one.
+
+    Existing rows stay where they are: the old table is attached as a single
+    partition covering everything up to tomorrow, and is archived/dropped by
+    retention like any other partition once it ages out.
+    """
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('bus_arrivals')")
+    if _pg_fetch_value(cursor) == "p":
+        return
+    boundary = date.today() + timedelta(days=1)
+    cursor.execute("ALTER TABLE bus_arrivals RENAME TO bus_arrivals_legacy")
+    cursor.execute("ALTER INDEX IF EXISTS idx_bus_arrivals_stop_service_ts RENAME TO idx_bus_arrivals_legacy_stop_service_ts")
+    cursor.execute("ALTER INDEX IF EXISTS idx_bus_arrivals_timestamp RENAME TO idx_bus_arrivals_legacy_timestamp")
+    # The id sequence must outlive the legacy partition
+    cursor.execute("ALTER SEQUENCE IF EXISTS bus_arrivals_id_seq OWNED BY NONE")
+    cursor.execute("""
+        CREATE TABLE bus_arrivals (LIKE bus_arrivals_legacy INCLUDING DEFAULTS)
+        PARTITION BY RANGE (timestamp)
+    """)
+    cursor.execute("CREATE TABLE bus_arrivals_default PARTITION OF bus_arrivals DEFAULT")
+    # Range partitions cannot hold NULL keys; those rows belong in the default partition
+    cursor.execute("INSERT INTO bus_arrivals_default SELECT * FROM bus_arrivals_legacy WHERE timestamp IS NULL")
+    cursor.execute("DELETE FROM bus_arrivals_legacy WHERE timestamp IS NULL")
+    cursor.execute(
+        "ALTER TABLE bus_arrivals ATTACH PARTITION bus_arrivals_legacy "
+        f"FOR VALUES FROM (MINVALUE) TO ('{boundary.isoformat()}')"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bus_arrivals_stop_service_ts ON bus_arrivals(stop_code, service, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bus_arrivals_timestamp ON bus_arrivals(timestamp)")
+
+
+def _pg_arrival_partitions(cursor):
+    """(name, lower, upper) for each bounded partition; None means unbounded."""
+    cursor.execute("""
+        SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass('bus_arrivals')
+    """)
+    partitions = []
+    for row in cursor.fetchall():
+        name, bound = (row["name"], row["bound"]) if isinstance(row, dict) else row
+        match = re.search(r"FROM \((.+?)\) TO \((.+?)\)", bound or "")
+        if not match:
+            continue  # the DEFAULT partition
+        lower, upper = (None if v == "MINVALUE" else datetime.fromisoformat(v.strip("'"))
+                        for v in match.groups())
+        partitions.append((name, lower, upper))
+    return partitions
+
+
+def ensure_arrival_partitions(days_ahead=ARRIVALS_PARTITIONS_AHEAD, today=None):
+    """Make sure today's and the next few days' partitions exist."""
+    today = today or date.today()
+    days = [today + timedelta(days=n) for n in range(days_ahead + 1)]
+    if not IS_PRODUCTION:
+        for day in days:
+            ensure_arrival_day(day)
+        return
+
+    conn = get_bus_db_connection(role="primary")
+    cursor = conn.cursor()
+    try:
+        existing = _pg_arrival_partitions(cursor)
+        for day in days:
+            start = datetime.combine(day, datetime.min.time())
+            end = start + timedelta(days=1)
+            if any((lower is None or lower < end) and (upper is None or upper > start)
+                   for _, lower, upper in existing):
+                continue
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS bus_arrivals_p{day:%Y%m%d} PARTITION OF bus_arrivals "
+                f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def _archive_path(label):
+    os.makedirs(ARRIVALS_ARCHIVE_DIR, exist_ok=True)
+    suffix = "parquet" if ARRIVALS_ARCHIVE_FORMAT == "parquet" else "csv.gz"
+    return os.path.join(ARRIVALS_ARCHIVE_DIR, f"bus_arrivals_{label}.{suffix}")
+
+
+def _write_sqlite_archive(archive, rows):
+    """Write bus_arrivals rows from a SQLite cursor to `archive` in ARRIVALS_ARCHIVE_FORMAT."""
+    if ARRIVALS_ARCHIVE_FORMAT == "parquet":
+        from columnar import write_arrival_archive
+        write_arrival_archive(archive, _fetch_chunks(rows))
+        return
+    with gzip.open(archive + ".tmp", "wt", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(ARRIVAL_COLUMNS)
+        writer.writerows(rows)
+    os.replace(archive + ".tmp", archive)
+
+
+def _fetch_chunks(cursor, size=50000):
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield [tuple(row.values()) if isinstance(row, dict) else tuple(row) for row in rows]
+
+
+def expire_arrival_partitions(retention_days=ARRIVALS_RETENTION_DAYS, today=None):
+    """Archive partitions older than the retention window, then drop them.
+
+    Archives are .csv.gz, or Parquet with BUS_ARRIVALS_ARCHIVE_FORMAT=parquet.
+    Returns the archive files written.
+    """
+    cutoff = datetime.combine((today or date.today()) - timedelta(days=retention_days), datetime.min.time())
+    archived = []
+    if ARRIVALS_ARCHIVE_FORMAT == "parquet":
+        from columnar import write_arrival_archive
+
+    if not IS_PRODUCTION:
+        for day in sqlite_arrival_days():
+            if datetime.combine(day, datetime.min.time()) >= cutoff:
+                break
+            path, archive = arrival_day_path(day), _archive_path(f"{day:%Y-%m-%d}")
+            conn = sqlite3.connect(path)
+            _write_sqlite_archive(archive, conn.execute(
+                f"SELECT {', '.join(ARRIVAL_COLUMNS)} FROM bus_arrivals ORDER BY timestamp"))
+            conn.close()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            archived.append(archive)
+        return archived
+
+    conn = get_bus_db_connection(role="primary")
+    cursor = conn.cursor()
+    try:
+        for name, lower, upper in sorted(_pg_arrival_partitions(cursor), key=lambda p: p[2]):
+            if upper is None or upper > cutoff:
+                continue
+            label = f"{upper - timedelta(days=1):%Y-%m-%d}" if lower else f"until_{upper:%Y-%m-%d}"
+            archive = _archive_path(label)
+            if ARRIVALS_ARCHIVE_FORMAT == "parquet":
+                # Server-side cursor, so the partition is streamed one row group at a time
+                rows = conn.cursor(name=f"archive_{name}")
+                rows.execute(f"SELECT {', '.join(ARRIVAL_COLUMNS)} FROM {name} ORDER BY timestamp")
+                write_arrival_archive(archive, _fetch_chunks(rows))
+                rows.close()
+            else:
+                with gzip.open(archive + ".tmp", "wb") as f:
+                    cursor.copy_expert(f"COPY (SELECT * FROM {name} ORDER BY timestamp) TO STDOUT WITH CSV HEADER", f)
+                os.replace(archive + ".tmp", archive)
+            cursor.execute(f"ALTER TABLE bus_arrivals DETACH PARTITION {name}")
+            cursor.execute(f"DROP TABLE {name}")
+            conn.commit()
+            archived.append(archive)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+    return archived
+
+
+def maintain_arrival_partitions():
+    """Create upcoming partitions, archive/drop expired ones and prune old rollups."""
+    ensure_arrival_partitions()
+    for archive in expire_arrival_partitions():
+        print(f"📦 Archived expired bus_arrivals partition to {archive}")
+    expire_arrival_rollups()
+    removed = expire_bus_trips()
+    if removed:
+        print(f"🗑️ Removed {removed} trips of expired bus_arrivals partitions")
 
 
 # Initialize both databases when module is imported
 if __name__ == "__main__":
+    import sys
+
     print("🚀 Initializing databases...")
     print(f"Environment: {'Production (AWS)' if IS_PRODUCTION else 'Development (Local)'}")
     init_users_db()
     init_bus_db()
-    print("✅ All databases initialized successfully!")
\ No newline at end of file
+    print("✅ All databases initialized successfully!")
+
+    # python database.py --check-plans  -> non-zero exit if a hot query full-scans
+    if "--check-plans" in sys.argv:
+        regressions = check_query_plans()
+        if regressions:
+            print(f"❌ {len(regressions)} hot query plan(s) regressed to a full scan")
+            sys.exit(1)
+        print("✅ All hot queries use an index")
\ No newline at end of file
@@ -0,0 +1,417 @@
+"""
+delay_model.py
+--------------
+Delay-risk classifier from notebook step 7, trained locally and served from
+memory.
+
+The notebook labels an arrival "delayed" when its ETA is above the median
+ETA of its service and fits a RandomForest (50 trees, depth 8) on
+prev_eta_minutes, hour, minute, weekday, bus_stop and service_index. This
+module trains the same forest with numpy on the bus database (histogram
+splits over at most MAX_BINS thresholds per feature, Poisson bootstrap,
+sqrt(features) per split) and exports it as a small JSON file of flat
+per-tree arrays, so serving needs neither Spark nor scikit-learn.
+
+Scoring walks every tree for every row at once: one numpy step per level,
+so a batch of arrivals costs max_depth vector operations. Scores are cached
+per feature tuple and the model is reloaded when its file changes.
+
+Usage:
+    python delay_model.py train [--days 14] [--max-rows 2000000] [--trees 50] [--depth 8] [--out PATH]
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+
+from analytics_pipeline import arrival_units, read_unit
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_FILE = os.getenv("DELAY_MODEL_FILE", os.path.join(BASE_DIR, "database/delay_model.json"))
+MODEL_VERSION = 1
+FEATURES = ("prev_eta_minutes", "hour", "minute", "weekday", "bus_stop", "service_index")
+MAX_BINS = 32
+MIN_LEAF = 20
+PREDICTION_CACHE_SIZE = 20000
+SG_TZ = timezone(timedelta(hours=8))
+
+
+def _spark_weekday(day):
+    return day.isoweekday() % 7 + 1
+
+
+def _stop_number(stop):
+    """bus_stop cast to double, as in the notebook (non-numeric codes become 0)."""
+    try:
+        return float(stop)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+# ---- Training ----
+class Reservoir:
+    """Uniform sample of at most `size` training rows from a stream (Algorithm R, one chunk at a time)."""
+
+    def __init__(self, size, rng):
+        self.size, self.rng, self.seen = size, rng, 0
+        self.services = np.empty(size, dtype=object)
+        self.features = np.empty((size, len(FEATURES) - 1), dtype=np.float64)
+        self.etas = np.empty(size, dtype=np.float64)
+
+    def add(self, services, features, etas):
+        n, start = len(etas), self.seen
+        self.seen += n
+        fill = max(0, min(n, self.size - start))
+        if fill:
+            self.services[start:start + fill] = services[:fill]
+            self.features[start:start + fill] = features[:fill]
+            self.etas[start:start + fill] = etas[:fill]
+        if n == fill:
+            return
+        # Row k of the stream replaces a random slot with probability size / (k + 1)
+        slots = self.rng.integers(0, np.arange(start + fill, start + n) + 1)
+        rows = np.nonzero(slots < self.size)[0]
+        slots = slots[rows]
+        # A slot hit twice keeps the later row, as the sequential algorithm would
+        last = len(slots) - 1 - np.unique(slots[::-1], return_index=True)[1]
+        rows, slots = rows[last] + fill, slots[last]
+        self.services[slots] = np.array(services, dtype=object)[rows]
+        self.features[slots] = np.array(features, dtype=np.float64)[rows]
+        self.etas[slots] = np.array(etas, dtype=np.float64)[rows]
+
+    def rows(self):
+        n = min(self.seen, self.size)
+        return list(self.services[:n]), self.features[:n], self.etas[:n]
+
+
+def load_training_rows(days, max_rows, chunk_size=50000, seed=42):
+    """(services, features without service_index, eta) sampled from the newest `days` arrival partitions.
+
+    Lags are computed over every row, but only a uniform sample of max_rows is kept,
+    so memory does not grow with the amount of history.
+    """
+    units = [unit for unit, _ in arrival_units()][-days:]
+    sample = Reservoir(max_rows, np.random.default_rng(seed))
+    last_eta, weekdays = {}, {}
+    for unit in units:
+        for rows in read_unit(unit, 0, chunk_size):
+            services, features, etas = [], [], []
+            for _, stop, service, eta, ts in rows:
+                if stop is None or service is None:
+                    continue
+                ts = str(ts)
+                day = ts[:10]
+                if day not in weekdays:
+                    weekdays[day] = _spark_weekday(date.fromisoformat(day))
+                key = (stop, service)
+                # Notebook: lag over (bus_stop, service) ordered by time, nulls filled with 0
+                features.append((last_eta.get(key, 0.0), int(ts[11:13]), int(ts[14:16]), weekdays[day],
+                                 _stop_number(stop)))
+                last_eta[key] = eta
+                services.append(service)
+                etas.append(eta)
+            if etas:
+                sample.add(services, features, etas)
+        print(f"📥 {unit}: {sample.seen} arrivals so far")
+    return sample.rows()
+
+
+def service_labels(services):
+    """StringIndexer order: most frequent service first."""
+    values, counts = np.unique(np.array(services, dtype=object), return_counts=True)
+    return [str(v) for v in values[np.lexsort((values, -counts))]]
+
+
+def delayed_labels(services, etas):
+    """1 where the ETA is above its service's median (percentile_approx 0.5)."""
+    services = np.array(services, dtype=object)
+    labels = np.zeros(len(etas), dtype=np.float64)
+    for service in np.unique(services):
+        mask = services == service
+        median = np.quantile(etas[mask], 0.5, method="inverted_cdf")
+        labels[mask] = etas[mask] > median
+    return labels
+
+
+def _thresholds(column):
+    """Up to MAX_BINS - 1 quantile split points of one feature."""
+    points = np.unique(np.quantile(column, np.linspace(0, 1, MAX_BINS + 1)[1:-1]))
+    return points[points < column.max()]
+
+
+def _gini_gain(pos, total):
+    """Best split over cumulative bins; returns (bin, impurity decrease x weight) or (None, 0)."""
+    left_n, left_p = np.cumsum(total)[:-1], np.cumsum(pos)[:-1]
+    all_n, all_p = total.sum(), pos.sum()
+    right_n, right_p = all_n - left_n, all_p - left_p
+    valid = (left_n >= MIN_LEAF) & (right_n >= MIN_LEAF)
+    if not valid.any():
+        return None, 0.0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        left_gini = 2 * left_p * (left_n - left_p) / left_n
+        right_gini = 2 * right_p * (right_n - right_p) / right_n
+    gain = 2 * all_p * (all_n - all_p) / all_n - left_gini - right_gini
+    gain[~valid] = -np.inf
+    best = int(np.argmax(gain))
+    return (best, float(gain[best])) if gain[best] > 1e-9 else (None, 0.0)
+
+
+def build_tree(binned, thresholds, labels, weights, max_depth, rng):
+    """One CART tree on pre-binned features; returns the flat arrays of the exported format."""
+    n_features = binned.shape[1]
+    per_split = max(1, int(round(np.sqrt(n_features))))
+    tree = {"feature": [], "threshold": [], "left": [], "right": [], "value": []}
+
+    def add_node(value):
+        for name, default in (("feature", -1), ("threshold", 0.0), ("left", -1), ("right", -1)):
+            tree[name].append(default)
+        tree["value"].append(round(value, 4))
+        return len(tree["value"]) - 1
+
+    stack = [(np.flatnonzero(weights), 0, None)]
+    while stack:
+        rows, depth, slot = stack.pop()
+        w = weights[rows]
+        pos_weight = float(np.dot(w, labels[rows]))
+        node = add_node(pos_weight / w.sum())
+        if slot is not None:
+            tree[slot[0]][slot[1]] = node
+        if depth >= max_depth or pos_weight in (0.0, float(w.sum())):
+            continue
+        best = (None, None, 0.0)
+        for feature in rng.choice(n_features, per_split, replace=False):
+            size = len(thresholds[feature]) + 1
+            bins = binned[rows, feature]
+            split, gain = _gini_gain(np.bincount(bins, weights=w * labels[rows], minlength=size),
+                                     np.bincount(bins, weights=w, minlength=size))
+            if split is not None and gain > best[2]:
+                best = (feature, split, gain)
+        feature, split, _ = best
+        if feature is None:
+            continue
+        tree["feature"][node] = int(feature)
+        tree["threshold"][node] = float(thresholds[feature][split])
+        goes_left = binned[rows, feature] <= split
+        stack.append((rows[~goes_left], depth + 1, ("right", node)))
+        stack.append((rows[goes_left], depth + 1, ("left", node)))
+    return tree
+
+
+def train_forest(X, y, trees, max_depth, seed=42):
+    rng = np.random.default_rng(seed)
+    thresholds = [_thresholds(X[:, f]) for f in range(X.shape[1])]
+    # x <= thresholds[k] exactly when its bin is <= k
+    binned = np.column_stack([np.searchsorted(t, X[:, f], side="left") for f, t in enumerate(thresholds)])
+    binned = binned.astype(np.int32)
+    forest = []
+    for i in range(trees):
+        weights = rng.poisson(1.0, len(y)).astype(np.float64)
+        forest.append(build_tree(binned, thresholds, y, weights, max_depth, rng))
+        print(f"🌲 tree {i + 1}/{trees}: {len(forest[-1]['value'])} nodes")
+    return forest
+
+
+def auc(scores, labels):
+    """Area under the ROC curve (Mann-Whitney, ties averaged)."""
+    order = np.argsort(scores, kind="mergesort")
+    ranks = np.empty(len(scores))
+    sorted_scores = scores[order]
+    # Average ranks over tied scores
+    starts = np.r_[0, np.flatnonzero(np.diff(sorted_scores)) + 1]
+    ends = np.r_[starts[1:], len(scores)]
+    for start, end in zip(starts, ends):
+        ranks[order[start:end]] = (start + end + 1) / 2
+    positives = labels.sum()
+    negatives = len(labels) - positives
+    if not positives or not negatives:
+        return None
+    return float((ranks[labels == 1].sum() - positives * (positives + 1) / 2) / (positives * negatives))
+
+
+def train(days=14, max_rows=2000000, trees=50, max_depth=8, out=MODEL_FILE, seed=42):
+    services, X, etas = load_training_rows(days, max_rows, seed=seed)
+    if len(etas) < 2 * MIN_LEAF:
+        raise SystemExit(f"❌ Only {len(etas)} arrivals in the last {days} days, not enough to train")
+    labels = service_labels(services)
+    index = {service: i for i, service in enumerate(labels)}
+    X = np.column_stack([X, [index[s] for s in services]])
+    y = delayed_labels(services, etas)
+
+    # 70/30 split as in the notebook
+    rng = np.random.default_rng(seed)
+    is_train = rng.random(len(y)) < 0.7
+    t0 = time.time()
+    forest = train_forest(X[is_train], y[is_train], trees, max_depth, seed)
+    model = DelayModel({"version": MODEL_VERSION, "features": list(FEATURES), "services": labels,
+                        "max_depth": max_depth, "trees": forest})
+    test_auc = auc(model.predict(X[~is_train]), y[~is_train]) if (~is_train).any() else None
+    model.meta.update(trained_at=datetime.now(SG_TZ).isoformat(timespec="seconds"), rows=int(len(y)),
+                      delayed_share=round(float(y.mean()), 4), test_auc=test_auc and round(test_auc, 4))
+    save_model(model.meta, out)
+    print(f"✅ {trees} trees trained on {int(is_train.sum())} arrivals in {time.time() - t0:.1f}s, "
+          f"test AUC {test_auc if test_auc is None else round(test_auc, 4)} -> {out} "
+          f"({os.path.getsize(out) / 1024:.0f} KiB)")
+    return model
+
+
+def save_model(payload, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(payload, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+# ---- Serving ----
+class DelayModel:
+    """An exported forest with every tree packed into shared node arrays."""
+
+    def __init__(self, payload):
+        self.meta = payload
+        self.service_index = {service: i for i, service in enumerate(payload["services"])}
+        self.max_depth = payload["max_depth"]
+        feature, threshold, left, right, value, roots = [], [], [], [], [], []
+        for tree in payload["trees"]:
+            offset = len(value)
+            roots.append(offset)
+            feature.extend(tree["feature"])
+            threshold.extend(tree["threshold"])
+            left.extend(l + offset if l >= 0 else -1 for l in tree["left"])
+            right.extend(r + offset if r >= 0 else -1 for r in tree["right"])
+            value.extend(tree["value"])
+        self.feature = np.array(feature, dtype=np.int64)
+        self.is_leaf = self.feature < 0
+        self.feature[self.is_leaf] = 0
+        self.threshold = np.array(threshold, dtype=np.float64)
+        self.left = np.array(left, dtype=np.int64)
+        self.right = np.array(right, dtype=np.int64)
+        self.value = np.array(value, dtype=np.float64)
+        self.roots = np.array(roots, dtype=np.int64)
+
+    def encode_service(self, service):
+        # StringIndexer handleInvalid="keep": unseen services share the last index
+        return self.service_index.get(str(service), len(self.service_index))
+
+    def predict(self, X):
+        """Probability of a delay for each row of the (n, len(FEATURES)) matrix X."""
+        X = np.asarray(X, dtype=np.float64)
+        if not len(X):
+            return np.zeros(0)
+        rows = np.arange(len(X))
+        nodes = np.repeat(self.roots[:, None], len(X), axis=1)  # (trees, rows)
+        for _ in range(self.max_depth):
+            leaf = self.is_leaf[nodes]
+            if leaf.all():
+                break
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(leaf, nodes, np.where(go_left, self.left[nodes], self.right[nodes]))
+        return self.value[nodes].mean(axis=0)
+
+
+_model = {"mtime": None, "model": None}
+_model_lock = threading.Lock()
+_predictions = OrderedDict()
+_predictions_lock = threading.Lock()
+
+
+def get_model(path=MODEL_FILE):
+    """The exported model, reloaded when the file changes; None until one has been trained."""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with _model_lock:
+        if _model["mtime"] != mtime:
+            with open(path) as f:
+                payload = json.load(f)
+            if payload.get("version") != MODEL_VERSION:
+                print(f"⚠️ {path} has an unsupported model version, retrain it")
+                return None
+            _model.update(mtime=mtime, model=DelayModel(payload))
+            with _predictions_lock:
+                _predictions.clear()
+            print(f"🌲 Delay model loaded ({len(payload['trees'])} trees, trained {payload.get('trained_at')})")
+        return _model["model"]
+
+
+def feature_row(model, service, stop, hour=None, minute=None, weekday=None, prev_eta=None, now=None):
+    """Feature tuple for one arrival; time fields default to now in Singapore."""
+    now = now or datetime.now(SG_TZ)
+    return (
+        round(float(prev_eta), 1) if prev_eta is not None else 0.0,
+        int(hour) if hour is not None else now.hour,
+        int(minute) if minute is not None else now.minute,
+        int(weekday) if weekday is not None else _spark_weekday(now),
+        _stop_number(stop),
+        model.encode_service(service),
+    )
+
+
+def score(model, rows):
+    """Delay probabilities for a list of feature tuples, scoring only the ones not cached."""
+    results, missing = [None] * len(rows), {}
+    with _predictions_lock:
+        for i, row in enumerate(rows):
+            cached = _predictions.get(row)
+            if cached is None:
+                missing.setdefault(row, []).append(i)
+            else:
+                _predictions.move_to_end(row)
+                results[i] = cached
+    if missing:
+        keys = list(missing)
+        for key, probability in zip(keys, model.predict(keys).tolist()):
+            for i in missing[key]:
+                results[i] = probability
+        with _predictions_lock:
+            for key, probability in zip(keys, (results[missing[k][0]] for k in keys)):
+                _predictions[key] = probability
+            while len(_predictions) > PREDICTION_CACHE_SIZE:
+                _predictions.popitem(last=False)
+    return results
+
+
+def risk_level(probability):
+    if probability >= 0.7:
+        return "high"
+    if probability >= 0.4:
+        return "medium"
+    return "low"
+
+
+def delay_risks(items, now=None):
+    """{"probability", "risk"} for each item dict (service, stop, optional hour/minute/weekday/eta).
+
+    Returns None when no model has been trained.
+    """
+    model = get_model()
+    if model is None:
+        return None
+    now = now or datetime.now(SG_TZ)
+    rows = [feature_row(model, item["service"], item["stop"], item.get("hour"), item.get("minute"),
+                        item.get("weekday"), item.get("eta"), now) for item in items]
+    return [{"probability": round(p, 3), "risk": risk_level(p)} for p in score(model, rows)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    cmd = sub.add_parser("train", help="train on the newest arrival partitions and export the model")
+    cmd.add_argument("--days", type=int, default=14)
+    cmd.add_argument("--max-rows", type=int, default=2000000, help="evenly sample down to this many arrivals")
+    cmd.add_argument("--trees", type=int, default=50)
+    cmd.add_argument("--depth", type=int, default=8)
+    cmd.add_argument("--seed", type=int, default=42)
+    cmd.add_argument("--out", default=MODEL_FILE)
+    args = parser.parse_args()
+    train(args.days, args.max_rows, args.trees, args.depth, args.out, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+downsample.py
+-------------
+Server-side downsampling of long (time, value) series for Chart.js.
+
+Both modes consume the points as a stream and keep O(points) state:
+
+  * minmax: the time range is cut into points / 2 equal buckets and each
+    bucket keeps only its lowest and highest value, so spikes survive.
+  * lttb: MinMax-LTTB. The stream is first min/max-bucketed to
+    LTTB_PRESELECT times the requested count, then Largest-Triangle-Three-
+    Buckets picks the final points from those candidates. This gives LTTB's
+    shape-preserving choice without keeping the raw series.
+"""
+
+LTTB_PRESELECT = 4
+
+
+class MinMaxBuckets:
+    """Streaming min/max per time bucket over [start, end] (epoch seconds)."""
+
+    def __init__(self, start, end, buckets):
+        self.start = start
+        self.buckets = max(1, buckets)
+        self.width = max(end - start, 1e-9) / self.buckets
+        self.slots = {}   # bucket -> [min_t, min_y, max_t, max_y]
+        self.count = 0
+
+    def add(self, t, y):
+        self.count += 1
+        index = min(max(int((t - self.start) / self.width), 0), self.buckets - 1)
+        slot = self.slots.get(index)
+        if slot is None:
+            self.slots[index] = [t, y, t, y]
+            return
+        if y < slot[1]:
+            slot[0], slot[1] = t, y
+        if y > slot[3]:
+            slot[2], slot[3] = t, y
+
+    def points(self):
+        """Kept points in time order (one per bucket when its min and max coincide)."""
+        points = []
+        for index in sorted(self.slots):
+            min_t, min_y, max_t, max_y = self.slots[index]
+            if (min_t, min_y) == (max_t, max_y):
+                points.append((min_t, min_y))
+            else:
+                points.extend(sorted(((min_t, min_y), (max_t, max_y))))
+        return points
+
+
+def lttb(points, threshold):
+    """Largest-Triangle-Three-Buckets on a time-ordered list of (t, y)."""
+    if threshold >= len(points) or threshold < 3:
+        return list(points)
+    sampled = [points[0]]
+    every = (len(points) - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third triangle vertex
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, len(points))
+        span = points[next_start:next_end]
+        avg_t = sum(p[0] for p in span) / len(span)
+        avg_y = sum(p[1] for p in span) / len(span)
+
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        at, ay = points[a]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            t, y = points[j]
+            area = abs((at - avg_t) * (y - ay) - (at - t) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+    return sampled
+
+
+def downsample(stream, start, end, points, mode="lttb"):
+    """Reduce a time-ordered stream of (t, y) in [start, end] to about `points` points.
+
+    Returns (points, raw count).
+    """
+    if mode == "minmax":
+        buckets = MinMaxBuckets(start, end, points // 2)
+    else:
+        buckets = MinMaxBuckets(start, end, points * LTTB_PRESELECT // 2)
+    for t, y in stream:
+        buckets.add(t, y)
+    kept = buckets.points()
+    if mode != "minmax":
+        kept = lttb(kept, points)
+    return kept, buckets.count
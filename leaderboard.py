@@ -0,0 +1,295 @@
+"""
+leaderboard.py
+--------------
+Live worst-services leaderboard, maintained by the arrivals collector as it
+stores ETAs (a live counterpart of the notebook's top10_worst.csv).
+
+Per service the collector keeps per-minute buckets of the last
+LEADERBOARD_WINDOW_MINUTES, from which come
+  * rolling drift (mean ETA change between consecutive stored ETAs of the
+    same stop and service) and volatility (mean |change|), over the long
+    window and the last LEADERBOARD_RECENT_MINUTES,
+  * the recent mean ETA, z-scored against the service's own hour-of-week
+    baseline (avg_by_service_hour, falling back to avg_by_hour).
+
+Services sit in two indexed max-heaps, by drift and by |z|, so each stored
+arrival costs O(log n) and the top k is read in O(k log k). Every collector
+saves its top entries to collector_leaderboard after each cycle; readers
+merge the fresh shards.
+"""
+
+import heapq
+import json
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from database import IS_PRODUCTION, get_bus_db_connection, bulk_write
+from live_stats import LIVE_STATS_SHARD
+
+LEADERBOARD_WINDOW_MINUTES = 60
+LEADERBOARD_RECENT_MINUTES = 15
+LEADERBOARD_MIN_CHANGES = 3        # drift samples before a service is ranked
+LEADERBOARD_SIZE = 10
+LEADERBOARD_STALE_SECONDS = 900    # shards not updated for this long are ignored
+LEADERBOARD_READ_TTL = 30
+ANOMALY_Z = 2.0
+ANOMALY_MIN_SAMPLES = 5
+
+
+class IndexedHeap:
+    """Max-heap of key -> score with O(log n) update and removal of any key."""
+
+    def __init__(self):
+        self.heap = []        # [score, key]
+        self.position = {}    # key -> index in heap
+
+    def __len__(self):
+        return len(self.heap)
+
+    def _swap(self, i, j):
+        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+        self.position[self.heap[i][1]] = i
+        self.position[self.heap[j][1]] = j
+
+    def _up(self, i):
+        while i and self.heap[i][0] > self.heap[(i - 1) // 2][0]:
+            self._swap(i, (i - 1) // 2)
+            i = (i - 1) // 2
+
+    def _down(self, i):
+        size = len(self.heap)
+        while True:
+            largest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < size and self.heap[child][0] > self.heap[largest][0]:
+                    largest = child
+            if largest == i:
+                return
+            self._swap(i, largest)
+            i = largest
+
+    def update(self, key, score):
+        i = self.position.get(key)
+        if i is None:
+            self.heap.append([score, key])
+            self.position[key] = len(self.heap) - 1
+            self._up(len(self.heap) - 1)
+            return
+        previous, self.heap[i][0] = self.heap[i][0], score
+        self._up(i) if score > previous else self._down(i)
+
+    def remove(self, key):
+        i = self.position.pop(key, None)
+        if i is None:
+            return
+        last = self.heap.pop()
+        if i < len(self.heap):
+            self.heap[i] = last
+            self.position[last[1]] = i
+            self._up(i)
+            self._down(self.position[last[1]])
+
+    def top(self, k):
+        """The k highest (key, score), best first, without touching the heap."""
+        result, frontier = [], [(-self.heap[0][0], 0)] if self.heap else []
+        while frontier and len(result) < k:
+            score, i = heapq.heappop(frontier)
+            result.append((self.heap[i][1], -score))
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(self.heap):
+                    heapq.heappush(frontier, (-self.heap[child][0], child))
+        return result
+
+
+class ServiceWindow:
+    """Per-minute [minute, etas, eta sum, changes, change sum, |change| sum] buckets of one service."""
+
+    __slots__ = ("buckets", "totals")
+
+    def __init__(self):
+        self.buckets = deque()
+        self.totals = [0, 0.0, 0, 0.0, 0.0]
+
+    def add(self, minute, eta, change):
+        if not self.buckets or self.buckets[-1][0] != minute:
+            self.buckets.append([minute, 0, 0.0, 0, 0.0, 0.0])
+        values = (1, eta, 0, 0.0, 0.0) if change is None else (1, eta, 1, change, abs(change))
+        bucket = self.buckets[-1]
+        for i, value in enumerate(values):
+            bucket[i + 1] += value
+            self.totals[i] += value
+
+    def evict(self, minute):
+        """Drop buckets older than the window ending at `minute`."""
+        while self.buckets and self.buckets[0][0] <= minute - LEADERBOARD_WINDOW_MINUTES:
+            for i, value in enumerate(self.buckets.popleft()[1:]):
+                self.totals[i] -= value
+
+    def recent(self, minute):
+        """Totals over the last LEADERBOARD_RECENT_MINUTES (at most that many buckets)."""
+        totals = [0, 0.0, 0, 0.0, 0.0]
+        for bucket in reversed(self.buckets):
+            if bucket[0] <= minute - LEADERBOARD_RECENT_MINUTES:
+                break
+            for i, value in enumerate(bucket[1:]):
+                totals[i] += value
+        return totals
+
+
+def _spark_weekday(moment):
+    return moment.isoweekday() % 7 + 1
+
+
+class Leaderboard:
+    """Rolling drift / volatility per service with heaps of the worst drift and strongest anomalies."""
+
+    def __init__(self):
+        self.windows = {}
+        self.by_drift = IndexedHeap()
+        self.by_anomaly = IndexedHeap()
+        self.z_scores = {}      # service -> (z, recent mean ETA, baseline mean)
+        self.baseline = {}      # (service or None, weekday, hour) -> (mean, std)
+        self.lock = threading.Lock()
+
+    def set_baseline(self, baseline):
+        with self.lock:
+            self.baseline = baseline
+
+    def _baseline(self, service, moment):
+        weekday, hour = _spark_weekday(moment), moment.hour
+        return self.baseline.get((service, weekday, hour)) or self.baseline.get((None, weekday, hour))
+
+    def _rescore(self, service, window, minute, moment):
+        _, _, changes, change_sum, _ = window.totals
+        if changes >= LEADERBOARD_MIN_CHANGES:
+            self.by_drift.update(service, change_sum / changes)
+        else:
+            self.by_drift.remove(service)
+
+        etas, eta_sum, *_ = window.recent(minute)
+        baseline = self._baseline(service, moment)
+        if etas >= ANOMALY_MIN_SAMPLES and baseline and baseline[1] > 0:
+            mean = eta_sum / etas
+            z = (mean - baseline[0]) / baseline[1]
+            self.z_scores[service] = (z, mean, baseline[0])
+            self.by_anomaly.update(service, abs(z))
+        else:
+            self.z_scores.pop(service, None)
+            self.by_anomaly.remove(service)
+
+    def observe(self, service, moment, eta, change=None):
+        """Fold one stored ETA at datetime `moment` in: O(log n) in the number of services."""
+        minute = int(moment.timestamp() // 60)
+        with self.lock:
+            window = self.windows.get(service)
+            if window is None:
+                window = self.windows[service] = ServiceWindow()
+            window.evict(minute)
+            window.add(minute, eta, change)
+            self._rescore(service, window, minute, moment)
+
+    def expire(self, moment):
+        """Slide every window to `moment`; services with nothing left are dropped."""
+        minute = int(moment.timestamp() // 60)
+        with self.lock:
+            for service in list(self.windows):
+                window = self.windows[service]
+                window.evict(minute)
+                if window.buckets:
+                    self._rescore(service, window, minute, moment)
+                else:
+                    del self.windows[service]
+                    self.z_scores.pop(service, None)
+                    self.by_drift.remove(service)
+                    self.by_anomaly.remove(service)
+
+    def _entry(self, service, minute):
+        etas, _, changes, change_sum, abs_sum = self.windows[service].totals
+        _, _, recent_changes, recent_sum, _ = self.windows[service].recent(minute)
+        z, recent_eta, baseline = self.z_scores.get(service, (None, None, None))
+        return {
+            "service": service,
+            "drift": change_sum / changes if changes else None,
+            "volatility": abs_sum / changes if changes else None,
+            "recent_drift": recent_sum / recent_changes if recent_changes else None,
+            "samples": etas,
+            "recent_eta": recent_eta,
+            "baseline_eta": baseline,
+            "z": z,
+            "anomaly": z is not None and abs(z) >= ANOMALY_Z,
+        }
+
+    def snapshot(self, k=LEADERBOARD_SIZE, moment=None):
+        minute = int((moment or datetime.now()).timestamp() // 60)
+        with self.lock:
+            leaders = [self._entry(service, minute) for service, _ in self.by_drift.top(k)]
+            anomalies = [self._entry(service, minute) for service, score in self.by_anomaly.top(k)
+                         if score >= ANOMALY_Z]
+        return {"updated_at": time.time(), "window_minutes": LEADERBOARD_WINDOW_MINUTES,
+                "leaders": leaders, "anomalies": anomalies}
+
+
+# ---- This process's board, persistence and the merged view ----
+collector_leaderboard = Leaderboard()
+_board_active = False
+_merged = {"at": 0.0, "board": None}
+_merged_lock = threading.Lock()
+
+
+def persist_leaderboard(moment=None):
+    """Slide the windows and save this collector's top entries to collector_leaderboard."""
+    global _board_active
+    moment = moment or datetime.now()
+    collector_leaderboard.expire(moment)
+    snapshot = collector_leaderboard.snapshot(moment=moment)
+    bulk_write("bus", "collector_leaderboard", ("shard", "payload", "updated_at"),
+               [(LIVE_STATS_SHARD, json.dumps(snapshot, separators=(",", ":")), snapshot["updated_at"])],
+               key=("shard",))
+    _board_active = True
+    return snapshot
+
+
+def _read_boards():
+    conn = get_bus_db_connection()
+    cursor = conn.cursor()
+    param = "%s" if IS_PRODUCTION else "?"
+    cursor.execute(f"SELECT shard, payload FROM collector_leaderboard WHERE updated_at >= {param}",
+                   (time.time() - LEADERBOARD_STALE_SECONDS,))
+    boards = {row["shard"]: json.loads(row["payload"]) for row in cursor.fetchall()}
+    cursor.close()
+    conn.close()
+    return boards
+
+
+def _merge_entries(boards, field, order):
+    best = {}
+    for board in boards:
+        for entry in board[field]:
+            current = best.get(entry["service"])
+            if current is None or entry["samples"] > current["samples"]:
+                best[entry["service"]] = entry
+    return sorted(best.values(), key=order, reverse=True)[:LEADERBOARD_SIZE]
+
+
+def merged_leaderboard():
+    """Worst services and anomalies across all fresh collector shards.
+
+    A service seen by several collectors keeps the entry with the most samples.
+    """
+    with _merged_lock:
+        if _merged["board"] is not None and time.time() - _merged["at"] < LEADERBOARD_READ_TTL:
+            return _merged["board"]
+        boards = _read_boards()
+        if _board_active:
+            boards[LIVE_STATS_SHARD] = collector_leaderboard.snapshot()
+        boards = list(boards.values())
+        merged = {
+            "updated_at": max((b["updated_at"] for b in boards), default=None),
+            "window_minutes": LEADERBOARD_WINDOW_MINUTES,
+            "leaders": _merge_entries(boards, "leaders", lambda e: e["drift"]),
+            "anomalies": _merge_entries(boards, "anomalies", lambda e: abs(e["z"])),
+        }
+        _merged.update(at=time.time(), board=merged)
+        return merged
@@ -0,0 +1,273 @@
+"""
+live_stats.py
+-------------
+Streaming bus ETA statistics maintained by the arrivals collector, so the
+/charts dashboard can be served live without the batch pipeline.
+
+For every service and every (service, hour of day) the collector folds each
+stored ETA into:
+  * Welford running mean / variance of the ETA,
+  * a quantile sketch of the ETA (median, p90),
+  * running drift (ETA minus the previous stored ETA of the same stop and
+    service) and its absolute value, the notebook's "volatility".
+
+All three are mergeable, so each collector process keeps its own shard and
+persists it to the collector_stats table every LIVE_STATS_PERSIST_SECONDS;
+readers merge all shards.
+"""
+
+import json
+import math
+import os
+import socket
+import threading
+import time
+from array import array
+
+from database import get_bus_db_connection, bulk_write
+
+LIVE_STATS_SHARD = os.getenv("COLLECTOR_ID") or socket.gethostname()
+LIVE_STATS_PERSIST_SECONDS = float(os.getenv("LIVE_STATS_PERSIST_SECONDS", 300))
+LIVE_STATS_READ_TTL = 30             # seconds a merged snapshot is reused
+SERVICE_RESOLUTION = 0.1             # minutes per sketch bin, per service
+SERVICE_HOUR_RESOLUTION = 1.0        # coarser bins for the 24x more (service, hour) sketches
+SKETCH_MAX_MINUTES = 180             # ETAs above this share the last bin
+
+
+class RunningStats:
+    """Welford mean / variance; merge() uses Chan et al.'s parallel update."""
+
+    __slots__ = ("count", "mean", "m2")
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count, self.mean, self.m2 = count, mean, m2
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        if not other.count:
+            return
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / total
+        self.m2 += other.m2 + delta * delta * self.count * other.count / total
+        self.count = total
+
+    @property
+    def std(self):
+        """Sample standard deviation, None below two samples (like Spark's stddev)."""
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else None
+
+    def to_state(self):
+        return [self.count, self.mean, self.m2]
+
+
+class QuantileSketch:
+    """Mergeable fixed-resolution histogram sketch for non-negative ETAs.
+
+    Collector ETAs are rounded to 0.1 minute and bounded, so counting them in
+    dense bins of `resolution` minutes is exact at SERVICE_RESOLUTION, uses at
+    most SKETCH_MAX_MINUTES / resolution counters, and merges by addition.
+    """
+
+    __slots__ = ("resolution", "counts")
+
+    def __init__(self, resolution, counts=()):
+        self.resolution = resolution
+        self.counts = array("L", counts)
+
+    def add(self, value):
+        index = min(max(int(round(value / self.resolution)), 0), int(SKETCH_MAX_MINUTES / self.resolution))
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+
+    def merge(self, other):
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+
+    def quantile(self, q):
+        """Smallest binned value with at least a q fraction of samples at or below it."""
+        target, seen = sum(self.counts) * q, 0
+        if not target:
+            return None
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return round(index * self.resolution, 1)
+
+    def to_state(self):
+        counts = self.counts.tolist()
+        while counts and not counts[-1]:
+            counts.pop()
+        return counts
+
+
+class EtaStats:
+    """Everything tracked for one service or one (service, hour)."""
+
+    __slots__ = ("eta", "sketch", "drift", "volatility")
+
+    def __init__(self, resolution, state=None):
+        state = state or {}
+        self.eta = RunningStats(*state.get("eta", ()))
+        self.sketch = QuantileSketch(resolution, state.get("sketch", ()))
+        self.drift = RunningStats(*state.get("drift", ()))
+        self.volatility = RunningStats(*state.get("volatility", ()))
+
+    def add(self, eta, change):
+        self.eta.add(eta)
+        self.sketch.add(eta)
+        if change is not None:
+            self.drift.add(change)
+            self.volatility.add(abs(change))
+
+    def merge(self, other):
+        for name in self.__slots__:
+            getattr(self, name).merge(getattr(other, name))
+
+    def to_state(self):
+        return {name: getattr(self, name).to_state() for name in self.__slots__}
+
+
+class LiveStats:
+    """Per-service and per-(service, hour) EtaStats of one collector shard."""
+
+    def __init__(self):
+        self.services = {}
+        self.service_hours = {}   # (service, hour) -> EtaStats
+        self.lock = threading.Lock()
+        self.persisted_at = 0.0
+
+    def observe(self, service, hour, eta, change=None):
+        """Fold one stored ETA (and its drift from the previous stored ETA) in."""
+        with self.lock:
+            stats = self.services.get(service)
+            if stats is None:
+                stats = self.services[service] = EtaStats(SERVICE_RESOLUTION)
+            stats.add(eta, change)
+            stats = self.service_hours.get((service, hour))
+            if stats is None:
+                stats = self.service_hours[(service, hour)] = EtaStats(SERVICE_HOUR_RESOLUTION)
+            stats.add(eta, change)
+
+    def merge(self, other):
+        with other.lock, self.lock:
+            for target, source, resolution in ((self.services, other.services, SERVICE_RESOLUTION),
+                                                (self.service_hours, other.service_hours, SERVICE_HOUR_RESOLUTION)):
+                for key, stats in source.items():
+                    target.setdefault(key, EtaStats(resolution)).merge(stats)
+
+    def to_state(self):
+        with self.lock:
+            return {
+                "services": {service: stats.to_state() for service, stats in self.services.items()},
+                "service_hours": {f"{service}|{hour}": stats.to_state()
+                                  for (service, hour), stats in self.service_hours.items()},
+            }
+
+    @classmethod
+    def from_state(cls, state):
+        live = cls()
+        for service, stats in state.get("services", {}).items():
+            live.services[service] = EtaStats(SERVICE_RESOLUTION, stats)
+        for key, stats in state.get("service_hours", {}).items():
+            service, hour = key.rsplit("|", 1)
+            live.service_hours[(service, int(hour))] = EtaStats(SERVICE_HOUR_RESOLUTION, stats)
+        return live
+
+    def records(self):
+        """Chart-ready records in the shape of the batch datasets (see charts.CHART_DATASETS)."""
+        with self.lock:
+            by_hour = {}
+            for (_, hour), stats in self.service_hours.items():
+                by_hour.setdefault(hour, RunningStats()).merge(stats.eta)
+            hourly = [{"hour": hour, "avg_eta": stats.mean} for hour, stats in sorted(by_hour.items())]
+
+            median, drift = [], []
+            for service, stats in self.services.items():
+                volatility = stats.volatility.mean if stats.volatility.count else None
+                median.append({
+                    "service": service,
+                    "median_eta": stats.sketch.quantile(0.5),
+                    "p90_eta": stats.sketch.quantile(0.9),
+                    "avg_eta": stats.eta.mean,
+                    "eta_variability": stats.eta.std,
+                    "drift_volatility": volatility,
+                })
+                if stats.drift.count:
+                    drift.append({
+                        "service": service,
+                        "avg_eta_drift": stats.drift.mean,
+                        "drift_variability": stats.drift.std,
+                        "avg_volatility": volatility,
+                    })
+        median.sort(key=lambda r: r["median_eta"] or 0, reverse=True)
+        drift.sort(key=lambda r: r["avg_eta_drift"], reverse=True)
+        return {"hourly": hourly, "median_by_service": median, "drift_by_service": drift,
+                "top10_worst": drift[:10]}
+
+
+# ---- This process's shard, persistence and the merged view ----
+collector_stats = LiveStats()
+_shard_loaded = False
+_snapshot = {"at": 0.0, "stats": None}
+_snapshot_lock = threading.Lock()
+
+
+def _read_shards():
+    conn = get_bus_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT shard, payload FROM collector_stats")
+    shards = {row["shard"]: row["payload"] for row in cursor.fetchall()}
+    cursor.close()
+    conn.close()
+    return shards
+
+
+def load_collector_stats():
+    """Resume this process's shard from its last persisted state (once)."""
+    global collector_stats, _shard_loaded
+    if _shard_loaded:
+        return collector_stats
+    payload = _read_shards().get(LIVE_STATS_SHARD)
+    if payload:
+        restored = LiveStats.from_state(json.loads(payload))
+        restored.merge(collector_stats)
+        collector_stats = restored
+    _shard_loaded = True
+    return collector_stats
+
+
+def persist_collector_stats(force=False):
+    """Write this shard to collector_stats if LIVE_STATS_PERSIST_SECONDS have passed."""
+    now = time.time()
+    if not force and now - collector_stats.persisted_at < LIVE_STATS_PERSIST_SECONDS:
+        return False
+    payload = json.dumps(collector_stats.to_state(), separators=(",", ":"))
+    bulk_write("bus", "collector_stats", ("shard", "payload", "updated_at"),
+               [(LIVE_STATS_SHARD, payload, now)], key=("shard",))
+    collector_stats.persisted_at = now
+    return True
+
+
+def merged_live_stats():
+    """All collector shards merged; this process's in-memory shard replaces its stored copy."""
+    with _snapshot_lock:
+        if _snapshot["stats"] is not None and time.time() - _snapshot["at"] < LIVE_STATS_READ_TTL:
+            return _snapshot["stats"]
+        merged = LiveStats()
+        for shard, payload in _read_shards().items():
+            if shard == LIVE_STATS_SHARD and _shard_loaded:
+                continue
+            merged.merge(LiveStats.from_state(json.loads(payload)))
+        if _shard_loaded:
+            merged.merge(collector_stats)
+        _snapshot.update(at=time.time(), stats=merged)
+        return merged
@@ -1,251 +1,383 @@
 """
 Migration script to move data from SQLite to PostgreSQL
-Run this ONCE when setting up production database
+Safe to re-run: progress is checkpointed in PostgreSQL, so an interrupted
+run resumes where it stopped.
+
+* Every table is streamed in rowid-keyed chunks (bounded memory) and loaded
+  with COPY into a temporary staging table.
+* Each chunk is read back from staging and compared against a checksum of
+  the source rows before it is inserted into the real table. The insert, the
+  chunk checksum and the checkpoint are committed together.
+* users goes first (the other user tables reference it); every other table,
+  and every daily bus_arrivals file, is migrated in parallel.
+
+Usage:
+    python migrate_to_postgres.py [--yes] [--workers 4] [--chunk-size 10000] [--restart]
 """
+import argparse
+import glob
+import hashlib
+import io
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime
+
 import sqlite3
 import psycopg2
-from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
+# The target is PostgreSQL whatever .env says about the app's own mode
+os.environ["FLASK_ENV"] = "production"
 
-def migrate_users():
-    """Migrate users from SQLite to PostgreSQL"""
-    print("Migrating users table...")
-    
-    # Connect to SQLite
-    sqlite_conn = sqlite3.connect('users.db')
-    sqlite_conn.row_factory = sqlite3.Row
-    sqlite_cursor = sqlite_conn.cursor()
-    
-    # Connect to PostgreSQL
-    pg_conn = psycopg2.connect(
-        host=os.getenv('DB_HOST'),
-        port=int(os.getenv('DB_PORT', 5432)),
-        database=os.getenv('DB_NAME'),
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD')
-    )
-    pg_cursor = pg_conn.cursor()
-    
+import database  # noqa: E402  (reads FLASK_ENV at import time)
+
+# Tables worth copying, in the order they are reported. Bookkeeping tables
+# (schema_migrations, replication_heartbeat) are left to the target's own setup.
+MIGRATED_TABLES = ["users", "locations", "bus_favorites", "bus_stops", "bus_routes",
+                   "bus_arrival_rollups", "bus_arrivals"]
+# Tables that must be finished before any other table starts (foreign keys)
+FIRST_TABLES = {"users"}
+# Columns not carried over: bus_arrivals ids restart in every daily SQLite file
+SKIP_COLUMNS = {"bus_arrivals": {"id"}}
+
+CHECKPOINT_DDL = [
+    """CREATE TABLE IF NOT EXISTS migration_checkpoints (
+        source TEXT NOT NULL,
+        table_name TEXT NOT NULL,
+        last_rowid BIGINT NOT NULL DEFAULT 0,
+        rows_copied BIGINT NOT NULL DEFAULT 0,
+        done BOOLEAN NOT NULL DEFAULT FALSE,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (source, table_name)
+    )""",
+    """CREATE TABLE IF NOT EXISTS migration_chunks (
+        source TEXT NOT NULL,
+        table_name TEXT NOT NULL,
+        first_rowid BIGINT NOT NULL,
+        last_rowid BIGINT NOT NULL,
+        row_count INTEGER NOT NULL,
+        checksum CHAR(32) NOT NULL,
+        copied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (source, table_name, first_rowid)
+    )""",
+]
+
+_print_lock = threading.Lock()
+
+
+def log(message):
+    with _print_lock:
+        print(message, flush=True)
+
+
+class ChecksumMismatch(Exception):
+    """Raised when a chunk read back from PostgreSQL differs from the SQLite rows."""
+
+
+def pg_connect():
+    return psycopg2.connect(**database._pg_connect_kwargs("primary"))
+
+
+# ---- value conversion ----
+BOOL_TYPES = {"boolean"}
+INT_TYPES = {"smallint", "integer", "bigint"}
+FLOAT_TYPES = {"real", "double precision", "numeric"}
+TIMESTAMP_TYPES = {"timestamp without time zone", "timestamp with time zone"}
+
+
+def to_pg(value, pg_type):
+    """SQLite value -> something COPY accepts for the target column type."""
+    if value is None:
+        return None
+    if pg_type in BOOL_TYPES:
+        return "t" if (value.lower() in ("1", "t", "true") if isinstance(value, str) else bool(value)) else "f"
+    if pg_type in TIMESTAMP_TYPES or pg_type == "date":
+        return value if str(value).strip() else None
+    return value
+
+
+def canonical(value, pg_type):
+    """Type-aware text form used for chunk checksums on both sides."""
+    if value is None:
+        return "\\N"
+    if pg_type in BOOL_TYPES:
+        return "t" if value in (True, "t") else "f"
+    if pg_type in INT_TYPES:
+        return str(int(value))
+    if pg_type in FLOAT_TYPES:
+        # REAL columns keep ~7 significant digits
+        return format(float(value), ".6g")
+    if pg_type in TIMESTAMP_TYPES:
+        ts = value if isinstance(value, datetime) else datetime.fromisoformat(str(value))
+        return ts.replace(tzinfo=None).isoformat(sep=" ")
+    if pg_type == "date":
+        return (value if isinstance(value, date) else date.fromisoformat(str(value)[:10])).isoformat()
+    return str(value)
+
+
+def csv_line(values):
+    """One COPY CSV line: NULL is an unquoted empty field, everything else is quoted."""
+    return ",".join("" if v is None else '"' + str(v).replace('"', '""') + '"' for v in values) + "\n"
+
+
+def chunk_checksum(rows, types):
+    digest = hashlib.md5()
+    for row in rows:
+        digest.update("\x1f".join(canonical(v, t) for v, t in zip(row, types)).encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+# ---- planning ----
+def sqlite_columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def pg_column_types(pg_cur, table):
+    pg_cur.execute("""
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s
+    """, (table,))
+    return dict(pg_cur.fetchall())
+
+
+def plan_jobs(sources, pg_cur):
+    """(source path, table, columns, pg types) for every table present on both sides."""
+    jobs = []
+    for path in sources:
+        conn = sqlite3.connect(path)
+        existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        for table in MIGRATED_TABLES:
+            if table not in existing:
+                continue
+            target = pg_column_types(pg_cur, table)
+            if not target:
+                log(f"⚠️ {table} does not exist in PostgreSQL, skipping {os.path.basename(path)}")
+                continue
+            # PostgreSQL folds unquoted names (ServiceNo -> serviceno)
+            columns = [c for c in sqlite_columns(conn, table)
+                       if c.lower() in target and c not in SKIP_COLUMNS.get(table, ())]
+            jobs.append((path, table, columns, [target[c.lower()] for c in columns]))
+        conn.close()
+    return jobs
+
+
+# ---- copying ----
+def copy_table(path, table, columns, types, chunk_size, arrival_day=None):
+    """Stream one SQLite table into PostgreSQL, resuming from its checkpoint."""
+    source = os.path.relpath(path, database.BASE_DIR)
+    name = f"{table} ({os.path.basename(path)})"
+    sqlite_conn = sqlite3.connect(path)
+    pg_conn = pg_connect()
+    pg_cur = pg_conn.cursor()
+    copied = 0
     try:
-        # Get all users from SQLite
-        sqlite_cursor.execute("SELECT * FROM users")
-        users = sqlite_cursor.fetchall()
-        
-        if not users:
-            print("No users to migrate.")
-            return
-        
-        # Prepare data for PostgreSQL
-        user_data = []
-        for user in users:
-            user_data.append((
-                user['username'],
-                user['email'],
-                user['phone'],
-                user['password_hash'],
-                user['date_of_birth'],
-                user['created_at']
-            ))
-        
-        # Insert into PostgreSQL
-        insert_query = """
-            INSERT INTO users (username, email, phone, password_hash, date_of_birth, created_at)
-            VALUES %s
-            ON CONFLICT (username) DO NOTHING
-        """
-        execute_values(pg_cursor, insert_query, user_data)
+        pg_cur.execute("""
+            INSERT INTO migration_checkpoints (source, table_name) VALUES (%s, %s)
+            ON CONFLICT DO NOTHING
+        """, (source, table))
+        pg_cur.execute("SELECT last_rowid, done FROM migration_checkpoints WHERE source = %s AND table_name = %s",
+                       (source, table))
+        last_rowid, done = pg_cur.fetchone()
         pg_conn.commit()
-        
-        print(f"✅ Migrated {len(users)} users")
-        
-    except Exception as e:
-        print(f"❌ Error migrating users: {e}")
-        pg_conn.rollback()
-    finally:
-        sqlite_cursor.close()
-        sqlite_conn.close()
-        pg_cursor.close()
-        pg_conn.close()
+        if done:
+            log(f"⏭️  {name}: already migrated")
+            return 0
+        if last_rowid:
+            log(f"↩️  {name}: resuming after rowid {last_rowid}")
 
+        if arrival_day is not None:
+            # Land the rows in their own daily partition rather than the default one
+            database.ensure_arrival_partitions(days_ahead=0, today=arrival_day)
 
-def migrate_locations():
-    """Migrate user locations from SQLite to PostgreSQL"""
-    print("Migrating locations table...")
-    
-    sqlite_conn = sqlite3.connect('users.db')
-    sqlite_conn.row_factory = sqlite3.Row
-    sqlite_cursor = sqlite_conn.cursor()
-    
-    pg_conn = psycopg2.connect(
-        host=os.getenv('DB_HOST'),
-        port=int(os.getenv('DB_PORT', 5432)),
-        database=os.getenv('DB_NAME'),
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD')
-    )
-    pg_cursor = pg_conn.cursor()
-    
-    try:
-        # Get all locations
-        sqlite_cursor.execute("SELECT * FROM locations")
-        locations = sqlite_cursor.fetchall()
-        
-        if not locations:
-            print("No locations to migrate.")
-            return
-        
-        # Prepare data
-        location_data = []
-        for loc in locations:
-            location_data.append((
-                loc['user_id'],
-                loc['label'],
-                loc['latitude'],
-                loc['longitude'],
-                loc['is_primary'],
-                loc.get('address'),
-                loc.get('postal_code'),
-                loc.get('is_favourite', 0)
-            ))
-        
-        # Insert into PostgreSQL
-        insert_query = """
-            INSERT INTO locations 
-            (user_id, label, latitude, longitude, is_primary, address, postal_code, is_favourite)
-            VALUES %s
-        """
-        execute_values(pg_cursor, insert_query, location_data)
+        column_list = ", ".join(columns)
+        pg_cur.execute(f"""
+            CREATE TEMP TABLE IF NOT EXISTS migration_stage AS
+            SELECT {column_list} FROM {table} WITH NO DATA
+        """)
+        pg_cur.execute("ALTER TABLE migration_stage ADD COLUMN IF NOT EXISTS src_rowid BIGINT")
         pg_conn.commit()
-        
-        print(f"✅ Migrated {len(locations)} locations")
-        
-    except Exception as e:
-        print(f"❌ Error migrating locations: {e}")
-        pg_conn.rollback()
-    finally:
-        sqlite_cursor.close()
-        sqlite_conn.close()
-        pg_cursor.close()
-        pg_conn.close()
 
+        started = time.monotonic()
+        while True:
+            rows = sqlite_conn.execute(
+                f"SELECT rowid, {column_list} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, chunk_size)
+            ).fetchall()
+            if not rows:
+                break
 
-def migrate_bus_favorites():
-    """Migrate bus favorites from SQLite to PostgreSQL"""
-    print("Migrating bus favorites table...")
-    
-    sqlite_conn = sqlite3.connect('users.db')
-    sqlite_conn.row_factory = sqlite3.Row
-    sqlite_cursor = sqlite_conn.cursor()
-    
-    pg_conn = psycopg2.connect(
-        host=os.getenv('DB_HOST'),
-        port=int(os.getenv('DB_PORT', 5432)),
-        database=os.getenv('DB_NAME'),
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD')
-    )
-    pg_cursor = pg_conn.cursor()
-    
-    try:
-        # Check if table exists in SQLite
-        sqlite_cursor.execute(
-            "SELECT name FROM sqlite_master WHERE type='table' AND name='bus_favorites'"
-        )
-        if not sqlite_cursor.fetchone():
-            print("No bus_favorites table found in SQLite.")
-            return
-        
-        # Get all bus favorites
-        sqlite_cursor.execute("SELECT * FROM bus_favorites")
-        favorites = sqlite_cursor.fetchall()
-        
-        if not favorites:
-            print("No bus favorites to migrate.")
-            return
-        
-        # Prepare data
-        favorite_data = []
-        for fav in favorites:
-            favorite_data.append((
-                fav['user_id'],
-                fav['bus_stop_code'],
-                fav['bus_stop_name'],
-                fav['created_at']
-            ))
-        
-        # Insert into PostgreSQL
-        insert_query = """
-            INSERT INTO bus_favorites (user_id, bus_stop_code, bus_stop_name, created_at)
-            VALUES %s
-            ON CONFLICT (user_id, bus_stop_code) DO NOTHING
-        """
-        execute_values(pg_cursor, insert_query, favorite_data)
+            converted = [tuple(to_pg(v, t) for v, t in zip(row[1:], types)) for row in rows]
+            expected = chunk_checksum(converted, types)
+
+            buffer = io.StringIO()
+            for row, values in zip(rows, converted):
+                buffer.write(csv_line((row[0],) + values))
+            buffer.seek(0)
+
+            pg_cur.execute("TRUNCATE migration_stage")
+            pg_cur.copy_expert(f"COPY migration_stage (src_rowid, {column_list}) FROM STDIN WITH (FORMAT csv)", buffer)
+            pg_cur.execute(f"SELECT {column_list} FROM migration_stage ORDER BY src_rowid")
+            actual = chunk_checksum(pg_cur.fetchall(), types)
+            if actual != expected:
+                pg_conn.rollback()
+                raise ChecksumMismatch(f"{name}: rowids {rows[0][0]}-{rows[-1][0]} "
+                                       f"checksum {actual} != {expected}")
+
+            pg_cur.execute(f"""
+                INSERT INTO {table} ({column_list})
+                SELECT {column_list} FROM migration_stage ORDER BY src_rowid
+                ON CONFLICT DO NOTHING
+            """)
+            pg_cur.execute("""
+                INSERT INTO migration_chunks (source, table_name, first_rowid, last_rowid, row_count, checksum)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (source, table_name, first_rowid) DO UPDATE SET
+                    last_rowid = excluded.last_rowid, row_count = excluded.row_count,
+                    checksum = excluded.checksum, copied_at = CURRENT_TIMESTAMP
+            """, (source, table, rows[0][0], rows[-1][0], len(rows), expected))
+            last_rowid = rows[-1][0]
+            pg_cur.execute("""
+                UPDATE migration_checkpoints
+                SET last_rowid = %s, rows_copied = rows_copied + %s, updated_at = CURRENT_TIMESTAMP
+                WHERE source = %s AND table_name = %s
+            """, (last_rowid, len(rows), source, table))
+            pg_conn.commit()
+            copied += len(rows)
+
+        pg_cur.execute("""
+            UPDATE migration_checkpoints SET done = TRUE, updated_at = CURRENT_TIMESTAMP
+            WHERE source = %s AND table_name = %s
+        """, (source, table))
         pg_conn.commit()
-        
-        print(f"✅ Migrated {len(favorites)} bus favorites")
-        
-    except Exception as e:
-        print(f"❌ Error migrating bus favorites: {e}")
-        pg_conn.rollback()
+        elapsed = time.monotonic() - started
+        log(f"✅ {name}: {copied} rows in {elapsed:.1f}s ({copied / elapsed if elapsed else 0:.0f} rows/s)")
+        return copied
     finally:
-        sqlite_cursor.close()
-        sqlite_conn.close()
-        pg_cursor.close()
+        pg_cur.close()
         pg_conn.close()
+        sqlite_conn.close()
+
+
+def reset_sequences(pg_cur, tables):
+    """Move serial sequences past the ids copied from SQLite."""
+    for table in tables:
+        if "id" not in pg_column_types(pg_cur, table) or "id" in SKIP_COLUMNS.get(table, ()):
+            continue
+        pg_cur.execute("SELECT pg_get_serial_sequence(%s, 'id')", (table,))
+        sequence = pg_cur.fetchone()[0]
+        if sequence:
+            pg_cur.execute(f"SELECT setval(%s, GREATEST((SELECT MAX(id) FROM {table}), 1))", (sequence,))
+
+
+def migrate(sources, workers, chunk_size, restart=False):
+    pg_conn = pg_connect()
+    pg_cur = pg_conn.cursor()
+    for statement in CHECKPOINT_DDL:
+        pg_cur.execute(statement)
+    if restart:
+        pg_cur.execute("TRUNCATE migration_checkpoints, migration_chunks")
+    pg_conn.commit()
+    jobs = plan_jobs(sources, pg_cur)
+
+    def run(batch):
+        failures = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for path, table, columns, types in batch:
+                day = None
+                if table == "bus_arrivals" and os.path.basename(path).startswith("bus_arrivals_"):
+                    day = datetime.strptime(os.path.basename(path)[13:21], "%Y%m%d").date()
+                futures[pool.submit(copy_table, path, table, columns, types, chunk_size, day)] = (path, table)
+            for future in as_completed(futures):
+                path, table = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    log(f"❌ Error migrating {table} from {os.path.basename(path)}: {e}")
+                    failures.append((path, table))
+        return failures
+
+    failures = run([job for job in jobs if job[1] in FIRST_TABLES])
+    if failures:
+        log("❌ Stopping: dependent tables need users migrated first. Re-run to resume.")
+    else:
+        failures = run([job for job in jobs if job[1] not in FIRST_TABLES])
+
+    reset_sequences(pg_cur, sorted({job[1] for job in jobs}))
+    pg_conn.commit()
+    pg_cur.close()
+    pg_conn.close()
+    return failures
 
 
 def verify_migration():
-    """Verify that migration was successful"""
+    """Print row counts and checksummed chunks per table"""
     print("\n" + "="*50)
     print("VERIFICATION")
     print("="*50)
-    
-    pg_conn = psycopg2.connect(
-        host=os.getenv('DB_HOST'),
-        port=int(os.getenv('DB_PORT', 5432)),
-        database=os.getenv('DB_NAME'),
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD')
-    )
+
+    pg_conn = pg_connect()
     pg_cursor = pg_conn.cursor()
-    
-    # Count records
-    pg_cursor.execute("SELECT COUNT(*) FROM users")
-    user_count = pg_cursor.fetchone()[0]
-    
-    pg_cursor.execute("SELECT COUNT(*) FROM locations")
-    location_count = pg_cursor.fetchone()[0]
-    
-    pg_cursor.execute("SELECT COUNT(*) FROM bus_favorites")
-    favorite_count = pg_cursor.fetchone()[0]
-    
+
+    pg_cursor.execute("""
+        SELECT table_name, COUNT(*), SUM(row_count)
+        FROM migration_chunks GROUP BY table_name ORDER BY table_name
+    """)
+    chunks = {table: (count, rows) for table, count, rows in pg_cursor.fetchall()}
+
     print(f"PostgreSQL Database Status:")
-    print(f"  - Users: {user_count}")
-    print(f"  - Locations: {location_count}")
-    print(f"  - Bus Favorites: {favorite_count}")
-    
+    for table in MIGRATED_TABLES:
+        pg_cursor.execute("SELECT to_regclass(%s)", (table,))
+        if pg_cursor.fetchone()[0] is None:
+            continue
+        pg_cursor.execute(f"SELECT COUNT(*) FROM {table}")
+        count = pg_cursor.fetchone()[0]
+        chunk_count, copied = chunks.get(table, (0, 0))
+        print(f"  - {table}: {count} rows ({copied} copied in {chunk_count} verified chunks)")
+
     pg_cursor.close()
     pg_conn.close()
 
 
+def default_sources():
+    sources = [os.path.join(database.BASE_DIR, database.USERS_DB_FILE), database.BUS_DB_FILE]
+    sources += sorted(glob.glob(os.path.join(database.ARRIVALS_DIR, "bus_arrivals_*.db")))
+    return [path for path in sources if os.path.exists(path)]
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sources", nargs="*", help="SQLite files (default: users.db, bus_data.db and daily arrival files)")
+    parser.add_argument("--workers", type=int, default=4, help="tables copied in parallel")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="rows per COPY/checkpoint")
+    parser.add_argument("--restart", action="store_true", help="forget checkpoints and start over")
+    parser.add_argument("--yes", action="store_true", help="don't ask for confirmation")
+    args = parser.parse_args()
+    sources = args.sources or default_sources()
+
     print("="*50)
     print("SQLite to PostgreSQL Migration")
     print("="*50)
     print(f"Target Database: {os.getenv('DB_HOST')}/{os.getenv('DB_NAME')}")
+    print(f"Sources: {len(sources)} SQLite files")
     print("="*50)
-    
-    response = input("\n⚠️  This will migrate data to PostgreSQL. Continue? (yes/no): ")
-    
+
+    response = "yes" if args.yes else input("\n⚠️  This will migrate data to PostgreSQL. Continue? (yes/no): ")
+
     if response.lower() == 'yes':
-        migrate_users()
-        migrate_locations()
-        migrate_bus_favorites()
+        # Target tables, indexes and partitions
+        database.init_users_db()
+        database.init_bus_db()
+        failures = migrate(sources, args.workers, args.chunk_size, restart=args.restart)
         verify_migration()
-        print("\n✅ Migration complete!")
+        if failures:
+            print(f"\n⚠️ {len(failures)} table(s) failed; run again to resume from the last checkpoint.")
+        else:
+            print("\n✅ Migration complete!")
     else:
-        print("Migration cancelled.")
\ No newline at end of file
+        print("Migration cancelled.")
@@ -0,0 +1,137 @@
+"""
+route_segments.py
+-----------------
+Spatial index over bus-route segments (consecutive stops of a service/direction),
+used to work out which bus services pass close to a traffic incident.
+
+Coordinates are projected onto a flat local grid in metres, which is accurate
+enough at Singapore's scale, and segments are bucketed into square cells so a
+lookup only measures distance to the handful of segments near the point.
+"""
+
+import math
+from collections import defaultdict
+
+# Metres per degree around Singapore (~1.35°N)
+M_PER_DEG_LAT = 110574.0
+M_PER_DEG_LON = 111320.0 * math.cos(math.radians(1.35))
+
+CELL_SIZE_M = 250.0
+DEFAULT_RADIUS_M = 100.0
+
+
+def _row_tuple(row):
+    """Rows come back as tuples, sqlite3.Row or RealDictRow depending on backend."""
+    return tuple(row.values()) if isinstance(row, dict) else tuple(row)
+
+
+def _project(lat, lon):
+    return lon * M_PER_DEG_LON, lat * M_PER_DEG_LAT
+
+
+def _point_segment_distance(px, py, ax, ay, bx, by):
+    dx, dy = bx - ax, by - ay
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        return math.hypot(px - ax, py - ay)
+    t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length_sq))
+    return math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+
+class SegmentIndex:
+    """Grid-bucketed index of route segments.
+
+    Each segment is (service, direction, from_seq, to_seq, from_stop, to_stop)
+    plus its projected end points.
+    """
+
+    def __init__(self, radius_m=DEFAULT_RADIUS_M, cell_size_m=CELL_SIZE_M):
+        self.radius_m = radius_m
+        self.cell_size_m = cell_size_m
+        self.segments = []
+        self.cells = defaultdict(list)
+
+    def _cell(self, x, y):
+        return int(x // self.cell_size_m), int(y // self.cell_size_m)
+
+    def add_segment(self, service, direction, start, end):
+        """Add a segment between two (seq, stop_code, lat, lon) route stops."""
+        (from_seq, from_stop, lat1, lon1), (to_seq, to_stop, lat2, lon2) = start, end
+        ax, ay = _project(lat1, lon1)
+        bx, by = _project(lat2, lon2)
+        seg_id = len(self.segments)
+        self.segments.append((service, direction, from_seq, to_seq, from_stop, to_stop, ax, ay, bx, by))
+
+        # Register in every cell the segment's bounding box (grown by the radius) touches
+        pad = self.radius_m
+        cx0, cy0 = self._cell(min(ax, bx) - pad, min(ay, by) - pad)
+        cx1, cy1 = self._cell(max(ax, bx) + pad, max(ay, by) + pad)
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                self.cells[(cx, cy)].append(seg_id)
+
+    def nearby_segments(self, lat, lon):
+        """Segments within radius_m of the point."""
+        px, py = _project(lat, lon)
+        hits = []
+        for seg_id in self.cells.get(self._cell(px, py), ()):
+            seg = self.segments[seg_id]
+            if _point_segment_distance(px, py, *seg[6:]) <= self.radius_m:
+                hits.append(seg)
+        return hits
+
+    def match(self, lat, lon):
+        """Affected (service, direction, stop range) entries for a point.
+
+        Adjacent matching segments of the same service/direction are merged
+        into a single from_seq..to_seq range.
+        """
+        by_route = defaultdict(list)
+        for service, direction, from_seq, to_seq, from_stop, to_stop, *_ in self.nearby_segments(lat, lon):
+            by_route[(service, direction)].append((from_seq, to_seq, from_stop, to_stop))
+
+        matches = []
+        for (service, direction), segs in sorted(by_route.items()):
+            segs.sort()
+            current = list(segs[0])
+            for from_seq, to_seq, from_stop, to_stop in segs[1:]:
+                if from_seq <= current[1]:
+                    current[1], current[3] = to_seq, to_stop
+                else:
+                    matches.append((service, direction, *current))
+                    current = [from_seq, to_seq, from_stop, to_stop]
+            matches.append((service, direction, *current))
+        return [
+            {"service": s, "direction": d, "from_seq": fs, "to_seq": ts, "from_stop": fst, "to_stop": tst}
+            for s, d, fs, ts, fst, tst in matches
+        ]
+
+    def __len__(self):
+        return len(self.segments)
+
+
+def build_segment_index(conn, radius_m=DEFAULT_RADIUS_M):
+    """Build a SegmentIndex from the bus_routes and bus_stops tables."""
+    c = conn.cursor()
+    c.execute("""
+        SELECT r.ServiceNo, r.Direction, r.StopSequence, r.BusStopCode, s.lat, s.lon
+        FROM bus_routes r
+        JOIN bus_stops s ON s.code = r.BusStopCode
+        WHERE s.lat IS NOT NULL AND s.lon IS NOT NULL
+        ORDER BY r.ServiceNo, r.Direction, r.StopSequence
+    """)
+    rows = [_row_tuple(r) for r in c.fetchall()]
+
+    # Same dedup rule as build_bus_routes_cache: first stop wins per (svc, direction, seq)
+    routes = defaultdict(dict)
+    for service, direction, seq, stop, lat, lon in rows:
+        stops = routes[(service, int(direction))]
+        if seq not in stops:
+            stops[seq] = (int(seq), stop, float(lat), float(lon))
+
+    index = SegmentIndex(radius_m=radius_m)
+    for (service, direction), stops in routes.items():
+        ordered = [stops[seq] for seq in sorted(stops)]
+        for start, end in zip(ordered, ordered[1:]):
+            index.add_segment(service, direction, start, end)
+    return index
@@ -0,0 +1,65 @@
+"""Splitting the old single SQLite bus_arrivals table into day files."""
+
+import csv
+import gzip
+import sqlite3
+
+import pytest
+
+import database
+
+ROWS = [
+    ("01012", "10", 3.0, "SD", "2025-01-01 08:00:00"),
+    ("01012", "10", 2.0, "SD", "2025-01-01 08:01:00"),
+    ("01012", "14", 5.0, "DD", "2025-01-02 09:00:00"),
+    ("01012", "14", 4.0, "DD", None),
+]
+
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "ARRIVALS_DIR", str(tmp_path / "arrivals"))
+    monkeypatch.setattr(database, "ARRIVALS_ARCHIVE_DIR", str(tmp_path / "archive"))
+    monkeypatch.setattr(database, "ARRIVALS_ARCHIVE_FORMAT", "csv")
+    conn = sqlite3.connect(str(tmp_path / "bus_data.db"))
+    conn.execute("""CREATE TABLE bus_arrivals(
+        id INTEGER PRIMARY KEY AUTOINCREMENT, stop_code TEXT, service TEXT,
+        eta_min REAL, bus_type TEXT, timestamp DATETIME)""")
+    conn.executemany(
+        "INSERT INTO bus_arrivals (stop_code, service, eta_min, bus_type, timestamp) VALUES (?, ?, ?, ?, ?)", ROWS)
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def day_rows(day):
+    conn = sqlite3.connect(database.arrival_day_path(day))
+    rows = conn.execute("SELECT stop_code, service, eta_min, bus_type, timestamp FROM bus_arrivals "
+                        "ORDER BY timestamp").fetchall()
+    conn.close()
+    return rows
+
+
+def test_rerun_after_interruption_does_not_duplicate(legacy_db):
+    # A previous run copied the first day, then died before dropping the table
+    day_file = sqlite3.connect(database.ensure_arrival_day("2025-01-01"))
+    day_file.executemany(
+        "INSERT INTO bus_arrivals (stop_code, service, eta_min, bus_type, timestamp) VALUES (?, ?, ?, ?, ?)", ROWS[:2])
+    day_file.commit()
+    day_file.close()
+
+    database._split_sqlite_arrivals(legacy_db)
+
+    assert day_rows("2025-01-01") == ROWS[:2]
+    assert day_rows("2025-01-02") == ROWS[2:3]
+    assert not legacy_db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='bus_arrivals'").fetchone()
+
+
+def test_rows_without_timestamp_are_archived(legacy_db):
+    database._split_sqlite_arrivals(legacy_db)
+
+    with gzip.open(database._archive_path("untimed"), "rt", newline="") as f:
+        archived = list(csv.reader(f))
+    assert archived[0] == list(database.ARRIVAL_COLUMNS)
+    assert [row[1:5] for row in archived[1:]] == [["01012", "14", "4.0", "DD"]]
@@ -0,0 +1,62 @@
+"""Cached saved locations must follow writes made by any worker."""
+
+import pytest
+from flask import Flask
+
+import auth
+import database
+
+app = Flask(__name__)
+
+
+@pytest.fixture
+def user_id(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "IS_PRODUCTION", False)
+    monkeypatch.setattr(auth, "IS_PRODUCTION", False)
+    monkeypatch.setattr(database, "USERS_DB_FILE", str(tmp_path / "users.db"))
+    monkeypatch.setattr(auth, "_collection_cache", {})
+    database.init_users_db()
+    conn = database.get_db_connection(role="primary")
+    cursor = conn.execute(
+        "INSERT INTO users (username, email, password_hash) VALUES ('alice', 'alice@example.com', 'x')")
+    uid = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return uid
+
+
+def add_location(label, uid):
+    def write(conn):
+        conn.execute("INSERT INTO locations (user_id, label) VALUES (?, ?)", (uid, label))
+    return write
+
+
+def labels(uid):
+    with app.test_request_context():
+        return [loc["label"] for loc in auth.cached_user_locations(uid)]
+
+
+def test_write_through_this_worker_is_seen(user_id):
+    assert labels(user_id) == []
+    with app.test_request_context():
+        auth.write_user_locations(user_id, add_location("Home", user_id))
+    assert labels(user_id) == ["Home"]
+
+
+def test_write_through_another_worker_is_seen(user_id):
+    assert labels(user_id) == []
+
+    # Another worker's write: same transaction, but this worker's cache is untouched
+    def other_worker(conn):
+        add_location("Office", user_id)(conn)
+        conn.execute("UPDATE users SET collections_version = collections_version + 1 WHERE id = ?", (user_id,))
+    database.submit_write("users", other_worker)
+
+    assert labels(user_id) == ["Office"]
+
+
+def test_unchanged_collection_is_served_from_cache(user_id, monkeypatch):
+    assert labels(user_id) == []
+    monkeypatch.setattr(auth, "_load_user_locations", lambda uid: pytest.fail("reloaded"))
+    with app.test_request_context():
+        assert auth.find_user_location(user_id, "home") is None
@@ -0,0 +1,40 @@
+"""`with get_db_connection() as conn:` must hand back the pooled wrapper and release it."""
+
+import pytest
+
+import database
+
+
+@pytest.fixture
+def users_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "IS_PRODUCTION", False)
+    monkeypatch.setattr(database, "USERS_DB_FILE", str(tmp_path / "users.db"))
+    conn = database.get_db_connection(role="primary")
+    conn.execute("CREATE TABLE notes (body TEXT)")
+    conn.commit()
+    conn.close()
+    return database.USERS_DB_FILE
+
+
+def test_with_block_commits_and_releases(users_db):
+    with database.get_db_connection(role="primary") as conn:
+        assert isinstance(conn, database.PooledConnection)
+        conn.execute("INSERT INTO notes VALUES ('kept')")
+    assert database._sqlite_local.refs[users_db] == 0
+
+    # The thread's shared connection is still open and saw the commit
+    conn = database.get_db_connection(role="primary")
+    assert [row[0] for row in conn.execute("SELECT body FROM notes")] == ["kept"]
+    conn.close()
+
+
+def test_with_block_rolls_back_on_error(users_db):
+    with pytest.raises(RuntimeError):
+        with database.get_db_connection(role="primary") as conn:
+            conn.execute("INSERT INTO notes VALUES ('lost')")
+            raise RuntimeError("boom")
+    assert database._sqlite_local.refs[users_db] == 0
+
+    conn = database.get_db_connection(role="primary")
+    assert conn.execute("SELECT COUNT(*) FROM notes").fetchone()[0] == 0
+    conn.close()
@@ -0,0 +1,45 @@
+"""The hot queries in database.HOT_QUERIES must be answered from an index.
+
+Runs against fresh SQLite databases in a temporary directory: the tables are
+created by init_users_db() / init_bus_db(), which apply every migration.
+"""
+
+import pytest
+
+import database
+
+
+@pytest.fixture
+def sqlite_dbs(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "IS_PRODUCTION", False)
+    monkeypatch.setattr(database, "USERS_DB_FILE", str(tmp_path / "users.db"))
+    monkeypatch.setattr(database, "BUS_DB_FILE", str(tmp_path / "bus_data.db"))
+    monkeypatch.setattr(database, "ARRIVALS_DIR", str(tmp_path / "arrivals"))
+    database.init_users_db()
+    database.init_bus_db()
+    return tmp_path
+
+
+def test_migrations_are_recorded(sqlite_dbs):
+    conn = database.get_bus_db_connection(role="primary")
+    versions = [row[0] for row in conn.execute(
+        "SELECT version FROM schema_migrations WHERE scope = 'bus' ORDER BY version")]
+    conn.close()
+    assert versions == [version for version, _, _ in database.BUS_MIGRATIONS]
+
+
+def test_hot_queries_use_an_index(sqlite_dbs):
+    assert database.check_query_plans(verbose=False) == []
+
+
+def test_every_hot_query_is_checked(sqlite_dbs):
+    scopes = {scope for scope, _, _, _ in database.HOT_QUERIES}
+    assert scopes == {"users", "bus", "arrivals", "arrival_day"}
+
+
+def test_full_scan_is_reported(sqlite_dbs, monkeypatch):
+    monkeypatch.setattr(database, "HOT_QUERIES", database.HOT_QUERIES + [
+        ("bus", "unindexed column", "SELECT code FROM bus_stops WHERE road = {p}", ("Orchard Rd",)),
+    ])
+    failures = database.check_query_plans(verbose=False)
+    assert [name for name, _ in failures] == ["unindexed column"]
@@ -0,0 +1,427 @@
+"""
+trips.py
+--------
+Reconstructs individual bus trips from bus_arrivals and stores each trip as
+one compact row of bus_trips.
+
+Every collector row is a prediction: at poll time ts, a bus of `service`
+is expected at `stop_code` at ts + eta_min. Rows of one closed arrivals
+partition are replayed in insert order and linked per (service, direction)
+using the bus_routes stop sequence:
+  * a prediction within SAME_VISIT_SECONDS (plus a share of its lead time)
+    of the latest prediction of an open trip at the same stop is the same
+    bus being re-predicted;
+  * a prediction at a stop the trip has no prediction for yet fits if the
+    time since (or until) its nearest known stops matches the trip's pace
+    (seconds per stop so far, or the route's smoothed pace for a trip seen
+    at one stop) within PACE_TOLERANCE, widened for far-off predictions;
+    the closest fit wins, otherwise a new trip starts.
+A trip closes after TRIP_IDLE_SECONDS without new predictions.
+
+Per stop the trip keeps its final prediction as the arrival time ("observed"
+when the last ETA was at most OBSERVED_ETA minutes) and its first
+prediction. Stops in between that were never polled get arrival times
+interpolated by route distance. The arrays are delta-encoded and packed as
+zigzag varints, so a trip of a few dozen stops is a couple of hundred bytes
+instead of hundreds of arrival rows.
+
+Usage:
+    python trips.py [--rebuild] [--unit UNIT]
+"""
+
+import argparse
+import time
+from bisect import bisect_left, insort
+from datetime import datetime
+
+from analytics_pipeline import arrival_units, read_unit
+from database import IS_PRODUCTION, get_bus_db_connection, write_bus_trips
+
+TRIP_FORMAT = 1
+SAME_VISIT_SECONDS = 180
+SAME_VISIT_LEAD_SHARE = 0.2       # far-off predictions move more between polls
+MIN_SECONDS_PER_STOP = 15
+TYPICAL_SECONDS_PER_STOP = 90     # starting pace of a route until its trips show their own
+PACE_TOLERANCE = 0.3              # a new stop may be this share off the expected travel time
+PACE_SLACK_SECONDS = 180          # (or this many seconds, whichever is larger)...
+PACE_LEAD_SHARE = 0.1             # ...plus a share of the prediction's lead time
+PACE_SMOOTHING = 0.1
+TRIP_IDLE_SECONDS = 1800
+MIN_TRIP_STOPS = 2
+OBSERVED_ETA = 1.0
+CHUNK_SIZE = 50000
+
+KIND_INTERPOLATED, KIND_PREDICTED, KIND_OBSERVED = 0, 1, 2
+KIND_NAMES = {KIND_INTERPOLATED: "interpolated", KIND_PREDICTED: "predicted", KIND_OBSERVED: "observed"}
+
+
+# ---- Compact encoding ----
+def encode_varints(values):
+    """Zigzag LEB128: small positive and negative ints take one byte."""
+    out = bytearray()
+    for value in values:
+        value = value * 2 if value >= 0 else -value * 2 - 1
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+
+def decode_varints(data):
+    values, value, shift = [], 0, 0
+    for byte in bytes(data):
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append(value >> 1 if not value & 1 else -(value >> 1) - 1)
+        value, shift = 0, 0
+    return values
+
+
+def _deltas(values):
+    return [value - previous for previous, value in zip([0] + values[:-1], values)]
+
+
+def _undelta(deltas):
+    values, total = [], 0
+    for delta in deltas:
+        total += delta
+        values.append(total)
+    return values
+
+
+def encode_trip(seqs, arrivals, kinds, errors, leads):
+    """Payload of one trip: format, stop count, then seq and arrival (seconds after the
+    first stop) deltas, kinds, and the first-prediction error and lead of every
+    non-interpolated stop."""
+    start = arrivals[0]
+    values = [TRIP_FORMAT, len(seqs)] + _deltas(seqs) + _deltas([a - start for a in arrivals]) + kinds
+    for kind, error, lead in zip(kinds, errors, leads):
+        if kind != KIND_INTERPOLATED:
+            values += [error, lead]
+    return encode_varints(values)
+
+
+def decode_trip(payload):
+    """[(seq, seconds after the first stop, kind, first-prediction error s, lead s)] of a payload."""
+    values = decode_varints(payload)
+    if values[0] != TRIP_FORMAT:
+        raise ValueError(f"unknown trip format {values[0]}")
+    n = values[1]
+    seqs = _undelta(values[2:2 + n])
+    offsets = _undelta(values[2 + n:2 + 2 * n])
+    kinds = values[2 + 2 * n:2 + 3 * n]
+    extra = iter(values[2 + 3 * n:])
+    stops = []
+    for seq, offset, kind in zip(seqs, offsets, kinds):
+        error, lead = (next(extra), next(extra)) if kind != KIND_INTERPOLATED else (None, None)
+        stops.append((seq, offset, kind, error, lead))
+    return stops
+
+
+# ---- Routes ----
+def load_routes():
+    """service -> {"stops": {stop: [(direction, seq)]}, "by_seq": {(direction, seq): (stop, distance)}}."""
+    conn = get_bus_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT ServiceNo AS service_no, Direction AS direction, StopSequence AS stop_sequence,
+               BusStopCode AS bus_stop_code, Distance AS distance
+        FROM bus_routes
+        ORDER BY ServiceNo, Direction, StopSequence
+    """)
+    routes = {}
+    for row in cursor.fetchall():
+        route = routes.setdefault(row["service_no"], {"stops": {}, "by_seq": {}})
+        key = (int(row["direction"]), int(row["stop_sequence"]))
+        if key in route["by_seq"]:
+            continue
+        distance = float(row["distance"]) if row["distance"] is not None else None
+        route["by_seq"][key] = (row["bus_stop_code"], distance)
+        route["stops"].setdefault(row["bus_stop_code"], []).append(key)
+    cursor.close()
+    conn.close()
+    return routes
+
+
+# ---- Reconstruction ----
+class Trip:
+    """Predictions of one bus along one direction.
+
+    stops: seq -> [first poll, first arrival, last arrival, last eta, last poll]
+    """
+
+    __slots__ = ("service", "direction", "stops", "seqs", "updated", "observations")
+
+    def __init__(self, service, direction):
+        self.service, self.direction = service, direction
+        self.stops, self.seqs = {}, []
+        self.updated, self.observations = 0.0, 0
+
+    def pace(self):
+        """Seconds per stop over the stops this trip has been predicted at, or None."""
+        if len(self.seqs) < 2:
+            return None
+        first, last = self.seqs[0], self.seqs[-1]
+        return (self.stops[last][2] - self.stops[first][2]) / (last - first)
+
+    def fit(self, seq, polled, arrival, route_pace):
+        """How well a prediction at `seq` continues this trip (lower is better), or None."""
+        visit = self.stops.get(seq)
+        if visit is not None:
+            if visit[4] == polled:
+                return None    # one poll predicts each bus at a stop only once
+            gap, lead = abs(arrival - visit[2]), arrival - polled
+            return gap if gap <= SAME_VISIT_SECONDS + SAME_VISIT_LEAD_SHARE * lead else None
+        # The trip's own pace, kept near the route's so a mislinked trip cannot drift off
+        pace = self.pace() or route_pace
+        pace = min(max(pace, route_pace * (1 - PACE_TOLERANCE)), route_pace * (1 + PACE_TOLERANCE))
+        i = bisect_left(self.seqs, seq)
+        neighbours = ([self.seqs[i - 1]] if i else []) + ([self.seqs[i]] if i < len(self.seqs) else [])
+        score = 0.0
+        for known in neighbours:
+            # Stops and seconds from the known stop to this one, both positive when the order is right
+            stops_between = abs(seq - known)
+            gap = arrival - self.stops[known][2] if known < seq else self.stops[known][2] - arrival
+            expected = stops_between * pace
+            slack = max(PACE_SLACK_SECONDS, PACE_TOLERANCE * expected) + PACE_LEAD_SHARE * (arrival - polled)
+            if gap < stops_between * MIN_SECONDS_PER_STOP or abs(gap - expected) > slack:
+                return None
+            score = max(score, abs(gap - expected))
+        # Re-predictions of a stop already on the trip are preferred over extending it
+        return SAME_VISIT_SECONDS + score
+
+    def observe(self, seq, polled, arrival, eta):
+        visit = self.stops.get(seq)
+        if visit is None:
+            self.stops[seq] = [polled, arrival, arrival, eta, polled]
+            insort(self.seqs, seq)
+        else:
+            visit[2], visit[3], visit[4] = arrival, eta, polled
+        self.updated = polled
+        self.observations += 1
+
+
+class TripBuilder:
+    """Links a time-ordered stream of arrival rows into trips."""
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.open = {}       # (service, direction) -> [Trip]
+        self.finished = []
+        self.unmatched = 0
+        self.paces = {}      # (service, direction) -> smoothed seconds per stop
+        self._times = {}
+
+    def epoch(self, ts):
+        if isinstance(ts, datetime):
+            return ts.timestamp()
+        seconds = self._times.get(ts)
+        if seconds is None:
+            if len(self._times) > 10000:
+                self._times.clear()
+            seconds = self._times[ts] = datetime.fromisoformat(ts).timestamp()
+        return seconds
+
+    def add(self, stop, service, eta, ts):
+        route = self.routes.get(service)
+        candidates = route["stops"].get(stop) if route else None
+        if not candidates:
+            self.unmatched += 1
+            return
+        polled = self.epoch(ts)
+        arrival = polled + eta * 60
+        best = None
+        for direction, seq in candidates:
+            route_pace = self.paces.get((service, direction), TYPICAL_SECONDS_PER_STOP)
+            for trip in self.open.get((service, direction), ()):
+                score = trip.fit(seq, polled, arrival, route_pace)
+                if score is not None and (best is None or score < best[0]):
+                    best = (score, trip, seq)
+        if best is None:
+            direction, seq = candidates[0]
+            trip = Trip(service, direction)
+            self.open.setdefault((service, direction), []).append(trip)
+            trip.observe(seq, polled, arrival, eta)
+            return
+        trip = best[1]
+        trip.observe(best[2], polled, arrival, eta)
+        pace = trip.pace()
+        if pace is not None:
+            key = (trip.service, trip.direction)
+            current = self.paces.get(key, pace)
+            self.paces[key] = current + PACE_SMOOTHING * (pace - current)
+
+    def close_idle(self, now=None):
+        """Finish trips without a prediction for TRIP_IDLE_SECONDS (all of them when now is None)."""
+        for key, trips in list(self.open.items()):
+            keep = []
+            for trip in trips:
+                if now is not None and now - trip.updated < TRIP_IDLE_SECONDS:
+                    keep.append(trip)
+                elif len(trip.stops) >= MIN_TRIP_STOPS:
+                    self.finished.append(trip)
+            if keep:
+                self.open[key] = keep
+            else:
+                del self.open[key]
+
+    def take_finished(self):
+        finished, self.finished = self.finished, []
+        return finished
+
+
+def trip_record(trip, route, source_unit, trip_no):
+    """bus_trips row of a finished trip, interpolating the stops it was never predicted at."""
+    seqs = trip.seqs
+    arrivals, previous = [], None
+    for seq in seqs:
+        arrival = trip.stops[seq][2]
+        previous = arrival if previous is None else max(arrival, previous)  # arrivals never go backwards
+        arrivals.append(previous)
+
+    out = {"seq": [], "arrival": [], "kind": [], "error": [], "lead": []}
+    for i, seq in enumerate(seqs):
+        if i:
+            lower, upper = seqs[i - 1], seq
+            start, end = arrivals[i - 1], arrivals[i]
+            d0 = route["by_seq"].get((trip.direction, lower), (None, None))[1]
+            d1 = route["by_seq"].get((trip.direction, upper), (None, None))[1]
+            for between in range(lower + 1, upper):
+                if (trip.direction, between) not in route["by_seq"]:
+                    continue
+                d = route["by_seq"][(trip.direction, between)][1]
+                if None not in (d0, d1, d) and d1 > d0:
+                    share = (d - d0) / (d1 - d0)
+                else:
+                    share = (between - lower) / (upper - lower)
+                out["seq"].append(between)
+                out["arrival"].append(round(start + share * (end - start)))
+                out["kind"].append(KIND_INTERPOLATED)
+                out["error"].append(0)
+                out["lead"].append(0)
+        first_poll, first_arrival, _, last_eta, _ = trip.stops[seq]
+        out["seq"].append(seq)
+        out["arrival"].append(round(arrivals[i]))
+        out["kind"].append(KIND_OBSERVED if last_eta <= OBSERVED_ETA else KIND_PREDICTED)
+        out["error"].append(round(first_arrival - arrivals[i]))
+        out["lead"].append(round(arrivals[i] - first_poll))
+
+    start, end = datetime.fromtimestamp(out["arrival"][0]), datetime.fromtimestamp(out["arrival"][-1])
+    payload = encode_trip(out["seq"], out["arrival"], out["kind"], out["error"], out["lead"])
+    return (source_unit, trip.service, trip.direction, trip_no, start.strftime("%Y-%m-%d"),
+            start.strftime("%Y-%m-%d %H:%M:%S"), end.strftime("%Y-%m-%d %H:%M:%S"),
+            out["seq"][0], out["seq"][-1], len(trip.stops), trip.observations, payload)
+
+
+def build_unit(unit, routes, chunk_size=CHUNK_SIZE):
+    """Rebuild the trips of one arrivals partition. Returns (arrivals read, trips, payload bytes).
+
+    The unit's trip rows are kept in memory (a few hundred bytes each) and replace
+    the previous ones in a single transaction.
+    """
+    builder = TripBuilder(routes)
+    arrivals, records = 0, []
+
+    def finish(trips):
+        for trip in trips:
+            records.append(trip_record(trip, routes[trip.service], unit, len(records)))
+
+    for rows in read_unit(unit, 0, chunk_size):
+        for _, stop, service, eta, ts in rows:
+            if stop is not None and service is not None:
+                builder.add(stop, service, eta, ts)
+        arrivals += len(rows)
+        builder.close_idle(builder.epoch(rows[-1][4]))
+        finish(builder.take_finished())
+    builder.close_idle()
+    finish(builder.take_finished())
+    payload_bytes = sum(len(record[-1]) for record in records)
+    write_bus_trips(unit, records, arrivals, payload_bytes)
+    if builder.unmatched:
+        print(f"⚠️ {unit}: {builder.unmatched} arrivals at stops not on their service's route")
+    return arrivals, len(records), payload_bytes
+
+
+def _built_units():
+    conn = get_bus_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT source_unit FROM bus_trip_units")
+    built = {row["source_unit"] for row in cursor.fetchall()}
+    cursor.close()
+    conn.close()
+    return built
+
+
+def reconstruct_trips(rebuild=False, only_unit=None, chunk_size=CHUNK_SIZE):
+    """Build trips for every closed arrivals partition not built yet. Returns the units built."""
+    built = set() if rebuild else _built_units()
+    units = [unit for unit, closed in arrival_units() if closed and unit not in built]
+    if only_unit:
+        units = [only_unit]
+    if not units:
+        return []
+    routes = load_routes()
+    for unit in units:
+        t0 = time.time()
+        arrivals, trips, payload_bytes = build_unit(unit, routes, chunk_size)
+        print(f"🚌 {unit}: {arrivals} arrivals -> {trips} trips ({payload_bytes / 1024:.0f} KiB) "
+              f"in {time.time() - t0:.1f}s")
+    return units
+
+
+def read_trips(service, direction, service_date, limit=500):
+    """Decoded trips of one service and direction starting on `service_date` (YYYY-MM-DD).
+
+    Each trip is one row, so a day of a service is read without touching bus_arrivals.
+    """
+    param = "%s" if IS_PRODUCTION else "?"
+    conn = get_bus_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT StopSequence AS stop_sequence, BusStopCode AS bus_stop_code FROM bus_routes
+        WHERE ServiceNo = {param} AND Direction = {param}
+    """, (service, direction))
+    stop_codes = {int(row["stop_sequence"]): row["bus_stop_code"] for row in cursor.fetchall()}
+    cursor.execute(f"""
+        SELECT start_time, stops_observed, observations, payload FROM bus_trips
+        WHERE service = {param} AND direction = {param} AND service_date = {param}
+        ORDER BY start_time LIMIT {int(limit)}
+    """, (service, direction, service_date))
+    rows = cursor.fetchall()
+    cursor.close()
+    conn.close()
+
+    trips = []
+    for row in rows:
+        start = row["start_time"]
+        start = (start if isinstance(start, datetime) else datetime.fromisoformat(str(start))).timestamp()
+        trips.append({
+            "stops_observed": row["stops_observed"],
+            "observations": row["observations"],
+            "stops": [{
+                "seq": seq,
+                "stop": stop_codes.get(seq),
+                "arrival": datetime.fromtimestamp(start + offset).isoformat(),
+                "kind": KIND_NAMES[kind],
+                "prediction_error_s": error,
+                "lead_s": lead,
+            } for seq, offset, kind, error, lead in decode_trip(row["payload"])],
+        })
+    return trips
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the trips of every closed partition")
+    parser.add_argument("--unit", help="rebuild one partition (SQLite day YYYYMMDD or PostgreSQL partition name)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    if not reconstruct_trips(args.rebuild, args.unit, args.chunk_size):
+        print("✅ No closed arrivals partitions left to reconstruct")
+
+
+if __name__ == "__main__":
+    main()